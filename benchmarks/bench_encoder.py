@@ -0,0 +1,92 @@
+"""Compares the question serializers against the generic attrs.asdict encoder they replaced.
+
+Run with `python -m benchmarks.bench_encoder [--questions 20] [--grid-size 64] [--length 100]`.
+"""
+
+import argparse
+import dataclasses
+import json
+import logging
+import timeit
+from typing import Any, Callable, Dict, List
+
+import attrs
+import numpy as np
+
+from experiment_server.encoder import encode_compact_json, encode_json
+from experiment_server.type import Question, State, Trajectory
+
+
+class AsdictEncoder(json.JSONEncoder):
+    """The encoder as it was before the dedicated serializers."""
+
+    def default(self, obj):
+        if isinstance(obj, np.integer):
+            return int(obj)
+        elif isinstance(obj, np.floating):
+            return float(obj)
+        elif isinstance(obj, np.ndarray):
+            return obj.tolist()
+        elif dataclasses.is_dataclass(obj):
+            return dataclasses.asdict(obj)
+        elif attrs.has(obj):
+            logging.debug(f"Serializing attrs class {obj} to {attrs.asdict(obj)}")
+            return attrs.asdict(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def encode_asdict(obj: Any) -> bytes:
+    return json.dumps(obj, cls=AsdictEncoder).encode("utf-8")
+
+
+def make_questions(n_questions: int, grid_size: int, length: int) -> List[Question]:
+    rng = np.random.default_rng(0)
+
+    def traj() -> Trajectory:
+        return Trajectory(
+            start_state=State(
+                grid=rng.integers(0, 13, size=grid_size * grid_size, dtype=np.int32),
+                grid_shape=(grid_size, grid_size),
+                agent_pos=(1, 1),
+                exit_pos=(grid_size - 2, grid_size - 2),
+            ),
+            actions=rng.integers(0, 15, size=length),
+            env_name="miner",
+            modality="traj",
+        )
+
+    return [Question(id=i, trajs=(traj(), traj())) for i in range(n_questions)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=20)
+    parser.add_argument("--grid-size", type=int, default=64)
+    parser.add_argument("--length", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    questions = make_questions(args.questions, args.grid_size, args.length)
+    encoders: Dict[str, Callable[[Any], bytes]] = {
+        "asdict (old)": encode_asdict,
+        "encode_json": encode_json,
+        "encode_compact_json": encode_compact_json,
+    }
+    assert encode_json(questions) == encode_asdict(questions)
+
+    baseline = None
+    for name, encode in encoders.items():
+        n_runs = 10
+        best = min(
+            timeit.repeat(lambda: encode(questions), number=n_runs, repeat=args.repeat)
+        )
+        per_question = best / n_runs / len(questions)
+        baseline = baseline or per_question
+        print(
+            f"{name:>20}: {per_question * 1e6:8.1f}us/question, {len(encode(questions)):>9} bytes, "
+            f"{baseline / per_question:4.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""Drives simulated participants through the whole study against the mocked s3 app.
+
+Each participant runs welcome -> instructions -> interact_times -> random_questions -> one
+submit_answer per question (20 unless the database has fewer) -> goodbye, with its own session, and
+up to --concurrency participants run at once. Afterwards every participant's user file is read back
+to count answers and interact times that were acknowledged but never stored.
+
+Reports throughput, latency percentiles per route, s3 requests and cost per participant, and errors,
+and writes them to --out as JSON. Pass --compare with an earlier results file to print what changed.
+
+Run from the repository root, with the question database at experiment_server/experiments.db:
+`python -m benchmarks.bench_load [--participants 50] [--concurrency 10] [--out load_test.json]`.
+Set WRITE_BEHIND_SPOOL to measure with write-behind.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import subprocess
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from secrets import token_hex
+from typing import Any, Dict, List, Optional, Tuple
+
+import arrow
+import numpy as np
+
+os.environ.setdefault("SECRET_KEY", token_hex(16))
+
+# mocked_app starts moto before importing the real app, so it has to come first.
+from experiment_server.mocked_app import app, request_counter  # noqa: E402
+from experiment_server.common import get_user_fs  # noqa: E402
+from experiment_server.user_file import read_user  # noqa: E402
+from experiment_server.write_behind import WriteBehindFS  # noqa: E402
+
+# (route, seconds, status), status 0 if the request raised.
+Timing = Tuple[str, float, int]
+
+
+class Participant:
+    def __init__(self):
+        self.client = app.test_client()
+        self.timings: List[Timing] = []
+        self.user_id: Optional[int] = None
+        self.answered: List[int] = []
+
+    def request(self, method: str, route: str, **kwargs) -> Any:
+        start = time.perf_counter()
+        try:
+            response = self.client.open(route, method=method, **kwargs)
+        except Exception:
+            logging.exception(f"{method} {route} raised")
+            self.timings.append((route, time.perf_counter() - start, 0))
+            return None
+        self.timings.append((route, time.perf_counter() - start, response.status_code))
+        return response
+
+    def run(self) -> None:
+        self.request("GET", "/")
+        with self.client.session_transaction() as session:
+            self.user_id = session.get("user_id")
+        self.request("GET", "/instructions")
+        now = arrow.utcnow()
+        self.request(
+            "POST",
+            "/interact_times",
+            json={
+                "startTime": now.shift(minutes=-2).isoformat(),
+                "stopTime": now.isoformat(),
+            },
+        )
+        response = self.request(
+            "POST",
+            "/random_questions",
+            json={"env": "miner", "lengths": [], "type": "traj"},
+        )
+        questions = response.get_json() if response is not None else None
+        for question in questions or []:
+            start_time = arrow.utcnow()
+            response = self.request(
+                "POST",
+                "/submit_answer",
+                json={
+                    "id": question["id"],
+                    "answer": "right" if question["id"] % 2 == 0 else "left",
+                    "startTime": start_time.shift(seconds=-5).isoformat(),
+                    "stopTime": start_time.isoformat(),
+                    "maxSteps": [10, 10],
+                },
+            )
+            if response is not None and response.status_code == 200:
+                self.answered.append(question["id"])
+        self.request("GET", "/goodbye")
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    ms = np.array(seconds) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99),
+    }
+
+
+def count_lost_writes(participants: List[Participant]) -> Dict[str, int]:
+    """Counts acknowledged answers and interact times that aren't in the user files."""
+    user_fs = get_user_fs()
+    lost = {"users": 0, "answers": 0, "interact_times": 0}
+    for participant in participants:
+        if participant.user_id is None:
+            continue
+        user = read_user(user_fs, participant.user_id)
+        if user is None:
+            lost["users"] += 1
+            lost["answers"] += len(participant.answered)
+            continue
+        stored = set(user.get_used_questions())
+        lost["answers"] += sum(1 for id in participant.answered if id not in stored)
+        if user.interact_times is None:
+            lost["interact_times"] += 1
+    return lost
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(n_participants: int, concurrency: int) -> Dict[str, Any]:
+    participants = [Participant() for _ in range(n_participants)]
+    cheap_before, expensive_before = request_counter.get_counts()
+    cost_before = request_counter.get_request_cost_cents() or 0.0
+
+    start = time.perf_counter()
+    # mocked_app prints the running s3 totals after every request.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(Participant.run, participants))
+    duration = time.perf_counter() - start
+    # Upload anything still spooled, so its requests are counted.
+    if isinstance(user_fs := get_user_fs(), WriteBehindFS):
+        user_fs.flush()
+
+    cheap, expensive = request_counter.get_counts()
+    cost = request_counter.get_request_cost_cents() or 0.0
+    by_route: Dict[str, List[Timing]] = defaultdict(list)
+    for participant in participants:
+        for timing in participant.timings:
+            by_route[timing[0]].append(timing)
+    n_requests = sum(len(timings) for timings in by_route.values())
+    routes = {
+        route: {
+            "requests": len(timings),
+            "errors": sum(1 for _, _, status in timings if not 200 <= status < 400),
+            **percentiles([seconds for _, seconds, _ in timings]),
+        }
+        for route, timings in by_route.items()
+    }
+
+    return {
+        "timestamp": arrow.utcnow().isoformat(),
+        "git_commit": git_commit(),
+        "config": {
+            "participants": n_participants,
+            "concurrency": concurrency,
+            "write_behind": os.environ.get("WRITE_BEHIND_SPOOL") is not None,
+        },
+        "duration_seconds": duration,
+        "participants_per_second": n_participants / duration,
+        "requests_per_second": n_requests / duration,
+        "routes": routes,
+        "errors": sum(route["errors"] for route in routes.values()),
+        "s3": {
+            "cheap_requests_per_participant": (cheap - cheap_before) / n_participants,
+            "expensive_requests_per_participant": (expensive - expensive_before)
+            / n_participants,
+            "cost_cents_per_participant": (cost - cost_before) / n_participants,
+        },
+        "lost_writes": count_lost_writes(participants),
+    }
+
+
+def print_results(results: Dict[str, Any]) -> None:
+    print(
+        f"{results['config']['participants']} participants in {results['duration_seconds']:.2f}s: "
+        f"{results['participants_per_second']:.2f} participants/s, "
+        f"{results['requests_per_second']:.1f} requests/s"
+    )
+    for route, stats in sorted(results["routes"].items()):
+        print(
+            f"{route:>18}: {stats['requests']:>6} requests, {stats['errors']:>4} errors, "
+            f"p50 {stats['p50_ms']:7.1f}ms, p95 {stats['p95_ms']:7.1f}ms, p99 {stats['p99_ms']:7.1f}ms"
+        )
+    s3 = results["s3"]
+    print(
+        f"s3 per participant: {s3['cheap_requests_per_participant']:.1f} GET-class, "
+        f"{s3['expensive_requests_per_participant']:.1f} PUT/LIST-class, "
+        f"{s3['cost_cents_per_participant']:.6f} cents"
+    )
+    print(f"errors: {results['errors']}, lost writes: {results['lost_writes']}")
+
+
+def print_comparison(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    def change(before: float, after: float) -> str:
+        if before == 0:
+            return f"{before:.3g} -> {after:.3g}"
+        return f"{before:.3g} -> {after:.3g} ({100 * (after - before) / before:+.1f}%)"
+
+    print(f"Compared to {old.get('git_commit')} at {old.get('timestamp')}:")
+    print(
+        f"  participants/s: {change(old['participants_per_second'], new['participants_per_second'])}"
+    )
+    for route, stats in sorted(new["routes"].items()):
+        if (before := old["routes"].get(route)) is not None:
+            print(f"  {route} p95 ms: {change(before['p95_ms'], stats['p95_ms'])}")
+    print(
+        "  cost cents/participant: "
+        + change(
+            old["s3"]["cost_cents_per_participant"],
+            new["s3"]["cost_cents_per_participant"],
+        )
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--participants", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--out", default="load_test.json")
+    parser.add_argument(
+        "--compare", help="Results file from an earlier run to compare against."
+    )
+    args = parser.parse_args()
+    # The app logs every request, which would swamp the results.
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = run(args.participants, args.concurrency)
+    print_results(results)
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
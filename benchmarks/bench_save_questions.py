@@ -0,0 +1,79 @@
+"""Times bulk_save_questions in-process and with pools of encoding processes.
+
+Run with `python -m benchmarks.bench_save_questions [--questions 5000] [--grid-size 64] [--length 100]
+[--workers 1 2 4]`.
+"""
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from pathlib import Path
+from typing import Iterator, Tuple
+
+import numpy as np
+
+from experiment_server.query import bulk_save_questions
+from experiment_server.type import State, Trajectory
+
+SCHEMA = Path(__file__).parent.parent / "experiment_server" / "schema.sql"
+
+
+def make_pairs(
+    n_questions: int, grid_size: int, length: int
+) -> Iterator[Tuple[Trajectory, Trajectory]]:
+    rng = np.random.default_rng(0)
+
+    def traj() -> Trajectory:
+        return Trajectory(
+            start_state=State(
+                grid=rng.integers(0, 13, size=grid_size * grid_size, dtype=np.int32),
+                grid_shape=(grid_size, grid_size),
+                agent_pos=(1, 1),
+                exit_pos=(grid_size - 2, grid_size - 2),
+            ),
+            actions=rng.integers(0, 15, size=length),
+            env_name="miner",
+            modality="traj",
+        )
+
+    for _ in range(n_questions):
+        yield traj(), traj()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=5000)
+    parser.add_argument("--grid-size", type=int, default=64)
+    parser.add_argument("--length", type=int, default=100)
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    baseline = None
+    for workers in args.workers:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            conn = sqlite3.connect(os.path.join(tmpdir, "questions.db"))
+            conn.executescript(SCHEMA.read_text())
+            pairs = make_pairs(args.questions, args.grid_size, args.length)
+            start = time.perf_counter()
+            bulk_save_questions(
+                conn,
+                pairs,
+                "random",
+                "miner",
+                chunk_size=args.chunk_size,
+                workers=workers,
+            )
+            elapsed = time.perf_counter() - start
+            conn.close()
+        baseline = baseline or elapsed
+        print(
+            f"workers={workers}: {elapsed:6.2f}s, {args.questions / elapsed:8.0f} questions/s, "
+            f"{baseline / elapsed:4.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""Async adapters over the blocking storage classes, for the ASGI app in asgi_app.py.
+
+fs and fs-s3fs only have blocking APIs, so each storage call runs on a shared, bounded thread pool
+and the event loop is free to serve other requests while it waits. Where a request needs several
+objects, they are requested concurrently rather than one after another.
+"""
+
+import asyncio
+import contextvars
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Optional, Sequence, TypeVar, Union
+
+from experiment_server.remote_sqlite import RemoteSqlite
+from experiment_server.type import Answer, User
+from experiment_server.user_db import UserDatabase
+from experiment_server.user_file import (
+    UserFile,
+    list_answer_segments,
+    merge_answers,
+    read_answer_segment,
+    read_snapshot,
+)
+
+T = TypeVar("T")
+
+# Storage calls in flight at once, per process.
+STORAGE_THREADS = int(os.environ.get("STORAGE_THREADS", 64))
+_executor = ThreadPoolExecutor(
+    max_workers=STORAGE_THREADS, thread_name_prefix="storage"
+)
+
+
+async def run_blocking(func: Callable[..., T], *args, **kwargs) -> T:
+    loop = asyncio.get_running_loop()
+    # Run in a copy of the caller's context, so storage calls are attributed to its route.
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        _executor, partial(context.run, func, *args, **kwargs)
+    )
+
+
+class AsyncRemoteSqlite:
+    """Async counterpart of RemoteSqlite.
+
+    There is no `con`: refresh can replace the local copy at any time, and many storage threads
+    read at once, so reads go through `read`, which hands a function one snapshot (see
+    `RemoteSqlite.view`) read through its thread's own connection. Awaiting several reads would
+    let a refresh land between them, so whatever has to be consistent belongs in one `read`.
+    """
+
+    def __init__(self, db: RemoteSqlite):
+        self.db = db
+
+    @property
+    def snapshot(self) -> int:
+        return self.db.snapshot
+
+    async def read(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Runs func(snapshot, *args, **kwargs) on a storage thread, with the current snapshot."""
+        return await run_blocking(lambda: func(self.db.view(), *args, **kwargs))
+
+    async def refresh(self) -> bool:
+        return await run_blocking(self.db.refresh)
+
+    async def pull(self, always_download: bool = False) -> None:
+        await run_blocking(self.db.pull, always_download)
+
+    async def push(self, always_upload: bool = False) -> None:
+        await run_blocking(self.db.push, always_upload)
+
+    async def transaction(
+        self, apply: Callable[[sqlite3.Connection], None], **kwargs
+    ) -> None:
+        await run_blocking(self.db.transaction, apply, **kwargs)
+
+
+class AsyncUserFile:
+    """Async counterpart of UserFile and UserDatabase, wrapping either one."""
+
+    def __init__(self, store: Union[UserFile, UserDatabase]):
+        self.store = store
+
+    def create(self) -> None:
+        self.store.create()
+
+    async def write(self, user: User) -> None:
+        if isinstance(self.store, UserDatabase):
+            await run_blocking(self.store.write, user)
+        else:
+            self.store.write(user)
+
+    async def get(self) -> User:
+        store = self.store
+        if isinstance(store, UserDatabase):
+            return await run_blocking(store.get)
+        if store.user is None:
+            store.load(await read_user_async(store))
+        assert store.user is not None
+        return store.user
+
+    async def add_answers(
+        self, answers: Sequence[Answer], key: Optional[str] = None
+    ) -> None:
+        if isinstance(self.store, UserDatabase):
+            await run_blocking(self.store.add_answers, answers, key)
+        else:
+            self.store.add_answers(answers, key)
+
+    async def flush(self) -> None:
+        store = self.store
+        if isinstance(store, UserDatabase):
+            return
+        writes = []
+        if len(store.pending_answers) > 0:
+            writes.append(run_blocking(store.write_segment, store.pending_answers))
+        if store.dirty and store.user is not None:
+            writes.append(run_blocking(store.write_snapshot, store.user))
+        await asyncio.gather(*writes)
+        store.pending_answers = []
+        store.segment_key = None
+        store.dirty = False
+
+
+async def read_user_async(user_file: UserFile) -> Optional[User]:
+    """read_user, but the snapshot and segment listing are fetched together, then every segment at once."""
+    user, paths = await asyncio.gather(
+        run_blocking(read_snapshot, user_file.fs, user_file.user_id),
+        run_blocking(list_answer_segments, user_file.fs, user_file.user_id),
+    )
+    if user is None:
+        return None
+    segments: List[List[Answer]] = await asyncio.gather(
+        *(run_blocking(read_answer_segment, user_file.fs, path) for path in paths)
+    )
+    return merge_answers(user, segments)
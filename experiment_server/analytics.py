@@ -0,0 +1,272 @@
+"""Summary statistics over participants' answers, for monitoring a study while it runs.
+
+Answers are held as columns of numpy arrays, in the layout written by export.py: user_id,
+question_id, prefer_right, start_time, end_time (seconds since the epoch) and max_steps (n x 2).
+Every statistic is computed with array operations over all answers at once, so a summary of the
+whole study takes milliseconds. The app serves `summarize` at /stats through a StatsCache, which
+recomputes it on a background thread.
+"""
+
+import logging
+import math
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from experiment_server.metrics import labeled
+
+Columns = Dict[str, np.ndarray]
+
+# Seconds since the epoch of a timestamp stored as ISO 8601 text, computed by sqlite.
+_EPOCH_SECONDS = "(julianday({}) - 2440587.5) * 86400.0"
+
+
+def answers_from_user_db(conn: sqlite3.Connection) -> Columns:
+    """Reads every answer in a user database (see user_db.py) into columns."""
+    rows = conn.execute(f"""
+SELECT
+    user_id,
+    question_id,
+    answer,
+    {_EPOCH_SECONDS.format("start_time")},
+    {_EPOCH_SECONDS.format("end_time")},
+    COALESCE(max_steps_left, -1),
+    COALESCE(max_steps_right, -1)
+FROM answers
+ORDER BY user_id, id""").fetchall()
+    table = np.array(rows, dtype=np.float64).reshape(-1, 7)
+    return {
+        "user_id": table[:, 0].astype(np.int64),
+        "question_id": table[:, 1].astype(np.int64),
+        "prefer_right": table[:, 2].astype(np.bool_),
+        "start_time": table[:, 3],
+        "end_time": table[:, 4],
+        "max_steps": table[:, 5:7].astype(np.int32),
+    }
+
+
+def question_metadata(conn: sqlite3.Connection) -> Columns:
+    """The modality and length of every question in the question database, sorted by id.
+
+    Questions comparing trajectories of different modalities have modality "mixed", and questions
+    comparing trajectories of different lengths have length -1.
+    """
+    rows = conn.execute("""
+SELECT
+    q.id,
+    CASE WHEN left.modality = right.modality THEN left.modality ELSE 'mixed' END,
+    CASE WHEN left.length = right.length THEN left.length ELSE -1 END
+FROM
+    questions AS q
+    JOIN trajectories AS left ON
+        q.first_id=left.id
+    JOIN trajectories AS right ON
+        q.second_id=right.id
+ORDER BY q.id""").fetchall()
+    return {
+        "question_id": np.array([row[0] for row in rows], dtype=np.int64),
+        "modality": np.array([row[1] for row in rows], dtype=str),
+        "length": np.array([row[2] for row in rows], dtype=np.int64),
+    }
+
+
+def response_times(answers: Columns) -> np.ndarray:
+    return answers["end_time"] - answers["start_time"]
+
+
+def preference_matrix(answers: Columns) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns user ids, question ids and a user x question matrix of preferences.
+
+    Entries are 1.0 if the user preferred the right trajectory, 0.0 if they preferred the left and NaN
+    if they didn't answer. If a user answered a question twice, their last answer counts.
+    """
+    user_ids, user_index = np.unique(answers["user_id"], return_inverse=True)
+    question_ids, question_index = np.unique(
+        answers["question_id"], return_inverse=True
+    )
+    matrix = np.full((len(user_ids), len(question_ids)), np.nan)
+    matrix[user_index, question_index] = answers["prefer_right"]
+    return user_ids, question_ids, matrix
+
+
+def pairwise_agreement(n_right: np.ndarray, n: np.ndarray) -> np.ndarray:
+    """Fraction of pairs of answers to the same question that agree, NaN for fewer than two answers."""
+    agreeing = n_right * (n_right - 1) + (n - n_right) * (n - n_right - 1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(n >= 2, agreeing / (n * (n - 1)), np.nan)
+
+
+def question_stats(answers: Columns) -> Columns:
+    """Per question: number of answers, fraction preferring the right trajectory, and agreement."""
+    _, question_ids, matrix = preference_matrix(answers)
+    answered = ~np.isnan(matrix)
+    n = answered.sum(axis=0)
+    n_right = np.nansum(matrix, axis=0)
+    return {
+        "question_id": question_ids,
+        "n_answers": n,
+        "prefer_right": n_right / n,
+        "agreement": pairwise_agreement(n_right, n),
+    }
+
+
+def grouped_medians(
+    keys: np.ndarray, values: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The median of values for each distinct key."""
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    unique_keys, starts, counts = np.unique(keys, return_index=True, return_counts=True)
+    lower = values[starts + (counts - 1) // 2]
+    upper = values[starts + counts // 2]
+    return unique_keys, (lower + upper) / 2
+
+
+def timing_outliers(answers: Columns, threshold: float = 3.5) -> Columns:
+    """Participants whose median response time is far from everyone else's.
+
+    Uses the modified z-score of each participant's median time, which is based on the median
+    absolute deviation and so isn't thrown off by the outliers themselves.
+    """
+    user_ids, medians = grouped_medians(answers["user_id"], response_times(answers))
+    center = np.median(medians) if len(medians) > 0 else 0.0
+    mad = np.median(np.abs(medians - center)) if len(medians) > 0 else 0.0
+    if mad == 0:
+        z = np.zeros_like(medians)
+    else:
+        z = 0.6745 * (medians - center) / mad
+    outlier = np.abs(z) > threshold
+    return {
+        "user_id": user_ids[outlier],
+        "median_response_time": medians[outlier],
+        "z": z[outlier],
+    }
+
+
+def breakdown(answers: Columns, groups: np.ndarray) -> List[Dict[str, Any]]:
+    """Answer counts, preference rates, agreement and response times for each group of answers."""
+    keys, index = np.unique(groups, return_inverse=True)
+    n = np.bincount(index, minlength=len(keys))
+    n_right = np.bincount(index, weights=answers["prefer_right"], minlength=len(keys))
+    times = response_times(answers)
+    _, median_times = grouped_medians(index, times)
+
+    # Agreement is between answers to the same question, so average it over each group's questions.
+    stats = question_stats(answers)
+    question_index = np.searchsorted(stats["question_id"], answers["question_id"])
+    first = np.unique(question_index, return_index=True)[1]
+    question_group = index[first]
+    agreement = stats["agreement"][question_index[first]]
+    has_agreement = ~np.isnan(agreement)
+    n_questions = np.bincount(question_group, minlength=len(keys))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_agreement = np.bincount(
+            question_group[has_agreement],
+            weights=agreement[has_agreement],
+            minlength=len(keys),
+        ) / np.bincount(question_group[has_agreement], minlength=len(keys))
+
+    return [
+        {
+            "group": key.item(),
+            "n_answers": int(n[i]),
+            "n_questions": int(n_questions[i]),
+            "prefer_right": float(n_right[i] / n[i]),
+            "agreement": float(mean_agreement[i]),
+            "median_response_time": float(median_times[i]),
+        }
+        for i, key in enumerate(keys)
+    ]
+
+
+def question_groups(
+    answers: Columns, questions: Columns
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The modality and length of the question of each answer, "unknown" and -1 for missing questions."""
+    ids = questions["question_id"]
+    if len(ids) == 0:
+        n = len(answers["question_id"])
+        return np.full(n, "unknown"), np.full(n, -1)
+    index = np.minimum(np.searchsorted(ids, answers["question_id"]), len(ids) - 1)
+    found = ids[index] == answers["question_id"]
+    modality = np.where(found, questions["modality"][index], "unknown")
+    length = np.where(found, questions["length"][index], -1)
+    return modality, length
+
+
+def _nan_to_none(value: Any) -> Any:
+    # NaN isn't valid JSON.
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    elif isinstance(value, list):
+        return [_nan_to_none(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: _nan_to_none(v) for k, v in value.items()}
+    return value
+
+
+def summarize(answers: Columns, questions: Optional[Columns] = None) -> Dict[str, Any]:
+    """Everything /stats reports, as JSON-compatible values."""
+    times = response_times(answers)
+    per_question = question_stats(answers)
+    outliers = timing_outliers(answers)
+    summary: Dict[str, Any] = {
+        "n_users": int(len(np.unique(answers["user_id"]))),
+        "n_answers": int(len(answers["user_id"])),
+        "n_questions": int(len(per_question["question_id"])),
+        "prefer_right": (
+            float(answers["prefer_right"].mean()) if len(times) > 0 else None
+        ),
+        "median_response_time": float(np.median(times)) if len(times) > 0 else None,
+        "questions": {name: column.tolist() for name, column in per_question.items()},
+        "timing_outliers": {name: column.tolist() for name, column in outliers.items()},
+    }
+    if questions is not None and len(times) > 0:
+        modality, length = question_groups(answers, questions)
+        summary["by_modality"] = breakdown(answers, modality)
+        summary["by_length"] = breakdown(answers, length)
+    return _nan_to_none(summary)
+
+
+class StatsCache:
+    """Serves the last computed summary, recomputing it in the background once it's max_age old.
+
+    Requests never wait for a summary to be computed: `get` returns the previous one (or None, before
+    the first has finished) and starts at most one background computation.
+    """
+
+    def __init__(self, max_age: float):
+        self.max_age = max_age
+        self.value: Optional[Dict[str, Any]] = None
+        self.computed_at = float("-inf")
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self, compute: Callable[[], Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if (
+                not self._refreshing
+                and time.monotonic() - self.computed_at >= self.max_age
+            ):
+                self._refreshing = True
+                threading.Thread(
+                    target=self._refresh, args=(compute,), name="stats", daemon=True
+                ).start()
+            return self.value
+
+    def _refresh(self, compute: Callable[[], Dict[str, Any]]) -> None:
+        try:
+            with labeled("stats"):
+                value: Optional[Dict[str, Any]] = compute()
+        except Exception:
+            logging.exception("Computing stats failed")
+            value = None
+        with self._lock:
+            if value is not None:
+                self.value = value
+            # After a failure too, so a broken export isn't retried on every request.
+            self.computed_at = time.monotonic()
+            self._refreshing = False
@@ -1,13 +1,9 @@
 import os
-import re
+import sqlite3
+import threading
 from logging.config import dictConfig
-from secrets import token_hex
-from typing import Final, Literal, Optional, Tuple
+from typing import Final, List, Optional, Union
 
-import arrow
-import fs
-import fs.base
-import numpy as np
 from flask import (
     Flask,
     g,
@@ -20,22 +16,52 @@ from flask import (
 )
 from werkzeug import Response
 
-from experiment_server.encoder import Encoder
-from experiment_server.query import (
-    get_named_question,
-    get_random_questions,
-    insert_question,
-    insert_traj,
+from experiment_server.common import (
+    DATABASE_MAX_AGE,
+    METRICS_MIMETYPE,
+    PROFILE_SECRET,
+    Page,
+    admin_authorized,
+    answer_batch,
+    cached_stats,
+    encode_question_response,
+    create_user_db,
+    get_db_filename,
+    get_db_fs,
+    get_id_allocator,
+    get_journal,
+    has_participant,
+    is_loopback,
+    journal_question,
+    journal_trajectory,
+    metrics_text,
+    missing_consent,
+    named_question,
+    open_user_store,
+    parse_answer,
+    parse_interact_times,
+    progress_redirect,
+    question_cache,
+    random_questions,
+    record_answer_batch,
+    record_progress,
+    request_metrics,
+    session_progress,
+    start_participant,
+    use_user_db,
 )
-from experiment_server.remote_sqlite import RemoteSqlite
-from experiment_server.type import Answer, State, Trajectory
+from experiment_server.encoder import JSONProvider
+from experiment_server.profiling import (
+    ActiveProfile,
+    ProfileBuffer,
+    server_timing,
+)
+from experiment_server.remote_sqlite import RemoteSqlite, Snapshot
+from experiment_server.type import Question
+from experiment_server.user_db import UserDatabase, connect_user_db
 from experiment_server.user_file import UserFile
 
-MAX_QUESTIONS: Final[int] = 20
-
-
-def use_local() -> bool:
-    return os.environ.get("EXPERIMENT_DIR") is not None
+PROFILE_BUFFER_SIZE: Final[int] = int(os.environ.get("PROFILE_BUFFER_SIZE", 32))
 
 
 dictConfig(
@@ -59,91 +85,96 @@ dictConfig(
 
 app = Flask(__name__, static_url_path="/assets")
 app.secret_key = os.environ["SECRET_KEY"]
-app.json_encoder = Encoder  # type: ignore
+app.json = JSONProvider(app)
+
+
+_database: Optional[RemoteSqlite] = None
+_database_lock = threading.Lock()
+profiles = ProfileBuffer(maxlen=PROFILE_BUFFER_SIZE)
 
 
 def get_db() -> RemoteSqlite:
-    db = getattr(g, "_database", None)
-    if db is None:
-        if (db_path := os.environ.get("DATABASE_PATH")) is not None:
-            app.logger.info(f"Using local database at {db_path}")
-            db = RemoteSqlite(
-                remote_fs=fs.open_fs(fs.path.dirname(db_path)),
-                filename=fs.path.basename(db_path),
-                always_download=True,
+    """Returns the process-wide question database, checking for a newer remote copy once per request."""
+    global _database
+    with _database_lock:
+        if _database is None:
+            app.logger.info(f"Using database {get_db_filename()} on {get_db_fs()}")
+            _database = RemoteSqlite(
+                remote_fs=get_db_fs(),
+                filename=get_db_filename(),
+                max_age=DATABASE_MAX_AGE,
             )
-        else:
-            app.logger.info("Using s3 database")
-            db = RemoteSqlite(
-                remote_fs=fs.open_fs("s3://multimodal-reward-learning/"),
-                filename="experiments.db",
-                always_download=True,
-            )
-        g._database = db
+            g._database_checked = True
+        db = _database
+    if not getattr(g, "_database_checked", False):
+        if db.refresh():
+            app.logger.info(f"Reloaded database, snapshot={db.snapshot}")
+        g._database_checked = True
     return db
 
 
-def get_user_file() -> Optional[UserFile]:
+def get_snapshot() -> Snapshot:
+    """The snapshot of the question database this request reads, taken on first use.
+
+    The connection, question pool and question cache a request uses all come from it, so a refresh
+    in the middle of the request can't mix two versions of the database.
+    """
+    snapshot = getattr(g, "_snapshot", None)
+    if snapshot is None:
+        snapshot = get_db().view()
+        g._snapshot = snapshot
+    return snapshot
+
+
+def get_user_db() -> sqlite3.Connection:
+    conn = getattr(g, "_user_db", None)
+    if conn is None:
+        create_user_db()
+        conn = connect_user_db(os.environ["USER_DATABASE_PATH"])
+        g._user_db = conn
+    return conn
+
+
+def get_user_file() -> Optional[Union[UserFile, UserDatabase]]:
     user_file = getattr(g, "_user_file", None)
-    if (
-        user_file is None
-        and "user_id" in session.keys()
-        and "payment_code" in session.keys()
-    ):
-        user_file = UserFile(
-            filesystem=get_user_fs(),
-            user_id=session["user_id"],
-            payment_code=session["payment_code"],
-        )
+    if user_file is None and has_participant(session):
+        user_file = open_user_store(session, get_user_db() if use_user_db() else None)
         g._user_file = user_file
     return user_file
 
 
-def redirect_missing_session(
-    current_page: Literal["welcome", "instructions", "interact", "replay", "goodbye"]
-) -> Optional[Response]:
-    if (
-        "user_id" not in session.keys()
-        or "consent" not in session.keys()
-        or not session["consent"]
-    ) and current_page != "welcome":
+def get_answered_questions(user_file: Union[UserFile, UserDatabase]) -> List[int]:
+    """Returns the ids of the questions the participant has answered, see `session_progress`."""
+    answered = session_progress(session)
+    if answered is None:
+        app.logger.info("Session has no valid progress, reading it from storage")
+        answered = user_file.get().get_used_questions()
+        record_progress(session, answered)
+    return answered
+
+
+def redirect_missing_session(current_page: Page) -> Optional[Response]:
+    if missing_consent(session, current_page):
         return redirect(url_for("welcome"))
     elif (user_file := get_user_file()) is not None:
-        n_questions = len(user_file.get().get_used_questions())
+        n_questions = len(get_answered_questions(user_file))
         app.logger.info(f"current page: {current_page}, n_questions: {n_questions}")
-        if n_questions > 0 and n_questions < MAX_QUESTIONS and current_page != "replay":
-            return redirect(url_for("replay"))
-        elif n_questions >= MAX_QUESTIONS and current_page != "goodbye":
-            return redirect(url_for("goodbye"))
+        if (page := progress_redirect(current_page, n_questions)) is not None:
+            return redirect(url_for(page))
     return None
 
 
-def get_user_fs() -> fs.base.FS:
-    return (
-        fs.open_fs("s3://multimodal-reward-learning/users/")
-        if not use_local()
-        else fs.open_fs(f"osfs://{os.environ['EXPERIMENT_DIR']}")
-    )
-
-
-def create_user() -> int:
-    files = get_user_fs().listdir("/")
-    max_user_id = -1
-    for f in files:
-        if match := re.match(r"user_([0-9]+).json", f):
-            max_user_id = max(max_user_id, int(match.group(1)))
-
-    return max_user_id + 1
-
-
-def parse_answer(json) -> Answer:
-    return Answer(
-        question_id=json["id"],
-        answer=json["answer"] == "right",
-        start_time=arrow.get(json["startTime"]).isoformat(),
-        end_time=arrow.get(json["stopTime"]).isoformat(),
-        max_steps=tuple(json["maxSteps"]),  # type: ignore
+def questions_response(questions: List[Question], many: bool = True) -> Response:
+    status, body, headers = encode_question_response(
+        question_cache,
+        questions,
+        many,
+        request.method,
+        request.accept_mimetypes,
+        request.accept_encodings,
+        request.if_none_match,
     )
+    return Response(body, status=status, headers=headers)
 
 
 # Pages
@@ -156,8 +187,11 @@ def welcome():
     if (resp := redirect_missing_session("welcome")) is not None:
         return resp
     if "user_id" not in session.keys():
-        session["user_id"] = create_user()
-        session["payment_code"] = token_hex(16)
+        start_participant(session, get_id_allocator().allocate())
+        # Write the new user's file now, page loads no longer read (and so create) it.
+        user_file = get_user_file()
+        assert user_file is not None
+        user_file.create()
     return render_template("welcome.html")
 
 
@@ -207,11 +241,7 @@ def submit_interact_times():
     if user_file is None:
         return jsonify({"error": "User not found"}), 404
     user = user_file.get()
-
-    user.interact_times = (
-        arrow.get(json["startTime"]).isoformat(),  # type: ignore
-        arrow.get(json["stopTime"]).isoformat(),  # type: ignore
-    )
+    user.interact_times = parse_interact_times(json)
     user_file.write(user)
 
     return jsonify({"success": True})
@@ -225,13 +255,33 @@ def submit_answer():
     user_file = get_user_file()
     if user_file is None:
         return jsonify({"error": "User not found"}), 404
-    user = user_file.get()
-    user.responses.append(parse_answer(json))
-    user_file.write(user)
+    answers = [parse_answer(json)]
+    answered = get_answered_questions(user_file)
+    user_file.add_answers(answers)
+    record_progress(session, answered, answers)
 
     return jsonify({"success": True})
 
 
+@app.route("/submit_answers", methods=["POST"])
+def submit_answers():
+    json = request.get_json()
+    user_file = get_user_file()
+    if user_file is None:
+        return jsonify({"error": "User not found"}), 404
+    answered = get_answered_questions(user_file)
+    try:
+        batch = answer_batch(json, session, answered)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid answers: {e}"}), 400
+
+    if not batch.duplicate:
+        if len(batch.answers) > 0:
+            user_file.add_answers(batch.answers, key=batch.key)
+        record_answer_batch(session, answered, batch)
+    return jsonify(batch.response())
+
+
 @app.route("/random_questions", methods=["POST"])
 def request_random_questions():
     if request.method != "POST":
@@ -241,39 +291,25 @@ def request_random_questions():
 
     spec = request.get_json()
     assert spec is not None
-
-    env = spec["env"]
-    lengths = spec["lengths"]
-    modality = spec["type"]
-    exclude_ids = user_file.get().get_used_questions()
-
-    if len(lengths) > 0:
-        length = lengths[0]
-    else:
-        length = None
-
-    questions = get_random_questions(
-        conn=get_db().con,
-        n_questions=MAX_QUESTIONS - len(exclude_ids),
-        question_type=modality,
-        env=env,
-        length=length,
-        exclude_ids=exclude_ids,
+    questions = random_questions(
+        get_snapshot(), spec, get_answered_questions(user_file)
     )
-
-    return jsonify(questions)
+    return questions_response(questions)
 
 
-@app.route("/named_question", methods=["POST"])
+@app.route("/named_question", methods=["GET", "POST"])
 def request_named_question():
-    if request.method != "POST":
-        return jsonify({"error": "Method not allowed"}), 405
-
-    spec = request.get_json()
-    assert spec is not None
+    # GET is conditional, so a client that already has the question gets a 304. POST is for older
+    # clients.
+    if request.method == "GET":
+        name = request.args.get("name")
+    else:
+        name = request.get_json()["name"]
+    if name is None:
+        return jsonify({"error": "Missing name"}), 400
 
-    question = get_named_question(conn=get_db().con, name=spec["name"])
-    return jsonify(question)
+    question = named_question(get_snapshot(), name)
+    return questions_response([question], many=False)
 
 
 @app.route("/submit_question", methods=["POST"])
@@ -282,19 +318,10 @@ def submit_question():
         return jsonify({"error": "Method not allowed"}), 405
     json = request.get_json()
     assert json is not None
-    traj_ids: Tuple[int, int] = json["traj_ids"]
-    label = json["name"]
-
-    db = get_db()
-    db.pull()
-    id = insert_question(
-        conn=db.con,
-        traj_ids=traj_ids,
-        algo="manual",
-        env_name="miner",
-        label=label,
-    )
-    db.push()
+    try:
+        id = journal_question(json, get_db(), get_journal())
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"Invalid question: {e}"}), 400
     return jsonify({"success": True, "question_id": id})
 
 
@@ -305,24 +332,46 @@ def submit_trajectory():
     json = request.get_json()
     assert json is not None
 
-    json_state = json["start_state"]
-
-    db = get_db()
-    db.pull()
-    id = insert_traj(
-        db.con,
-        Trajectory(
-            start_state=State.from_json(json_state),
-            actions=np.array(json["actions"]),
-            env_name="miner",
-            modality="traj",
-        ),
-    )
-    db.push()
-
+    id = journal_trajectory(json, get_journal())
     return jsonify({"success": True, "trajectory_id": id})
 
 
+@app.route("/stats")
+def stats():
+    if not admin_authorized(request.headers, request.args):
+        return jsonify({"error": "Not authorized"}), 403
+    if (summary := cached_stats(get_db())) is None:
+        return jsonify({"error": "Stats are being computed, try again shortly"}), 503
+    return jsonify(summary)
+
+
+@app.route("/metrics")
+def metrics():
+    # Scrapers on the same machine don't need a token, which would have to be renewed as it expires.
+    if not (
+        is_loopback(request.remote_addr)
+        or admin_authorized(request.headers, request.args)
+    ):
+        return jsonify({"error": "Not authorized"}), 403
+    return Response(metrics_text(), mimetype=METRICS_MIMETYPE)
+
+
+@app.route("/admin/profiles")
+def list_profiles():
+    if not admin_authorized(request.headers, request.args):
+        return jsonify({"error": "Not authorized"}), 403
+    return jsonify([profile.summary() for profile in profiles.recent()])
+
+
+@app.route("/admin/profiles/<int:id>")
+def get_profile(id: int):
+    if not admin_authorized(request.headers, request.args):
+        return jsonify({"error": "Not authorized"}), 403
+    if (profile := profiles.get(id)) is None:
+        return jsonify({"error": "Profile not found"}), 404
+    return jsonify({**profile.summary(), "report": profile.report})
+
+
 @app.route("/log", methods=["POST"])
 def log():
     if request.method != "POST":
@@ -333,8 +382,73 @@ def log():
     return jsonify({"success": True})
 
 
+def request_route() -> str:
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+def begin_request_metrics() -> None:
+    g._metrics_token = request_metrics.begin(request_route())
+
+
+@app.before_request
+def start_profile() -> None:
+    # Every scrape of /metrics would otherwise push a real request's profile out of the buffer.
+    if (
+        PROFILE_SECRET is not None
+        and not request.path.startswith("/admin/")
+        and request.path != "/metrics"
+    ):
+        if admin_authorized(request.headers, request.args):
+            g._profile = ActiveProfile(
+                profiles, request.method, request.path, request_route()
+            )
+
+
+@app.after_request
+def finish_profile(response: Response) -> Response:
+    # Registered before the other after_request hooks, so it runs after them and includes the
+    # user file flush.
+    if (active := getattr(g, "_profile", None)) is not None:
+        profile = active.finish(response.status_code)
+        g._profile = None
+        response.headers["X-Profile-Id"] = str(profile.id)
+        response.headers["Server-Timing"] = server_timing(profile.seconds)
+    return response
+
+
+@app.teardown_request
+def stop_profile(exception) -> None:
+    # If the request failed before finish_profile ran, don't leave the thread being profiled.
+    if (active := getattr(g, "_profile", None)) is not None:
+        active.profiler.disable()
+
+
+@app.after_request
+def record_status(response: Response) -> Response:
+    g._status = response.status_code
+    return response
+
+
+@app.teardown_request
+def end_request_metrics(exception) -> None:
+    # In teardown rather than after_request, so the writes flush_user_file makes are attributed to
+    # the route.
+    if (token := getattr(g, "_metrics_token", None)) is not None:
+        request_metrics.end(token, request.method, getattr(g, "_status", 500))
+
+
+@app.after_request
+def flush_user_file(response: Response) -> Response:
+    # Flushed before the response is sent rather than in teardown, so a failed write is reported
+    # to the participant instead of silently dropped.
+    if (user_file := getattr(g, "_user_file", None)) is not None:
+        user_file.flush()
+    return response
+
+
 @app.teardown_appcontext
-def close_connection(exception):
-    db = getattr(g, "_database", None)
-    if db is not None:
-        db.con.close()
+def close_user_db(exception):
+    conn = getattr(g, "_user_db", None)
+    if conn is not None:
+        conn.close()
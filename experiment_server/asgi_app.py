@@ -0,0 +1,394 @@
+"""The experiment server's routes on Quart, for running under an ASGI server.
+
+Serve with `hypercorn experiment_server.asgi_app:app`. Requires the async extra
+(`pip install experiment_server[async]`).
+
+This is the same site as app.py, configured by the same environment variables, and sessions are
+compatible between the two. Storage calls are awaited (see aio.py) instead of blocking the worker, so
+one process serves many participants waiting on s3 at once.
+"""
+
+import asyncio
+import os
+from logging.config import dictConfig
+from typing import List, Optional
+
+from quart import (
+    Quart,
+    Response,
+    g,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
+from quart.json.provider import DefaultJSONProvider
+
+from experiment_server.aio import (
+    AsyncRemoteSqlite,
+    AsyncUserFile,
+    run_blocking,
+)
+from experiment_server.common import (
+    DATABASE_MAX_AGE,
+    METRICS_MIMETYPE,
+    Page,
+    admin_authorized,
+    answer_batch,
+    cached_stats,
+    encode_question_response,
+    get_db_filename,
+    get_db_fs,
+    get_id_allocator,
+    get_journal,
+    has_participant,
+    is_loopback,
+    journal_question,
+    journal_trajectory,
+    metrics_text,
+    missing_consent,
+    named_question,
+    open_user_store,
+    parse_answer,
+    parse_interact_times,
+    progress_redirect,
+    question_cache,
+    random_questions,
+    record_answer_batch,
+    record_progress,
+    request_metrics,
+    session_progress,
+    start_participant,
+    use_user_db,
+)
+from experiment_server.encoder import to_jsonable
+from experiment_server.remote_sqlite import RemoteSqlite
+from experiment_server.type import Question
+from experiment_server.user_db import connect_user_db
+
+
+class JSONProvider(DefaultJSONProvider):
+    default = staticmethod(to_jsonable)
+
+
+dictConfig(
+    {
+        "version": 1,
+        "formatters": {
+            "default": {
+                "format": "[%(asctime)s] %(levelname)s in %(module)s: %(message)s",
+            }
+        },
+        "handlers": {
+            "default": {
+                "class": "logging.StreamHandler",
+                "stream": "ext://sys.stderr",
+                "formatter": "default",
+            },
+        },
+        "root": {"level": "INFO", "handlers": ["default"]},
+    }
+)
+
+app = Quart(__name__, static_url_path="/assets")
+app.secret_key = os.environ["SECRET_KEY"]
+app.json = JSONProvider(app)
+
+_database: Optional[AsyncRemoteSqlite] = None
+# Created on first use, so it belongs to the server's event loop.
+_database_lock: Optional[asyncio.Lock] = None
+
+
+async def get_db() -> AsyncRemoteSqlite:
+    """Returns the process-wide question database, checking for a newer remote copy once per request."""
+    global _database, _database_lock
+    if _database_lock is None:
+        _database_lock = asyncio.Lock()
+    async with _database_lock:
+        if _database is None:
+            app.logger.info(f"Using database {get_db_filename()} on {get_db_fs()}")
+            _database = AsyncRemoteSqlite(
+                await run_blocking(
+                    RemoteSqlite,
+                    remote_fs=get_db_fs(),
+                    filename=get_db_filename(),
+                    max_age=DATABASE_MAX_AGE,
+                )
+            )
+            g._database_checked = True
+        db = _database
+    if not getattr(g, "_database_checked", False):
+        if await db.refresh():
+            app.logger.info(f"Reloaded database, snapshot={db.snapshot}")
+        g._database_checked = True
+    return db
+
+
+async def get_user_file() -> Optional[AsyncUserFile]:
+    user_file = getattr(g, "_user_file", None)
+    if user_file is None and has_participant(session):
+        conn = None
+        if use_user_db():
+            conn = await run_blocking(
+                connect_user_db,
+                os.environ["USER_DATABASE_PATH"],
+                check_same_thread=False,
+            )
+            g._user_db = conn
+        user_file = AsyncUserFile(
+            await run_blocking(open_user_store, dict(session), conn)
+        )
+        g._user_file = user_file
+    return user_file
+
+
+async def get_answered_questions(user_file: AsyncUserFile) -> List[int]:
+    """Returns the ids of the questions the participant has answered, see `session_progress`."""
+    answered = session_progress(session)
+    if answered is None:
+        app.logger.info("Session has no valid progress, reading it from storage")
+        answered = (await user_file.get()).get_used_questions()
+        record_progress(session, answered)
+    return answered
+
+
+async def redirect_missing_session(current_page: Page) -> Optional[Response]:
+    if missing_consent(session, current_page):
+        return redirect(url_for("welcome"))
+    elif (user_file := await get_user_file()) is not None:
+        n_questions = len(await get_answered_questions(user_file))
+        app.logger.info(f"current page: {current_page}, n_questions: {n_questions}")
+        if (page := progress_redirect(current_page, n_questions)) is not None:
+            return redirect(url_for(page))
+    return None
+
+
+async def questions_response(questions: List[Question], many: bool = True) -> Response:
+    status, body, headers = encode_question_response(
+        question_cache,
+        questions,
+        many,
+        request.method,
+        request.accept_mimetypes,
+        request.accept_encodings,
+        request.if_none_match,
+    )
+    return Response(body, status=status, headers=headers)
+
+
+# Pages
+
+
+@app.route("/")
+async def welcome():
+    if "consent" not in session.keys():
+        session["consent"] = False
+    if (resp := await redirect_missing_session("welcome")) is not None:
+        return resp
+    if "user_id" not in session.keys():
+        start_participant(session, await run_blocking(get_id_allocator().allocate))
+        user_file = await get_user_file()
+        assert user_file is not None
+        user_file.create()
+    return await render_template("welcome.html")
+
+
+@app.route("/instructions")
+async def instructions():
+    session["consent"] = True
+    if (resp := await redirect_missing_session("instructions")) is not None:
+        return resp
+    return await render_template("instructions.html")
+
+
+@app.route("/replay")
+async def replay():
+    app.logger.info("Visited replay")
+    if (resp := await redirect_missing_session("replay")) is not None:
+        return resp
+    return await render_template("replay.html")
+
+
+@app.route("/goodbye")
+async def goodbye():
+    app.logger.info("Visited goodbye")
+    if (resp := await redirect_missing_session("goodbye")) is not None:
+        return resp
+    return await render_template("goodbye.html", payment_code=session["payment_code"])
+
+
+@app.route("/interact")
+async def interact():
+    if (resp := await redirect_missing_session("interact")) is not None:
+        return resp
+    return await render_template("interact.html")
+
+
+@app.route("/record")
+async def record():
+    return await render_template("record.html")
+
+
+# API
+@app.route("/interact_times", methods=["POST"])
+async def submit_interact_times():
+    json = await request.get_json()
+    user_file = await get_user_file()
+    if user_file is None:
+        return jsonify({"error": "User not found"}), 404
+    user = await user_file.get()
+    user.interact_times = parse_interact_times(json)
+    await user_file.write(user)
+
+    return jsonify({"success": True})
+
+
+@app.route("/submit_answer", methods=["POST"])
+async def submit_answer():
+    json = await request.get_json()
+    user_file = await get_user_file()
+    if user_file is None:
+        return jsonify({"error": "User not found"}), 404
+    answers = [parse_answer(json)]
+    answered = await get_answered_questions(user_file)
+    await user_file.add_answers(answers)
+    record_progress(session, answered, answers)
+
+    return jsonify({"success": True})
+
+
+@app.route("/submit_answers", methods=["POST"])
+async def submit_answers():
+    json = await request.get_json()
+    user_file = await get_user_file()
+    if user_file is None:
+        return jsonify({"error": "User not found"}), 404
+    answered = await get_answered_questions(user_file)
+    try:
+        batch = answer_batch(json, session, answered)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": f"Invalid answers: {e}"}), 400
+
+    if not batch.duplicate:
+        if len(batch.answers) > 0:
+            await user_file.add_answers(batch.answers, key=batch.key)
+        record_answer_batch(session, answered, batch)
+    return jsonify(batch.response())
+
+
+@app.route("/random_questions", methods=["POST"])
+async def request_random_questions():
+    if (user_file := await get_user_file()) is None:
+        return jsonify({"error": "User not found"}), 404
+
+    spec = await request.get_json()
+    assert spec is not None
+    answered = await get_answered_questions(user_file)
+    db = await get_db()
+    # Sample, query and cache in one call, so they all see the same snapshot.
+    questions = await db.read(random_questions, spec, answered)
+    return await questions_response(questions)
+
+
+@app.route("/named_question", methods=["GET", "POST"])
+async def request_named_question():
+    # GET is conditional, so a client that already has the question gets a 304. POST is for older
+    # clients.
+    if request.method == "GET":
+        name = request.args.get("name")
+    else:
+        name = (await request.get_json())["name"]
+    if name is None:
+        return jsonify({"error": "Missing name"}), 400
+
+    db = await get_db()
+    question = await db.read(named_question, name)
+    return await questions_response([question], many=False)
+
+
+@app.route("/submit_question", methods=["POST"])
+async def submit_question():
+    json = await request.get_json()
+    assert json is not None
+    db = await get_db()
+    try:
+        id = await run_blocking(journal_question, json, db.db, get_journal())
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": f"Invalid question: {e}"}), 400
+    return jsonify({"success": True, "question_id": id})
+
+
+@app.route("/submit_trajectory", methods=["POST"])
+async def submit_trajectory():
+    json = await request.get_json()
+    assert json is not None
+
+    id = await run_blocking(journal_trajectory, json, get_journal())
+    return jsonify({"success": True, "trajectory_id": id})
+
+
+@app.route("/stats")
+async def stats():
+    if not admin_authorized(request.headers, request.args):
+        return jsonify({"error": "Not authorized"}), 403
+    db = await get_db()
+    if (summary := cached_stats(db.db)) is None:
+        return jsonify({"error": "Stats are being computed, try again shortly"}), 503
+    return jsonify(summary)
+
+
+@app.route("/metrics")
+async def metrics():
+    # Scrapers on the same machine don't need a token, which would have to be renewed as it expires.
+    if not (
+        is_loopback(request.remote_addr)
+        or admin_authorized(request.headers, request.args)
+    ):
+        return jsonify({"error": "Not authorized"}), 403
+    return Response(metrics_text(), mimetype=METRICS_MIMETYPE)
+
+
+@app.route("/log", methods=["POST"])
+async def log():
+    json = await request.get_json()
+    assert json is not None
+    app.logger.info(json)
+    return jsonify({"success": True})
+
+
+def request_route() -> str:
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@app.before_request
+async def begin_request_metrics() -> None:
+    g._metrics_token = request_metrics.begin(request_route())
+
+
+@app.after_request
+async def record_status(response: Response) -> Response:
+    g._status = response.status_code
+    return response
+
+
+@app.teardown_request
+async def end_request_metrics(exception) -> None:
+    if (token := getattr(g, "_metrics_token", None)) is not None:
+        request_metrics.end(token, request.method, getattr(g, "_status", 500))
+
+
+@app.after_request
+async def flush_user_file(response: Response) -> Response:
+    # Flushed before the response is sent rather than in teardown, so a failed write is reported
+    # to the participant instead of silently dropped.
+    if (user_file := getattr(g, "_user_file", None)) is not None:
+        await user_file.flush()
+    return response
+
+
+@app.teardown_appcontext
+async def close_user_db(exception) -> None:
+    if (conn := getattr(g, "_user_db", None)) is not None:
+        conn.close()
@@ -1,52 +1,150 @@
+import threading
+import time
+from collections import defaultdict
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
 import boto3
-from moto import mock_s3  # type: ignore
+import boto3.session
+
+from experiment_server.metrics import (
+    LATENCY_BUCKETS,
+    SIZE_BUCKETS,
+    Histogram,
+    Labels,
+    format_counter,
+    format_histogram,
+)
 
 
 @dataclass
 class AwsRequestPrices:
+    """Prices of one request, in cents."""
+
     cheap_price_cents: float
     expensive_price_cents: float
 
 
+# s3 standard storage in us-east-1: $0.005 per 1000 PUT, COPY, POST and LIST requests, and $0.0004
+# per 1000 GET and other requests.
+S3_STANDARD_PRICES = AwsRequestPrices(
+    cheap_price_cents=0.00004, expensive_price_cents=0.0005
+)
+
+EXPENSIVE_OPERATIONS = frozenset(
+    [
+        "PutObject",
+        "CopyObject",
+        # This might not exist
+        "PostObject",
+        "ListObjects",
+        "ListObjectsV2",
+        "CreateMultipartUpload",
+        "UploadPart",
+        "CompleteMultipartUpload",
+    ]
+)
+CHEAP_OPERATIONS = frozenset(["GetObject", "HeadObject", "SelectObjectContent"])
+
+
 class Boto3Counter:
-    def __init__(self, client, prices: Optional[AwsRequestPrices] = None):
+    """Counts s3 requests and what they cost, and records their latency and size.
+
+    Requests are broken down by operation and by the label returned by `label`, which the app sets
+    to the route of the request that made them (see metrics.py).
+    """
+
+    def __init__(
+        self,
+        client=None,
+        prices: Optional[AwsRequestPrices] = None,
+        label: Callable[[], str] = lambda: "",
+    ):
         self.s3 = client
         self.expensive_requests = 0
         self.cheap_requests = 0
         self.prices = prices
-
-        self.s3.meta.events.register(
-            "provide-client-params.s3.PutObject", self._count_expensive
+        self.label = label
+
+        self.requests: Dict[Labels, int] = defaultdict(int)
+        self.cost_cents: Dict[Labels, float] = defaultdict(float)
+        self.latency: Dict[Labels, Histogram] = {}
+        self.sizes: Dict[Labels, Histogram] = {}
+        self._lock = threading.Lock()
+
+        if client is not None:
+            self.watch(client)
+
+    def watch(self, client) -> None:
+        """Count requests made through another client, e.g. one for a different s3 filesystem."""
+        self._register(client.meta.events)
+
+    def watch_session(self, session: boto3.session.Session) -> None:
+        """Count requests made through every client created from session from now on.
+
+        fs-s3fs creates a client per thread, so watching the session they come from (see
+        `common.get_s3_session`) is the only way to see all of its requests.
+        """
+        self._register(session.events)
+
+    def _register(self, events) -> None:
+        # Clients copy their session's handlers, so unique ids stop a client of a watched session
+        # from counting every request twice if it's also watched directly.
+        events.register(
+            "before-call.s3", self._before_call, unique_id=f"{id(self)}-before"
         )
-        self.s3.meta.events.register(
-            "provide-client-params.s3.CopyObject", self._count_expensive
-        )
-        # This might not exist
-        self.s3.meta.events.register(
-            "provide-client-params.s3.PostObject", self._count_expensive
-        )
-        self.s3.meta.events.register(
-            "provide-client-params.s3.ListObjects", self._count_expensive
-        )
-        self.s3.meta.events.register(
-            "provide-client-params.s3.ListObjectsV2", self._count_expensive
+        events.register(
+            "after-call.s3", self._after_call, unique_id=f"{id(self)}-after"
         )
 
-        self.s3.meta.events.register(
-            "provide-client-params.s3.GetObject", self._count_cheap
+    def _before_call(self, params=None, context=None, **kwargs):
+        if context is None:
+            return
+        body = params.get("body") if params is not None else None
+        context["boto3_counter"] = (
+            self.label(),
+            time.perf_counter(),
+            len(body) if hasattr(body, "__len__") else 0,
         )
-        self.s3.meta.events.register(
-            "provide-client-params.s3.SelectObjectContent", self._count_cheap
-        )
-
-    def _count_expensive(self, **kwargs):
-        self.expensive_requests += 1
 
-    def _count_cheap(self, **kwargs):
-        self.cheap_requests += 1
+    def _after_call(
+        self, http_response=None, parsed=None, model=None, context=None, **kwargs
+    ):
+        if context is None or "boto3_counter" not in context or model is None:
+            return
+        label, start, sent = context["boto3_counter"]
+        elapsed = time.perf_counter() - start
+        operation = model.name
+        if model.has_streaming_output:
+            # Reading the body here would consume it, so trust the header.
+            received = (parsed or {}).get("ContentLength", 0) or 0
+        else:
+            received = len(http_response.content) if http_response is not None else 0
+        self.record(label, operation, elapsed, sent, received)
+
+    def record(
+        self, label: str, operation: str, elapsed: float, sent: int, received: int
+    ) -> None:
+        labels: Labels = (("route", label), ("operation", operation))
+        with self._lock:
+            if operation in EXPENSIVE_OPERATIONS:
+                self.expensive_requests += 1
+                price = self.prices.expensive_price_cents if self.prices else 0.0
+            elif operation in CHEAP_OPERATIONS:
+                self.cheap_requests += 1
+                price = self.prices.cheap_price_cents if self.prices else 0.0
+            else:
+                price = 0.0
+            self.requests[labels] += 1
+            self.cost_cents[labels] += price
+            if (latency := self.latency.get(labels)) is None:
+                latency = self.latency[labels] = Histogram(LATENCY_BUCKETS)
+            latency.observe(elapsed)
+            for direction, size in (("sent", sent), ("received", received)):
+                size_labels = labels + (("direction", direction),)
+                if (histogram := self.sizes.get(size_labels)) is None:
+                    histogram = self.sizes[size_labels] = Histogram(SIZE_BUCKETS)
+                histogram.observe(size)
 
     def get_counts(self) -> Tuple[int, int]:
         return self.cheap_requests, self.expensive_requests
@@ -60,17 +158,47 @@ class Boto3Counter:
             + self.prices.expensive_price_cents * self.expensive_requests
         )
 
+    def prometheus(self) -> List[str]:
+        with self._lock:
+            lines = format_counter(
+                "s3_requests_total",
+                "s3 requests, by the route that made them and operation.",
+                dict(self.requests),
+            )
+            if self.prices is not None:
+                lines += format_counter(
+                    "s3_request_cost_cents_total",
+                    "Request charges for s3 requests, in cents, by route and operation.",
+                    dict(self.cost_cents),
+                )
+            return (
+                lines
+                + format_histogram(
+                    "s3_request_seconds",
+                    "Latency of s3 requests, by route and operation.",
+                    self.latency,
+                )
+                + format_histogram(
+                    "s3_request_bytes",
+                    "Bytes sent and received by s3 requests, by route, operation and direction.",
+                    self.sizes,
+                )
+            )
+
 
-@mock_s3
 def main():
-    client = boto3.client("s3", region_name="us-east-1")
-    counter = Boto3Counter(client)
-    client.create_bucket(Bucket="mybucket")
-    client.list_objects_v2(Bucket="mybucket")
-    client.put_object(Bucket="mybucket", Key="blah.txt", Body="Hello world!")
-    resp = client.get_object(Bucket="mybucket", Key="blah.txt")
-    print(resp["Body"].read())
-    print(counter.get_counts())
+    from moto import mock_s3  # type: ignore
+
+    with mock_s3():
+        client = boto3.client("s3", region_name="us-east-1")
+        counter = Boto3Counter(client, prices=S3_STANDARD_PRICES)
+        client.create_bucket(Bucket="mybucket")
+        client.list_objects_v2(Bucket="mybucket")
+        client.put_object(Bucket="mybucket", Key="blah.txt", Body="Hello world!")
+        resp = client.get_object(Bucket="mybucket", Key="blah.txt")
+        print(resp["Body"].read())
+        print(counter.get_counts())
+        print("\n".join(counter.prometheus()))
 
 
 if __name__ == "__main__":
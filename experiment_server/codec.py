@@ -0,0 +1,170 @@
+"""Compact binary encoding for the blobs stored in the trajectories table.
+
+Every blob starts with a 4 byte header: the magic bytes b"ES", a format version, and a kind byte
+saying what follows. Arrays are stored as their dtype, shape, and raw buffer, padded so the buffer is
+8 byte aligned, which lets decoding wrap the blob with np.frombuffer instead of copying it. Decoded
+arrays are therefore read-only views of the blob.
+
+Blobs written before this format existed are pickles, which never start with the magic bytes, so
+decoding falls back to pickle for them until the database is migrated with
+`python -m experiment_server.manage migrate-blobs`.
+"""
+
+import pickle
+import struct
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from experiment_server.type import State
+
+MAGIC = b"ES"
+VERSION = 1
+
+KIND_NONE = ord("n")
+KIND_STATE = ord("s")
+KIND_ARRAY = ord("a")
+KIND_BYTES_LIST = ord("b")
+
+_HEADER = struct.Struct("<2sBB")
+_STATE = struct.Struct("<6i")
+_COUNT = struct.Struct("<I")
+_ALIGNMENT = 8
+
+
+def is_encoded(blob: bytes) -> bool:
+    return blob[: len(MAGIC)] == MAGIC
+
+
+def _header(kind: int) -> bytes:
+    return _HEADER.pack(MAGIC, VERSION, kind)
+
+
+def _read_header(blob: bytes) -> int:
+    magic, version, kind = _HEADER.unpack_from(blob)
+    if magic != MAGIC:
+        raise ValueError("Blob is not in the experiment_server binary format")
+    if version > VERSION:
+        raise ValueError(
+            f"Blob has format version {version}, newest supported is {VERSION}"
+        )
+    return kind
+
+
+def _encode_array(arr: np.ndarray, offset: int) -> bytes:
+    """Encodes arr to be written at the given offset into a blob, so its buffer can be aligned."""
+    # ascontiguousarray returns a 0-d array as 1-d, so the shape comes from arr. A 0-d array is
+    # stored with ndim 0, no dimensions, and one element.
+    shape = arr.shape
+    data = np.ascontiguousarray(arr).tobytes()
+    dtype = arr.dtype.str.encode("ascii")
+    meta = struct.pack(
+        f"<B{len(dtype)}sB{len(shape)}I", len(dtype), dtype, len(shape), *shape
+    )
+    padding = -(offset + len(meta)) % _ALIGNMENT
+    return meta + b"\0" * padding + data
+
+
+def _decode_array(blob: bytes, offset: int) -> np.ndarray:
+    (dtype_len,) = struct.unpack_from("<B", blob, offset)
+    offset += 1
+    dtype = np.dtype(blob[offset : offset + dtype_len].decode("ascii"))
+    offset += dtype_len
+    (ndim,) = struct.unpack_from("<B", blob, offset)
+    offset += 1
+    shape = struct.unpack_from(f"<{ndim}I", blob, offset)
+    offset += 4 * ndim
+    offset += -offset % _ALIGNMENT
+    count = 1 if ndim == 0 else int(np.prod(shape))
+    return np.frombuffer(blob, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+def encode_state(state: State) -> bytes:
+    head = _header(KIND_STATE) + _STATE.pack(
+        *(int(x) for x in (*state.grid_shape, *state.agent_pos, *state.exit_pos))
+    )
+    return head + _encode_array(state.grid, len(head))
+
+
+def decode_state(blob: bytes) -> State:
+    if not is_encoded(blob):
+        return pickle.loads(blob)
+    kind = _read_header(blob)
+    if kind != KIND_STATE:
+        raise ValueError(f"Expected a state blob, got kind {chr(kind)}")
+    values = _STATE.unpack_from(blob, _HEADER.size)
+    grid = _decode_array(blob, _HEADER.size + _STATE.size)
+    return State(
+        grid=grid,
+        grid_shape=(values[0], values[1]),
+        agent_pos=(values[2], values[3]),
+        exit_pos=(values[4], values[5]),
+    )
+
+
+def encode_array(arr: np.ndarray) -> bytes:
+    head = _header(KIND_ARRAY)
+    return head + _encode_array(arr, len(head))
+
+
+def decode_array(blob: bytes) -> np.ndarray:
+    kind = _read_header(blob)
+    if kind != KIND_ARRAY:
+        raise ValueError(f"Expected an array blob, got kind {chr(kind)}")
+    return _decode_array(blob, _HEADER.size)
+
+
+def encode_actions(actions: Optional[np.ndarray]) -> bytes:
+    if actions is None:
+        return _header(KIND_NONE)
+    return encode_array(actions)
+
+
+def decode_actions(blob: bytes) -> Optional[np.ndarray]:
+    if not is_encoded(blob):
+        return pickle.loads(blob)
+    if _read_header(blob) == KIND_NONE:
+        return None
+    return decode_array(blob)
+
+
+def encode_cstates(cstates: Optional[List[bytes]]) -> bytes:
+    if cstates is None:
+        return _header(KIND_NONE)
+    parts = [_header(KIND_BYTES_LIST), _COUNT.pack(len(cstates))]
+    for cstate in cstates:
+        parts.append(_COUNT.pack(len(cstate)))
+        parts.append(cstate)
+    return b"".join(parts)
+
+
+def decode_cstates(blob: Optional[bytes]) -> Optional[List[bytes]]:
+    if blob is None:
+        return None
+    if not is_encoded(blob):
+        return pickle.loads(blob)
+    kind = _read_header(blob)
+    if kind == KIND_NONE:
+        return None
+    if kind != KIND_BYTES_LIST:
+        raise ValueError(f"Expected a bytes list blob, got kind {chr(kind)}")
+    (count,) = _COUNT.unpack_from(blob, _HEADER.size)
+    offset = _HEADER.size + _COUNT.size
+    cstates = []
+    for _ in range(count):
+        (length,) = _COUNT.unpack_from(blob, offset)
+        offset += _COUNT.size
+        cstates.append(bytes(blob[offset : offset + length]))
+        offset += length
+    return cstates
+
+
+def reencode(
+    start_state: bytes, actions: bytes, cstates: Optional[bytes]
+) -> Tuple[bytes, bytes, bytes]:
+    """Rewrites the blobs of one trajectory row in the current format."""
+    return (
+        encode_state(decode_state(start_state)),
+        encode_actions(decode_actions(actions)),
+        encode_cstates(decode_cstates(cstates)),
+    )
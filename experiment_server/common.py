@@ -0,0 +1,567 @@
+"""The parts of the server shared by the Flask app (app.py) and the Quart app (asgi_app.py).
+
+Nothing here depends on a web framework, and importing this module has no side effects beyond
+reading the configuration from the environment: the apps themselves set up logging, and s3 requests
+are counted from the session the s3 filesystems are opened with.
+"""
+
+import gzip
+import hashlib
+import ipaddress
+import logging
+import os
+import re
+import sqlite3
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from secrets import token_hex
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Final,
+    List,
+    Literal,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+import arrow
+import boto3.session
+import fs
+import fs.base
+import fs.path
+from fs_s3fs import S3FS
+from werkzeug.datastructures import Accept, ETags, MIMEAccept
+
+from experiment_server.analytics import (
+    StatsCache,
+    answers_from_user_db,
+    question_metadata,
+    summarize,
+)
+from experiment_server.boto3_counter import S3_STANDARD_PRICES, Boto3Counter
+from experiment_server.encoder import (
+    COMPACT_MIMETYPE,
+    encode_compact_json,
+    encode_json,
+)
+from experiment_server.export import export_answers, load_answers
+from experiment_server.journal import (
+    REF_PREFIX,
+    WriteJournal,
+    applied_ref,
+    ref_key,
+)
+from experiment_server.metrics import RequestMetrics, render, route_label
+from experiment_server.profiling import PROFILE_HEADER, PROFILE_PARAM, verify
+from experiment_server.query import (
+    QuestionPool,
+    get_named_question,
+    get_random_questions,
+)
+from experiment_server.question_cache import QuestionCache
+from experiment_server.remote_sqlite import RemoteSqlite, Snapshot
+from experiment_server.type import Answer, Question, State
+from experiment_server.user_db import UserDatabase, connect_user_db
+from experiment_server.user_file import UserFile
+from experiment_server.user_ids import IdAllocator, RandomIdAllocator, SqliteIdAllocator
+from experiment_server.write_behind import WriteBehindFS
+
+MAX_QUESTIONS: Final[int] = 20
+S3_BUCKET: Final[str] = "multimodal-reward-learning"
+# How long the cached question database is trusted before checking s3 for a newer version.
+DATABASE_MAX_AGE: Final[float] = float(os.environ.get("DATABASE_MAX_AGE", 30.0))
+QUESTION_CACHE_SIZE: Final[int] = int(os.environ.get("QUESTION_CACHE_SIZE", 4096))
+# Don't serve questions where both trajectories contain fire.
+EXCLUDE_DOUBLE_FIRE: Final[bool] = os.environ.get("EXCLUDE_DOUBLE_FIRE", "0") == "1"
+# Response formats for questions, by media type: (cache key, serializer).
+QUESTION_FORMATS: Final[Dict[str, Tuple[str, Callable[[Any], bytes]]]] = {
+    "application/json": ("json", encode_json),
+    COMPACT_MIMETYPE: ("compact", encode_compact_json),
+}
+# Question responses smaller than this aren't worth gzipping.
+GZIP_MIN_SIZE: Final[int] = 1024
+# How many recent /submit_answers idempotency keys the session remembers.
+ANSWER_BATCH_KEYS: Final[int] = 8
+# Longest a spooled participant write waits before being uploaded, if WRITE_BEHIND_SPOOL is set.
+WRITE_BEHIND_INTERVAL: Final[float] = float(
+    os.environ.get("WRITE_BEHIND_INTERVAL", 1.0)
+)
+# Signs the tokens that open the admin endpoints (see profiling.py). They are all closed if unset.
+PROFILE_SECRET: Final[Optional[str]] = os.environ.get("PROFILE_SECRET")
+# How long /stats serves the same summary before reading the answers again.
+STATS_MAX_AGE: Final[float] = float(os.environ.get("STATS_MAX_AGE", 60.0))
+# Where /stats keeps its incremental export of the user files, if there's no user database. The
+# export has the layout written by `manage.py export-answers`.
+STATS_EXPORT_DIR: Final[str] = os.environ.get(
+    "STATS_EXPORT_DIR", "/tmp/experiment-server-stats"
+)
+
+METRICS_MIMETYPE: Final[str] = "text/plain; version=0.0.4"
+
+Page = Literal["welcome", "instructions", "interact", "replay", "goodbye"]
+# The flask or quart session, a signed cookie holding the participant's id and progress.
+Session = MutableMapping[str, Any]
+
+question_cache = QuestionCache(maxsize=QUESTION_CACHE_SIZE)
+request_metrics = RequestMetrics()
+# Watches the session every s3 client is created from, see get_s3_session.
+s3_metrics = Boto3Counter(prices=S3_STANDARD_PRICES, label=route_label)
+stats_cache = StatsCache(max_age=STATS_MAX_AGE)
+
+
+def use_local() -> bool:
+    return os.environ.get("EXPERIMENT_DIR") is not None
+
+
+def use_user_db() -> bool:
+    return os.environ.get("USER_DATABASE_PATH") is not None
+
+
+class SessionS3FS(S3FS):
+    """An S3FS whose per-thread clients are created from session, instead of boto3's default one."""
+
+    def __init__(self, bucket_name: str, session: boto3.session.Session, **kwargs):
+        super().__init__(bucket_name, **kwargs)
+        self.session = session
+        # boto3 sessions aren't thread safe, and each thread creates its own client.
+        self._session_lock = threading.Lock()
+
+    @property
+    def s3(self):
+        if not hasattr(self._tlocal, "s3"):
+            with self._session_lock:
+                self._tlocal.s3 = self.session.resource("s3", **self._client_args())
+        return self._tlocal.s3
+
+    @property
+    def client(self):
+        if not hasattr(self._tlocal, "client"):
+            with self._session_lock:
+                self._tlocal.client = self.session.client("s3", **self._client_args())
+        return self._tlocal.client
+
+    def _client_args(self) -> Dict[str, Any]:
+        return {
+            "region_name": self.region,
+            "aws_access_key_id": self.aws_access_key_id,
+            "aws_secret_access_key": self.aws_secret_access_key,
+            "aws_session_token": self.aws_session_token,
+            "endpoint_url": self.endpoint_url,
+        }
+
+
+@lru_cache(maxsize=None)
+def get_s3_session() -> boto3.session.Session:
+    """The session every s3 client of the app is created from, so s3_metrics sees all its requests."""
+    session = boto3.session.Session()
+    s3_metrics.watch_session(session)
+    return session
+
+
+@lru_cache(maxsize=None)
+def get_s3_fs() -> fs.base.FS:
+    return SessionS3FS(S3_BUCKET, session=get_s3_session())
+
+
+@lru_cache(maxsize=None)
+def get_db_fs() -> fs.base.FS:
+    if (db_path := os.environ.get("DATABASE_PATH")) is not None:
+        return fs.open_fs(fs.path.dirname(db_path))
+    return get_s3_fs()
+
+
+def get_db_filename() -> str:
+    if (db_path := os.environ.get("DATABASE_PATH")) is not None:
+        return fs.path.basename(db_path)
+    return "experiments.db"
+
+
+@lru_cache(maxsize=None)
+def get_journal() -> WriteJournal:
+    return WriteJournal(get_db_fs())
+
+
+@lru_cache(maxsize=None)
+def create_user_db() -> None:
+    connect_user_db(os.environ["USER_DATABASE_PATH"], create=True).close()
+
+
+@lru_cache(maxsize=None)
+def get_user_fs() -> fs.base.FS:
+    user_fs = (
+        SessionS3FS(S3_BUCKET, session=get_s3_session(), dir_path="users")
+        if not use_local()
+        else fs.open_fs(f"osfs://{os.environ['EXPERIMENT_DIR']}")
+    )
+    if (spool_path := os.environ.get("WRITE_BEHIND_SPOOL")) is not None:
+        logging.info(f"Buffering participant writes in {spool_path}")
+        user_fs = WriteBehindFS(user_fs, spool_path, interval=WRITE_BEHIND_INTERVAL)
+        user_fs.start()
+    return user_fs
+
+
+def close_user_fs() -> None:
+    """Uploads any buffered participant writes. gunicorn.conf.py calls this as each worker exits."""
+    if get_user_fs.cache_info().currsize > 0 and isinstance(
+        user_fs := get_user_fs(), WriteBehindFS
+    ):
+        user_fs.close()
+
+
+@lru_cache(maxsize=None)
+def get_id_allocator() -> IdAllocator:
+    if use_user_db():
+        create_user_db()
+        return SqliteIdAllocator(os.environ["USER_DATABASE_PATH"])
+    return RandomIdAllocator(get_user_fs())
+
+
+def allocator_metrics() -> List[str]:
+    # Opening the allocator can touch storage, so it's only reported once a participant has used it.
+    if get_id_allocator.cache_info().currsize == 0:
+        return []
+    return get_id_allocator().prometheus()
+
+
+def token_authorized(token: Optional[str]) -> bool:
+    """Whether token was signed with PROFILE_SECRET and hasn't expired."""
+    return (
+        PROFILE_SECRET is not None
+        and token is not None
+        and verify(PROFILE_SECRET, token)
+    )
+
+
+def admin_authorized(headers: Mapping[str, str], args: Mapping[str, str]) -> bool:
+    """Whether a request carries a valid token, the same one that turns on profiling."""
+    return token_authorized(headers.get(PROFILE_HEADER) or args.get(PROFILE_PARAM))
+
+
+def is_loopback(remote_addr: Optional[str]) -> bool:
+    """Whether a request came from this machine, e.g. a metrics agent running next to the app."""
+    try:
+        return remote_addr is not None and ipaddress.ip_address(remote_addr).is_loopback
+    except ValueError:
+        return False
+
+
+def compute_stats(db: RemoteSqlite) -> Dict[str, Any]:
+    """Summarizes every answer. Slow without a user database, so stats_cache runs it off-request."""
+    if use_user_db():
+        conn = connect_user_db(os.environ["USER_DATABASE_PATH"])
+        try:
+            answers = answers_from_user_db(conn)
+        finally:
+            conn.close()
+    else:
+        export_answers(get_user_fs(), STATS_EXPORT_DIR)
+        answers, _ = load_answers(STATS_EXPORT_DIR)
+    questions = db.derived("question_metadata", question_metadata)
+    return summarize(answers, questions)
+
+
+def cached_stats(db: RemoteSqlite) -> Optional[Dict[str, Any]]:
+    """The latest summary for /stats, or None while the first one is computed."""
+    return stats_cache.get(lambda: compute_stats(db))
+
+
+def metrics_text() -> str:
+    """The /metrics page, in the Prometheus text format."""
+    return render(
+        [request_metrics.prometheus(), s3_metrics.prometheus(), allocator_metrics()]
+    )
+
+
+def sync_question_cache(snapshot: Snapshot) -> QuestionCache:
+    old_stats = question_cache.stats()
+    if question_cache.sync(snapshot.id):
+        logging.info(
+            f"Cleared question cache for snapshot {snapshot.id}, stats before clearing: {old_stats}"
+        )
+    return question_cache
+
+
+def random_questions(snapshot: Snapshot, spec, answered: List[int]) -> List[Question]:
+    """Samples the questions for a /random_questions request, reading only from snapshot."""
+    lengths = spec["lengths"]
+    return get_random_questions(
+        conn=snapshot.con,
+        n_questions=MAX_QUESTIONS - len(answered),
+        question_type=spec["type"],
+        env=spec["env"],
+        length=lengths[0] if len(lengths) > 0 else None,
+        exclude_ids=answered,
+        pool=snapshot.derived("question_pool", QuestionPool),
+        cache=sync_question_cache(snapshot),
+        exclude_double_fire=EXCLUDE_DOUBLE_FIRE,
+        snapshot=snapshot.id,
+    )
+
+
+def named_question(snapshot: Snapshot, name: str) -> Question:
+    return get_named_question(
+        conn=snapshot.con,
+        name=name,
+        cache=sync_question_cache(snapshot),
+        snapshot=snapshot.id,
+    )
+
+
+def encode_questions(
+    cache: QuestionCache,
+    questions: List[Question],
+    many: bool,
+    accept_mimetypes: MIMEAccept,
+    accept_encodings: Accept,
+) -> Tuple[bytes, Dict[str, str]]:
+    """Serializes questions in the format the client asked for, gzipped if it accepts gzip.
+
+    Returns the body and its Content-Type, ETag, Vary and (if gzipped) Content-Encoding headers.
+    """
+    mimetype = accept_mimetypes.best_match(list(QUESTION_FORMATS)) or "application/json"
+    fmt, encode = QUESTION_FORMATS[mimetype]
+    fragments = cache.payloads(questions, encode, format=fmt)
+    body = b"[" + b",".join(fragments) + b"]" if many else fragments[0]
+    etag = f"{hashlib.blake2b(body, digest_size=16).hexdigest()}-{fmt}"
+    headers = {"Content-Type": mimetype, "Vary": "Accept, Accept-Encoding"}
+    if len(body) >= GZIP_MIN_SIZE and accept_encodings["gzip"] > 0:
+        body = gzip.compress(body, compresslevel=6)
+        etag += "-gzip"
+        headers["Content-Encoding"] = "gzip"
+    headers["ETag"] = f'"{etag}"'
+    return body, headers
+
+
+def encode_question_response(
+    cache: QuestionCache,
+    questions: List[Question],
+    many: bool,
+    method: str,
+    accept_mimetypes: MIMEAccept,
+    accept_encodings: Accept,
+    if_none_match: ETags,
+) -> Tuple[int, bytes, Dict[str, str]]:
+    """Returns the status, body and headers of a response with questions, see `encode_questions`.
+
+    Only GET and HEAD responses keep their ETag, and are a 304 without a body if the client already
+    has them. A POST can't be answered with a 304, so an ETag on it would never be used.
+    """
+    body, headers = encode_questions(
+        cache, questions, many, accept_mimetypes, accept_encodings
+    )
+    if method not in ("GET", "HEAD"):
+        del headers["ETag"]
+    elif if_none_match.contains(headers["ETag"].strip('"')):
+        return 304, b"", {"ETag": headers["ETag"], "Vary": headers["Vary"]}
+    return 200, body, headers
+
+
+def valid_progress(answered) -> bool:
+    return (
+        isinstance(answered, list)
+        and len(answered) <= MAX_QUESTIONS
+        and all(isinstance(id, int) for id in answered)
+        and len(set(answered)) == len(answered)
+    )
+
+
+def session_progress(session: Session) -> Optional[List[int]]:
+    """The ids of the questions the participant has answered, if the session has them right.
+
+    The ids are carried in the signed session cookie so that page loads don't have to read the user
+    file. The apps read storage, and save it with `record_progress`, only when this returns None.
+    """
+    answered = session.get("answered_questions")
+    return answered if valid_progress(answered) else None
+
+
+def record_progress(
+    session: Session, answered: List[int], answers: Sequence[Answer] = ()
+) -> None:
+    answered = list(answered)
+    for answer in answers:
+        if answer.question_id not in answered:
+            answered.append(answer.question_id)
+    session["answered_questions"] = answered
+
+
+def start_participant(session: Session, user_id: int) -> None:
+    """Gives a new participant's session its id, payment code and empty progress."""
+    session["user_id"] = user_id
+    session["payment_code"] = token_hex(16)
+    session["answered_questions"] = []
+
+
+def open_user_store(
+    session: Session, conn: Optional[sqlite3.Connection]
+) -> Union[UserFile, UserDatabase]:
+    """The participant's storage: their rows in the user database if conn is given, else their file."""
+    if conn is not None:
+        return UserDatabase(
+            conn=conn, user_id=session["user_id"], payment_code=session["payment_code"]
+        )
+    return UserFile(
+        filesystem=get_user_fs(),
+        user_id=session["user_id"],
+        payment_code=session["payment_code"],
+    )
+
+
+def has_participant(session: Session) -> bool:
+    return "user_id" in session.keys() and "payment_code" in session.keys()
+
+
+def missing_consent(session: Session, page: Page) -> bool:
+    """Whether page should send the participant back to the welcome page to consent."""
+    return page != "welcome" and (
+        "user_id" not in session.keys() or not session.get("consent", False)
+    )
+
+
+def progress_redirect(page: Page, n_questions: int) -> Optional[Page]:
+    """The page a participant who has answered n_questions belongs on, if it isn't page."""
+    if n_questions > 0 and n_questions < MAX_QUESTIONS and page != "replay":
+        return "replay"
+    elif n_questions >= MAX_QUESTIONS and page != "goodbye":
+        return "goodbye"
+    return None
+
+
+def parse_answer(json) -> Answer:
+    return Answer(
+        question_id=json["id"],
+        answer=json["answer"] == "right",
+        start_time=arrow.get(json["startTime"]).isoformat(),
+        end_time=arrow.get(json["stopTime"]).isoformat(),
+        max_steps=tuple(json["maxSteps"]),  # type: ignore
+    )
+
+
+def parse_answer_batch(json) -> Tuple[str, List[Answer]]:
+    """Parses a {"idempotencyKey": ..., "answers": [...]} batch from the client."""
+    key = json["idempotencyKey"]
+    if not isinstance(key, str) or re.fullmatch(r"[A-Za-z0-9_-]{1,64}", key) is None:
+        raise ValueError("idempotencyKey must be 1-64 letters, digits, - or _")
+    if not isinstance(json["answers"], list) or len(json["answers"]) > MAX_QUESTIONS:
+        raise ValueError(f"answers must be a list of at most {MAX_QUESTIONS} answers")
+    return key, [parse_answer(answer) for answer in json["answers"]]
+
+
+def parse_interact_times(json) -> Tuple[str, str]:
+    return (
+        arrow.get(json["startTime"]).isoformat(),
+        arrow.get(json["stopTime"]).isoformat(),
+    )
+
+
+@dataclass
+class AnswerBatch:
+    """A /submit_answers batch, with the answers to questions that were already answered dropped."""
+
+    key: str
+    answers: List[Answer]
+    duplicate: bool
+
+    def response(self) -> Dict[str, Any]:
+        return {
+            "success": True,
+            "accepted": len(self.answers),
+            "duplicate": self.duplicate,
+        }
+
+
+def answer_batch(json, session: Session, answered: List[int]) -> AnswerBatch:
+    """Parses a batch of answers. Raises KeyError, TypeError or ValueError if it's malformed.
+
+    A batch whose key the session has seen was already stored, e.g. the client retried after a lost
+    response, and is marked as a duplicate with nothing to store.
+    """
+    key, answers = parse_answer_batch(json)
+    if key in session.get("answer_batches", []):
+        return AnswerBatch(key, [], duplicate=True)
+    return AnswerBatch(key, new_answers(answered, answers), duplicate=False)
+
+
+def record_answer_batch(
+    session: Session, answered: List[int], batch: AnswerBatch
+) -> None:
+    """Updates the session once a batch's answers are stored."""
+    record_progress(session, answered, batch.answers)
+    recent_keys = session.get("answer_batches", [])
+    session["answer_batches"] = (recent_keys + [batch.key])[-ANSWER_BATCH_KEYS:]
+
+
+def new_answers(answered: List[int], answers: List[Answer]) -> List[Answer]:
+    """Drops answers to questions that were already answered, keeping the first answer to each."""
+    seen = set(answered)
+    out = []
+    for answer in answers:
+        if answer.question_id not in seen:
+            seen.add(answer.question_id)
+            out.append(answer)
+    return out
+
+
+def parse_traj_ids(
+    traj_ids, db: RemoteSqlite, journal: WriteJournal
+) -> Tuple[Union[int, str], Union[int, str]]:
+    """Checks a submitted question's trajectories before it is journaled.
+
+    Each id must be a trajectory id or a reference to a journaled trajectory, which is either still
+    in the journal or already merged into the database. Raises ValueError otherwise, since an entry
+    that can't be resolved would only fail at compaction.
+    """
+    if not isinstance(traj_ids, list) or len(traj_ids) != 2:
+        raise ValueError("traj_ids must be a pair of trajectory ids")
+    for id in traj_ids:
+        if isinstance(id, int) and not isinstance(id, bool):
+            continue
+        if (key := ref_key(id)) is None:
+            raise ValueError(
+                f"{id!r} is neither a trajectory id nor a journal reference"
+            )
+        kind = journal.kind(key)
+        if kind is None:
+            # Compacted since it was submitted, check the database, pulling it if ours predates that.
+            if applied_ref(db.reader(), REF_PREFIX + key) is None:
+                db.pull()
+                if applied_ref(db.reader(), REF_PREFIX + key) is None:
+                    raise ValueError(f"No trajectory was submitted as {id}")
+        elif kind != "trajectory":
+            raise ValueError(f"{id} is a {kind}, not a trajectory")
+    return traj_ids[0], traj_ids[1]
+
+
+def journal_question(json, db: RemoteSqlite, journal: WriteJournal) -> str:
+    """Journals a question submitted to /submit_question, returning its reference.
+
+    Raises KeyError or ValueError, before anything is journaled, if the question is malformed.
+    """
+    traj_ids = parse_traj_ids(json["traj_ids"], db, journal)
+    label = json["name"]
+    return journal.append(
+        "question",
+        {"traj_ids": traj_ids, "algo": "manual", "env_name": "miner", "label": label},
+    )
+
+
+def journal_trajectory(json, journal: WriteJournal) -> str:
+    """Journals a trajectory submitted to /submit_trajectory, returning its reference."""
+    # Check the state parses now, rather than when the journal is compacted.
+    State.from_json(json["start_state"])
+    return journal.append(
+        "trajectory",
+        {
+            "start_state": json["start_state"],
+            "actions": json["actions"],
+            "env_name": "miner",
+            "modality": "traj",
+        },
+    )
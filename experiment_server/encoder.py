@@ -1,23 +1,139 @@
+import base64
 import dataclasses
 import json
 import logging
-from typing import Any
+from typing import Any, Callable, Dict
 
 import attrs
 import numpy as np
+from flask.json.provider import DefaultJSONProvider
+
+from experiment_server.type import Answer, Question, State, Trajectory
+
+ArrayPacker = Callable[[np.ndarray], Any]
+
+
+def list_array(arr: np.ndarray) -> list:
+    return arr.tolist()
+
+
+def state_to_dict(state: State, pack_array: ArrayPacker = list_array) -> dict:
+    return {
+        "grid": pack_array(state.grid),
+        "grid_shape": state.grid_shape,
+        "agent_pos": state.agent_pos,
+        "exit_pos": state.exit_pos,
+    }
+
+
+def trajectory_to_dict(traj: Trajectory, pack_array: ArrayPacker = list_array) -> dict:
+    return {
+        "start_state": state_to_dict(traj.start_state, pack_array),
+        "actions": pack_array(traj.actions) if traj.actions is not None else None,
+        "env_name": traj.env_name,
+        "modality": traj.modality,
+        "reason": traj.reason,
+        "cstates": traj.cstates,
+    }
+
+
+def question_to_dict(question: Question, pack_array: ArrayPacker = list_array) -> dict:
+    return {
+        "id": question.id,
+        "trajs": [trajectory_to_dict(traj, pack_array) for traj in question.trajs],
+    }
+
+
+def answer_to_dict(answer: Answer, pack_array: ArrayPacker = list_array) -> dict:
+    return {
+        "question_id": answer.question_id,
+        "answer": answer.answer,
+        "start_time": answer.start_time,
+        "end_time": answer.end_time,
+        "max_steps": answer.max_steps,
+    }
+
+
+# Serializers for the types the app sends most, which write their fields directly instead of going
+# through attrs.asdict. Looked up by exact type, so subclasses like FeatureTrajectory, which have
+# more fields, take the generic path.
+SERIALIZERS: Dict[type, Callable[[Any, ArrayPacker], dict]] = {
+    Question: question_to_dict,
+    Trajectory: trajectory_to_dict,
+    State: state_to_dict,
+    Answer: answer_to_dict,
+}
+
+
+def to_jsonable(obj: Any, pack_array: ArrayPacker = list_array) -> Any:
+    """Converts obj, which json can't serialize by itself, to something it can."""
+    if (serializer := SERIALIZERS.get(type(obj))) is not None:
+        return serializer(obj, pack_array)
+    elif isinstance(obj, np.integer):
+        return int(obj)
+    elif isinstance(obj, np.floating):
+        return float(obj)
+    elif isinstance(obj, np.ndarray):
+        return pack_array(obj)
+    elif dataclasses.is_dataclass(obj):
+        return dataclasses.asdict(obj)
+    elif attrs.has(type(obj)):
+        logging.debug("Serializing attrs class %s", type(obj).__name__)
+        return attrs.asdict(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
 class Encoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif dataclasses.is_dataclass(obj):
-            return dataclasses.asdict(obj)
-        elif attrs.has(obj):
-            logging.debug(f"Serializing attrs class {obj} to {attrs.asdict(obj)}")
-            return attrs.asdict(obj)
-        return json.JSONEncoder.default(self, obj)
+        return to_jsonable(obj)
+
+
+def encode_json(obj: Any) -> bytes:
+    return json.dumps(obj, cls=Encoder).encode("utf-8")
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, serializing the app's types with to_jsonable."""
+
+    default = staticmethod(to_jsonable)
+
+
+# Media type of question payloads with arrays packed by compact_array.
+COMPACT_MIMETYPE = "application/vnd.experiment-server.compact+json"
+
+
+def compact_array(arr: np.ndarray) -> dict:
+    """Packs arr as base64 of its little-endian bytes, which queries.js unpacks into a typed array.
+
+    Integer arrays are narrowed to uint8 when every value fits, which covers grids and actions. Other
+    integers are sent as int32 if they fit and float64 otherwise, since javascript has no int64 array
+    that behaves like a list of numbers.
+    """
+    if arr.dtype.kind == "b":
+        arr = arr.astype(np.uint8)
+    elif arr.dtype.kind in "iu":
+        lo, hi = (int(arr.min()), int(arr.max())) if arr.size > 0 else (0, 0)
+        if lo >= 0 and hi <= np.iinfo(np.uint8).max:
+            arr = arr.astype(np.uint8)
+        elif lo >= np.iinfo(np.int32).min and hi <= np.iinfo(np.int32).max:
+            arr = arr.astype("<i4")
+        else:
+            arr = arr.astype("<f8")
+    elif arr.dtype.kind == "f":
+        arr = arr.astype("<f4" if arr.dtype.itemsize <= 4 else "<f8")
+    else:
+        raise TypeError(f"Can't pack arrays of dtype {arr.dtype}")
+    return {
+        "__ndarray__": base64.b64encode(np.ascontiguousarray(arr).data).decode("ascii"),
+        "dtype": arr.dtype.name,
+        "shape": list(arr.shape),
+    }
+
+
+class CompactEncoder(json.JSONEncoder):
+    def default(self, obj):
+        return to_jsonable(obj, compact_array)
+
+
+def encode_compact_json(obj: Any) -> bytes:
+    return json.dumps(obj, cls=CompactEncoder, separators=(",", ":")).encode("utf-8")
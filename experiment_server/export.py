@@ -0,0 +1,264 @@
+"""Exports participants' answers from the user files to columnar arrays for analysis.
+
+`export_answers` writes two .npz files to a local directory, with one array per column:
+
+- answers.npz: user_id, question_id, prefer_right, start_time, end_time (seconds since the epoch)
+  and max_steps (n x 2, left then right), one row per answer.
+- users.npz: user_id, interact_start, interact_end (NaN if the participant never got that far) and
+  n_answers, one row per participant.
+
+Users are read concurrently on a bounded thread pool and turned into rows as they arrive, so only a
+few users are in memory at a time. A manifest.json records the version of each user's files, and
+later exports only read the users whose snapshot or answer segments changed since, copying
+everyone else's rows from the previous export. Which users changed is decided from a single
+recursive listing of the filesystem, without a request per user.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import fs.base
+import fs.errors
+import fs.info
+import fs.path
+import numpy as np
+from fs.wrapfs import WrapFS
+from fs_s3fs import S3FS
+
+from experiment_server.query import bounded_map
+from experiment_server.type import User
+from experiment_server.user_file import (
+    merge_answers,
+    read_answer_segment,
+    read_snapshot,
+    read_user,
+)
+
+ANSWER_COLUMNS = {
+    "user_id": np.int64,
+    "question_id": np.int64,
+    "prefer_right": np.bool_,
+    "start_time": np.float64,
+    "end_time": np.float64,
+    "max_steps": np.int32,
+}
+USER_COLUMNS = {
+    "user_id": np.int64,
+    "interact_start": np.float64,
+    "interact_end": np.float64,
+    "n_answers": np.int32,
+}
+
+
+def info_version(info: fs.info.Info) -> str:
+    """Identifies the contents of a file by its ETag, or modification time and size without one."""
+    if (etag := info.get("s3", "e_tag")) is not None:
+        return etag
+    modified = info.modified.timestamp() if info.modified is not None else None
+    return f"{modified}-{info.size}"
+
+
+def list_files(filesystem: fs.base.FS) -> Iterator[Tuple[str, str]]:
+    """Yields the path and version of every file on filesystem.
+
+    On s3 this is one paginated LIST of everything under the filesystem's prefix, whose entries
+    carry each object's ETag; scandir would make a LIST per directory and a HEAD per object. Other
+    filesystems are walked.
+    """
+    # Only the listing bypasses a wrapper like WriteBehindFS. Writes it hasn't uploaded yet show up
+    # in the next export.
+    while isinstance(filesystem, WrapFS):
+        filesystem = filesystem.delegate_fs()
+    if isinstance(filesystem, S3FS):
+        prefix = fs.path.relpath(fs.path.forcedir(filesystem.dir_path))
+        paginator = filesystem.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=filesystem._bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", ()):
+                if not obj["Key"].endswith("/"):
+                    yield "/" + obj["Key"][len(prefix) :], obj["ETag"]
+    else:
+        for path, info in filesystem.walk.info("/", namespaces=["details"]):
+            if not info.is_dir:
+                yield path, info_version(info)
+
+
+def scan_users(filesystem: fs.base.FS) -> Iterator[Tuple[int, str, List[str]]]:
+    """Yields the id, snapshot version and sorted answer segment paths of every user."""
+    snapshots: Dict[int, str] = {}
+    segments: Dict[int, List[str]] = defaultdict(list)
+    for path, version in list_files(filesystem):
+        if (match := re.fullmatch(r"/user_([0-9]+)\.json", path)) is not None:
+            snapshots[int(match.group(1))] = version
+        elif (
+            match := re.fullmatch(r"/(user_([0-9]+)_answers/[^/]+\.jsonl)", path)
+        ) is not None:
+            segments[int(match.group(2))].append(match.group(1))
+    for user_id, version in snapshots.items():
+        yield user_id, version, sorted(segments[user_id])
+
+
+def parse_time(timestamp: Optional[str]) -> float:
+    if timestamp is None:
+        return float("nan")
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def empty_columns(columns: Dict[str, type]) -> Dict[str, np.ndarray]:
+    return {
+        name: np.empty((0, 2) if name == "max_steps" else 0, dtype=dtype)
+        for name, dtype in columns.items()
+    }
+
+
+def sort_by_user(columns: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    # Stable, so each user's answers stay in the order they were given.
+    order = np.argsort(columns["user_id"], kind="stable")
+    return {name: column[order] for name, column in columns.items()}
+
+
+def load_answers(out_dir: str) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    """Reads the answer and user columns written by export_answers."""
+    with np.load(os.path.join(out_dir, "answers.npz")) as answers, np.load(
+        os.path.join(out_dir, "users.npz")
+    ) as users:
+        return dict(answers), dict(users)
+
+
+def _save_columns(path: str, columns: Dict[str, np.ndarray]) -> None:
+    # np.savez adds .npz to names without it, so the temporary file keeps the extension.
+    tmp_path = f"{path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, path)
+
+
+class _ColumnBuilder:
+    def __init__(self, columns: Dict[str, type]):
+        self.dtypes = columns
+        self.values: Dict[str, list] = {name: [] for name in columns}
+        self.kept: List[Dict[str, np.ndarray]] = []
+
+    def keep(self, columns: Dict[str, np.ndarray], mask: np.ndarray) -> None:
+        """Keeps the masked rows of a previous export."""
+        self.kept.append({name: columns[name][mask] for name in self.dtypes})
+
+    def build(self) -> Dict[str, np.ndarray]:
+        out = {}
+        for name, dtype in self.dtypes.items():
+            new = np.array(self.values[name], dtype=dtype)
+            if name == "max_steps":
+                new = new.reshape(-1, 2)
+            out[name] = np.concatenate([kept[name] for kept in self.kept] + [new])
+        return out
+
+
+def _read_user(
+    filesystem: fs.base.FS,
+    user_id: int,
+    snapshot_version: str,
+    paths: List[str],
+    previous_version: Optional[str],
+) -> Tuple[int, str, Optional[User]]:
+    """Returns the user's current version, and the user if that version differs from the previous one."""
+    # Segment names are never reused and segments are never rewritten, so their names identify them.
+    version = "|".join([snapshot_version] + [path.rsplit("/", 1)[-1] for path in paths])
+    if version == previous_version:
+        return user_id, version, None
+    user = read_snapshot(filesystem, user_id)
+    if user is None:
+        # Deleted since the listing.
+        return user_id, version, None
+    try:
+        segments = [read_answer_segment(filesystem, p) for p in paths]
+    except fs.errors.ResourceNotFound:
+        # Compacted since the listing, so the snapshot may already hold these answers. The version
+        # no longer matches the files, so the next export reads the user again.
+        return user_id, version, read_user(filesystem, user_id)
+    return user_id, version, merge_answers(user, segments)
+
+
+def export_answers(
+    filesystem: fs.base.FS, out_dir: str, workers: int = 16, incremental: bool = True
+) -> Dict[str, int]:
+    """Exports every user's answers on filesystem to columnar files in out_dir.
+
+    If incremental and out_dir holds a previous export, users whose files haven't changed are not
+    read again. Returns the number of users and answers exported, and how many users were read.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    previous: Dict[str, str] = {}
+    old_answers, old_users = empty_columns(ANSWER_COLUMNS), empty_columns(USER_COLUMNS)
+    if incremental and os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        old_answers, old_users = load_answers(out_dir)
+
+    start = time.perf_counter()
+    answers = _ColumnBuilder(ANSWER_COLUMNS)
+    users = _ColumnBuilder(USER_COLUMNS)
+    versions: Dict[str, str] = {}
+    unchanged: List[int] = []
+    n_read = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export") as pool:
+        results = bounded_map(
+            pool,
+            lambda listing: _read_user(
+                filesystem, *listing, previous.get(str(listing[0]))
+            ),
+            scan_users(filesystem),
+            prefetch=4 * workers,
+        )
+        for user_id, version, user in results:
+            if user is None:
+                if version == previous.get(str(user_id)):
+                    versions[str(user_id)] = version
+                    unchanged.append(user_id)
+                continue
+            versions[str(user_id)] = version
+            n_read += 1
+            interact_start, interact_end = user.interact_times or (None, None)
+            users.values["user_id"].append(user_id)
+            users.values["interact_start"].append(parse_time(interact_start))
+            users.values["interact_end"].append(parse_time(interact_end))
+            users.values["n_answers"].append(len(user.responses))
+            for answer in user.responses:
+                answers.values["user_id"].append(user_id)
+                answers.values["question_id"].append(answer.question_id)
+                answers.values["prefer_right"].append(answer.answer)
+                answers.values["start_time"].append(parse_time(answer.start_time))
+                answers.values["end_time"].append(parse_time(answer.end_time))
+                answers.values["max_steps"].append(tuple(answer.max_steps))
+
+    kept_ids = np.array(unchanged, dtype=np.int64)
+    answers.keep(old_answers, np.isin(old_answers["user_id"], kept_ids))
+    users.keep(old_users, np.isin(old_users["user_id"], kept_ids))
+    answer_columns, user_columns = sort_by_user(answers.build()), sort_by_user(
+        users.build()
+    )
+
+    # The manifest goes last: if the export is interrupted before it, the next run compares against
+    # the older manifest and re-reads anything that changed since, which is still correct.
+    _save_columns(os.path.join(out_dir, "answers.npz"), answer_columns)
+    _save_columns(os.path.join(out_dir, "users.npz"), user_columns)
+    tmp_manifest = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_manifest, "w") as f:
+        json.dump(versions, f)
+    os.replace(tmp_manifest, manifest_path)
+
+    stats = {
+        "users": len(user_columns["user_id"]),
+        "answers": len(answer_columns["user_id"]),
+        "read": n_read,
+    }
+    logging.info(
+        f"Exported {stats['answers']} answers from {stats['users']} users "
+        f"({n_read} read) in {time.perf_counter() - start:.2f}s"
+    )
+    return stats
@@ -0,0 +1,336 @@
+"""Append-only journal of writes to the question database.
+
+Submitting a trajectory or question used to download the whole database, insert one row, and upload
+the whole database again, and two writers at once would overwrite each other. Instead, each write is
+appended to the journal as its own small object, which never overwrites anything, and `compact` merges
+a batch of entries into the database with a single pull and push, retrying if another process
+pushed in between.
+
+Entries are applied in the order they were written. Rows created from an entry get their database id
+only at compaction, so writers get back a journal reference (`"journal:<key>"`) that later entries can
+use wherever they would use the id. Applied references are recorded in the `journal_refs` table, so
+compacting again after a failure never inserts an entry twice. An entry referring to one that is
+still in the journal waits for it, and an entry that can never be applied, like one referring to a
+reference that doesn't exist, is moved to `<dirname>/dead/` and logged rather than holding up the
+entries after it.
+
+Compaction runs in a single process, `manage.py compact-journal --every 60` (the `journal` process in
+the Procfile), rather than in every web worker, so entries reach readers within a minute or so.
+Without `--every`, the command compacts once, by hand.
+"""
+
+import json
+import logging
+import sqlite3
+import time
+from dataclasses import dataclass, field
+from secrets import token_hex
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import fs.base
+import fs.errors
+import numpy as np
+
+from experiment_server.metrics import labeled
+from experiment_server.query import ensure_flag_columns, insert_question, insert_traj
+from experiment_server.remote_sqlite import RemoteSqlite
+from experiment_server.type import State, Trajectory
+
+EntryKind = Literal["trajectory", "question"]
+REF_PREFIX = "journal:"
+
+
+def ref_key(ref: Any) -> Optional[str]:
+    """The journal key of a `"journal:<key>"` reference, or None if ref isn't one."""
+    if isinstance(ref, str) and ref.startswith(REF_PREFIX):
+        return ref[len(REF_PREFIX) :]
+    return None
+
+
+class WriteJournal:
+    def __init__(self, filesystem: fs.base.FS, dirname: str = "journal"):
+        self.fs = filesystem
+        self.dirname = dirname
+
+    def append(self, kind: EntryKind, payload: Dict[str, Any]) -> str:
+        """Durably records a write and returns a reference to the row it will create."""
+        key = f"{time.time_ns():020d}-{token_hex(4)}"
+        self.fs.makedirs(self.dirname, recreate=True)
+        self.fs.writetext(
+            f"{self.dirname}/{key}.json", json.dumps({"kind": kind, "payload": payload})
+        )
+        return REF_PREFIX + key
+
+    def keys(self) -> List[str]:
+        if not self.fs.exists(self.dirname):
+            return []
+        return sorted(
+            name[: -len(".json")]
+            for name in self.fs.listdir(self.dirname)
+            if name.endswith(".json")
+        )
+
+    def read(self, key: str) -> Tuple[EntryKind, Dict[str, Any]]:
+        entry = json.loads(self.fs.readtext(f"{self.dirname}/{key}.json"))
+        return entry["kind"], entry["payload"]
+
+    def kind(self, key: str) -> Optional[EntryKind]:
+        """The kind of the entry with this key, or None if it isn't in the journal (any more)."""
+        try:
+            return self.read(key)[0]
+        except fs.errors.ResourceNotFound:
+            return None
+
+    def dead_letter(self, failed: Dict[str, str]) -> None:
+        """Moves entries that can't be applied out of the journal, keyed by why they failed."""
+        if len(failed) == 0:
+            return
+        dead_dir = f"{self.dirname}/dead"
+        self.fs.makedirs(dead_dir, recreate=True)
+        for key, reason in failed.items():
+            logging.error(f"Moving journal entry {key} to {dead_dir}: {reason}")
+            try:
+                self.fs.move(
+                    f"{self.dirname}/{key}.json",
+                    f"{dead_dir}/{key}.json",
+                    overwrite=True,
+                )
+            except fs.errors.ResourceNotFound:
+                pass
+
+    def remove(self, keys: List[str]) -> None:
+        for key in keys:
+            try:
+                self.fs.remove(f"{self.dirname}/{key}.json")
+            except fs.errors.ResourceNotFound:
+                # Another process compacted the same entries at the same time.
+                pass
+
+    def compact(self, db: RemoteSqlite, batch_size: int = 1000) -> int:
+        """Merges up to batch_size of the oldest entries into db and removes them from the journal.
+
+        Returns the number of entries taken out of the journal, merged or dead-lettered. Entries
+        waiting for another entry stay in the journal for the next compaction.
+        """
+        all_keys = self.keys()
+        keys = all_keys[:batch_size]
+        if len(keys) == 0:
+            return 0
+        entries = [(key, *self.read(key)) for key in keys]
+        # A question can refer to a trajectory journaled after it, by a worker with a faster clock.
+        # Merge that trajectory now rather than wait for it to come up in a later batch.
+        in_batch = set(keys)
+        pending = set(all_keys)
+        for _, kind, payload in list(entries):
+            if kind == "question" and isinstance(payload.get("traj_ids"), list):
+                for id in payload["traj_ids"]:
+                    if (key := ref_key(id)) in pending and key not in in_batch:
+                        entries.append((key, *self.read(key)))
+                        in_batch.add(key)
+
+        result = db.transaction(
+            lambda conn: apply_entries(conn, entries, pending=all_keys)
+        )
+        # Only forget entries once the remote database has them: pull whatever it holds now, which
+        # is our push unless another one has landed since, and check their references are in it.
+        db.pull()
+        merged = [
+            key
+            for key in result.applied
+            if applied_ref(db.con, REF_PREFIX + key) is not None
+        ]
+        if len(merged) < len(result.applied):
+            logging.warning(
+                f"{len(result.applied) - len(merged)} compacted journal entries are missing from "
+                f"{db.fsfilename}, keeping them to merge again"
+            )
+        self.remove(merged)
+        self.dead_letter(result.failed)
+        logging.info(
+            f"Compacted {len(merged)} journal entries into {db.fsfilename}, "
+            f"{len(result.deferred)} deferred, {len(result.failed)} failed"
+        )
+        return len(merged) + len(result.failed)
+
+
+class JournalCompactor:
+    """Compacts a journal into a database every interval seconds, for `manage.py compact-journal`.
+
+    Run one per journal. Two compactors at once would be safe, since pushes conflict rather than
+    overwrite each other, but they would mostly spend their time retrying.
+    """
+
+    def __init__(
+        self,
+        journal: WriteJournal,
+        db: RemoteSqlite,
+        interval: float = 60.0,
+        batch_size: int = 1000,
+    ):
+        self.journal = journal
+        self.db = db
+        self.interval = interval
+        self.batch_size = batch_size
+
+    def run(self) -> int:
+        """Compacts batches until the journal has none left to merge. Returns the number of entries."""
+        n_compacted = 0
+        while (n := self.journal.compact(self.db, self.batch_size)) > 0:
+            n_compacted += n
+        return n_compacted
+
+    def run_forever(self) -> None:
+        while True:
+            start = time.monotonic()
+            try:
+                with labeled("compactor"):
+                    self.run()
+            except Exception:
+                # Leave the entries for the next round, e.g. after s3 was briefly unavailable.
+                logging.exception("Compacting the journal failed")
+            time.sleep(max(0.0, self.interval - (time.monotonic() - start)))
+
+
+def ensure_refs_table(conn: sqlite3.Connection) -> None:
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS journal_refs(ref TEXT PRIMARY KEY, row_id INT NOT NULL)"
+    )
+
+
+def applied_ref(conn: sqlite3.Connection, ref: str) -> Optional[int]:
+    """The id of the row created from a journal reference, or None if it hasn't been applied."""
+    if (
+        conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name='journal_refs'"
+        ).fetchone()
+        is None
+    ):
+        return None
+    row = conn.execute(
+        "SELECT row_id FROM journal_refs WHERE ref=:ref", {"ref": ref}
+    ).fetchone()
+    return int(row[0]) if row is not None else None
+
+
+class Deferred(Exception):
+    """An entry refers to another entry that is still waiting in the journal."""
+
+
+def resolve_ref(
+    conn: sqlite3.Connection, id: Union[int, str], pending: Collection[str] = ()
+) -> int:
+    """The row id of id, which is either a row id or a reference to an applied entry.
+
+    Raises Deferred if id refers to one of the pending keys, and ValueError if it can never resolve.
+    """
+    if isinstance(id, bool):
+        raise ValueError(f"{id!r} is not a row id")
+    if (key := ref_key(id)) is not None:
+        if (row_id := applied_ref(conn, REF_PREFIX + key)) is not None:
+            return row_id
+        if key in pending:
+            raise Deferred(f"Journal reference {id} has not been applied yet")
+        raise ValueError(f"Journal reference {id} does not exist")
+    return int(id)
+
+
+@dataclass
+class Applied:
+    """What apply_entries did with each entry, by journal key."""
+
+    applied: List[str] = field(default_factory=list)
+    deferred: List[str] = field(default_factory=list)
+    failed: Dict[str, str] = field(default_factory=dict)
+
+
+def apply_entries(
+    conn: sqlite3.Connection,
+    entries: List[Tuple[str, EntryKind, Dict[str, Any]]],
+    pending: Collection[str] = (),
+) -> Applied:
+    """Applies entries in a single transaction, skipping any that were already applied.
+
+    An entry referring to one of the pending keys waits until that entry is applied, and is
+    deferred if it isn't among entries. Entries that can't be applied are reported as failed.
+    Neither stops the entries after them.
+    """
+    ensure_refs_table(conn)
+    ensure_flag_columns(conn)
+    pending = set(pending)
+    result = Applied()
+    remaining = entries
+    with conn:
+        # Entries deferred in one pass are retried once the entries they wait for are applied.
+        while len(remaining) > 0:
+            deferred = []
+            for key, kind, payload in remaining:
+                ref = REF_PREFIX + key
+                if applied_ref(conn, ref) is None:
+                    try:
+                        row_id = apply_entry(conn, kind, payload, pending)
+                    except Deferred:
+                        deferred.append((key, kind, payload))
+                        continue
+                    except (
+                        KeyError,
+                        TypeError,
+                        ValueError,
+                        sqlite3.IntegrityError,
+                    ) as e:
+                        result.failed[key] = f"{type(e).__name__}: {e}"
+                        pending.discard(key)
+                        continue
+                    conn.execute(
+                        "INSERT INTO journal_refs (ref, row_id) VALUES (:ref, :row_id)",
+                        {"ref": ref, "row_id": row_id},
+                    )
+                result.applied.append(key)
+                pending.discard(key)
+            if len(deferred) == len(remaining):
+                break
+            remaining = deferred
+        result.deferred = [key for key, _, _ in remaining]
+    return result
+
+
+def apply_entry(
+    conn: sqlite3.Connection,
+    kind: EntryKind,
+    payload: Dict[str, Any],
+    pending: Collection[str],
+) -> int:
+    """Inserts the row an entry describes, returning its id. Everything is checked before inserting."""
+    if kind == "trajectory":
+        return insert_traj(
+            conn,
+            Trajectory(
+                start_state=State.from_json(payload["start_state"]),
+                actions=np.array(payload["actions"]),
+                env_name=payload["env_name"],
+                modality=payload["modality"],
+            ),
+            commit=False,
+        )
+    elif kind == "question":
+        first_id, second_id = payload["traj_ids"]
+        return insert_question(
+            conn,
+            traj_ids=(
+                resolve_ref(conn, first_id, pending),
+                resolve_ref(conn, second_id, pending),
+            ),
+            algo=payload["algo"],
+            env_name=payload["env_name"],
+            label=payload["label"],
+            commit=False,
+        )
+    raise ValueError(f"Unknown journal entry kind {kind}")
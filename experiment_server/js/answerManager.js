@@ -1,9 +1,17 @@
 import { post } from './utils.js';
 
+function newIdempotencyKey() {
+    return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+}
+
 class AnswerManager {
     constructor() {
         this.answers = [];
         this.questionId = null;
+        // The batch being sent. It keeps its idempotency key until the server accepts it, so a
+        // retry after a failed request can't record the same answers twice.
+        this.batch = null;
+        this.inFlight = null;
     }
 
     setQuestionId(id) {
@@ -12,21 +20,61 @@ class AnswerManager {
         }
     }
 
-    addAnswer(side, timer) {
-        this.answers.push({
+    addAnswer(side, timer, maxSteps) {
+        const answer = {
             id: this.questionId,
             answer: side,
             startTime: timer.startTime,
             stopTime: timer.stopTime,
-        });
+        };
+        if (maxSteps !== undefined) {
+            answer.maxSteps = maxSteps;
+        }
+        this.answers.push(answer);
         this.questionId = null;
     }
 
+    nextBatch() {
+        if (this.batch === null && this.answers.length > 0) {
+            this.batch = { idempotencyKey: newIdempotencyKey(), answers: this.answers };
+            this.answers = [];
+        }
+        return this.batch;
+    }
+
+    // Sends every answer added so far. Answers added while a request is in flight go in the next
+    // batch, so a slow connection sends several answers per request instead of queueing requests.
     async submitAnswers() {
-        if (this.answers.length > 0) {
-            await post('/submit_answers', JSON.stringify(this.answers));
+        if (this.inFlight === null) {
+            this.inFlight = this.sendBatches().finally(() => {
+                this.inFlight = null;
+            });
+        }
+        return this.inFlight;
+    }
+
+    async sendBatches() {
+        let batch = this.nextBatch();
+        while (batch !== null) {
+            // eslint-disable-next-line no-await-in-loop
+            const response = await post('/submit_answers', JSON.stringify(batch));
+            if (!response.ok) {
+                return;
+            }
+            this.batch = null;
+            batch = this.nextBatch();
+        }
+    }
+
+    // Hands anything unsent to the browser to deliver after the page is gone.
+    flushOnUnload(navigator) {
+        const batch = this.nextBatch();
+        if (batch !== null) {
+            navigator.sendBeacon(
+                '/submit_answers',
+                new Blob([JSON.stringify(batch)], { type: 'application/json' }),
+            );
         }
-        this.answers = [];
     }
 }
 export default AnswerManager;
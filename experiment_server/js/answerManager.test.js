@@ -1,6 +1,6 @@
 import { jest } from '@jest/globals';
 
-jest.unstable_mockModule('./utils.js', () => ({ post: jest.fn() }));
+jest.unstable_mockModule('./utils.js', () => ({ post: jest.fn(() => Promise.resolve({ ok: true })) }));
 
 const AnswerManager = (await import('./answerManager.js')).default;
 const utils = await import('./utils.js');
@@ -34,18 +34,52 @@ test('addAnswer', () => {
 });
 
 test('submitAnswers', async () => {
+    const answerManager = new AnswerManager();
+    answerManager.setQuestionId(1);
+    answerManager.addAnswer('left', { startTime: 1, stopTime: 2 }, [10, 12]);
+    answerManager.setQuestionId(2);
+    answerManager.addAnswer('right', { startTime: 3, stopTime: 4 }, [10, 12]);
+    await answerManager.submitAnswers();
+    expect(utils.post).toHaveBeenCalledTimes(1);
+    expect(utils.post.mock.calls[0][0]).toBe('/submit_answers');
+    const batch = JSON.parse(utils.post.mock.calls[0][1]);
+    expect(batch.idempotencyKey).toMatch(/^[A-Za-z0-9_-]+$/);
+    expect(batch.answers).toStrictEqual([
+        { id: 1, answer: 'left', startTime: 1, stopTime: 2, maxSteps: [10, 12] },
+        { id: 2, answer: 'right', startTime: 3, stopTime: 4, maxSteps: [10, 12] },
+    ]);
+    expect(answerManager.answers).toStrictEqual([]);
+    expect(answerManager.batch).toBe(null);
+    utils.post.mockClear();
+});
+
+test('failed batches are retried with the same key', async () => {
     const answerManager = new AnswerManager();
     answerManager.setQuestionId(1);
     answerManager.addAnswer('left', { startTime: 1, stopTime: 2 });
+    utils.post.mockImplementationOnce(() => Promise.resolve({ ok: false }));
+    await answerManager.submitAnswers();
     answerManager.setQuestionId(2);
     answerManager.addAnswer('right', { startTime: 3, stopTime: 4 });
     await answerManager.submitAnswers();
-    expect(utils.post).toHaveBeenCalledWith(
-        '/submit_answers',
-        JSON.stringify([
-            { id: 1, answer: 'left', startTime: 1, stopTime: 2 },
-            { id: 2, answer: 'right', startTime: 3, stopTime: 4 },
-        ]),
-    );
-    expect(answerManager.answers).toStrictEqual([]);
+
+    expect(utils.post).toHaveBeenCalledTimes(3);
+    const [first, retry, second] = utils.post.mock.calls.map((call) => JSON.parse(call[1]));
+    expect(retry).toStrictEqual(first);
+    expect(second.idempotencyKey).not.toBe(first.idempotencyKey);
+    expect(second.answers.map((answer) => answer.id)).toStrictEqual([2]);
+    utils.post.mockClear();
+});
+
+test('flushOnUnload', () => {
+    const answerManager = new AnswerManager();
+    const navigator = { sendBeacon: jest.fn() };
+    answerManager.flushOnUnload(navigator);
+    expect(navigator.sendBeacon).not.toHaveBeenCalled();
+
+    answerManager.setQuestionId(1);
+    answerManager.addAnswer('left', { startTime: 1, stopTime: 2 });
+    answerManager.flushOnUnload(navigator);
+    expect(navigator.sendBeacon).toHaveBeenCalledTimes(1);
+    expect(navigator.sendBeacon.mock.calls[0][0]).toBe('/submit_answers');
 });
@@ -1,21 +1,63 @@
-import { post } from './utils.js';
+import { get, post } from './utils.js';
+
+// Asks the server to send arrays (grids and actions) as base64 typed arrays instead of lists.
+export const COMPACT_TYPE = 'application/vnd.experiment-server.compact+json';
+
+const ARRAY_TYPES = {
+    uint8: Uint8Array,
+    int32: Int32Array,
+    float32: Float32Array,
+    float64: Float64Array,
+};
+
+function decodeArray({ __ndarray__: data, dtype }) {
+    const binary = atob(data);
+    const bytes = new Uint8Array(binary.length);
+    for (let i = 0; i < binary.length; i += 1) {
+        bytes[i] = binary.charCodeAt(i);
+    }
+    // Arrays with more than one dimension come back flattened, in row-major order.
+    return new ARRAY_TYPES[dtype](bytes.buffer);
+}
+
+export function decodeArrays(value) {
+    if (Array.isArray(value)) {
+        return value.map(decodeArrays);
+    }
+    if (value !== null && typeof value === 'object') {
+        if ('__ndarray__' in value) {
+            return decodeArray(value);
+        }
+        const out = {};
+        Object.keys(value).forEach((key) => {
+            out[key] = decodeArrays(value[key]);
+        });
+        return out;
+    }
+    return value;
+}
+
+const QUESTION_ACCEPT = { Accept: `${COMPACT_TYPE}, application/json;q=0.5` };
+
+function postForQuestions(url, body) {
+    return post(url, body, QUESTION_ACCEPT)
+        .then((resp) => resp.json())
+        .then(decodeArrays);
+}
 
 export async function requestRandomQuestions({ env = 'miner', lengths = [], type = null } = {}) {
-    return post(
+    return postForQuestions(
         '/random_questions',
         JSON.stringify({
             env,
             lengths,
             type,
         }),
-    ).then((resp) => resp.json());
+    );
 }
 
 export async function requestQuestionByName(name) {
-    return post(
-        '/named_question',
-        JSON.stringify({
-            name,
-        }),
-    ).then((resp) => resp.json());
+    return get(`/named_question?name=${encodeURIComponent(name)}`, QUESTION_ACCEPT)
+        .then((resp) => resp.json())
+        .then(decodeArrays);
 }
@@ -0,0 +1,23 @@
+import { decodeArrays } from './queries.js';
+
+test('decodeArrays', () => {
+    const question = {
+        id: 1,
+        trajs: [
+            {
+                start_state: {
+                    grid: { __ndarray__: 'AAECAwQ=', dtype: 'uint8', shape: [5] },
+                    grid_shape: [8, 8],
+                },
+                actions: { __ndarray__: '/////ywBAAA=', dtype: 'int32', shape: [2] },
+                reason: null,
+            },
+        ],
+    };
+    const decoded = decodeArrays(question);
+    expect(decoded.id).toBe(1);
+    expect(decoded.trajs[0].start_state.grid).toStrictEqual(new Uint8Array([0, 1, 2, 3, 4]));
+    expect(decoded.trajs[0].start_state.grid_shape).toStrictEqual([8, 8]);
+    expect(decoded.trajs[0].actions).toStrictEqual(new Int32Array([-1, 300]));
+    expect(decoded.trajs[0].reason).toBe(null);
+});
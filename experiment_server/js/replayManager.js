@@ -1,8 +1,8 @@
 import 'core-js/actual/typed-array/int32-array.js';
+import AnswerManager from './answerManager.js';
 import GameManager from './gameManager.js';
 import { requestRandomQuestions } from './queries.js';
 import Timer from './timer.js';
-import { post } from './utils.js';
 
 class ReplayManager {
     constructor(document, window, maxQuestions, tickLength, opts) {
@@ -22,6 +22,9 @@ class ReplayManager {
 
         this.questionsPromise = requestRandomQuestions();
 
+        this.answerManager = new AnswerManager();
+        this.window.addEventListener('pagehide', () => this.answerManager.flushOnUnload(this.window.navigator));
+
         this.select = this.select.bind(this);
         this.selectLeft = this.selectLeft.bind(this);
         this.selectRight = this.selectRight.bind(this);
@@ -123,7 +126,9 @@ class ReplayManager {
             return;
         }
 
-        this.submitPromise = this.submitAnswer(side, this.timer, await this.gameManager.getMaxSteps());
+        this.answerManager.setQuestionId(this.questionId);
+        this.answerManager.addAnswer(side, this.timer, await this.gameManager.getMaxSteps());
+        this.submitPromise = this.answerManager.submitAnswers();
 
         this.timer.reset();
 
@@ -132,19 +137,6 @@ class ReplayManager {
         this.nextQuestion();
     }
 
-    async submitAnswer(side, timer, maxSteps) {
-        await post(
-            '/submit_answer',
-            JSON.stringify({
-                id: this.questionId,
-                answer: side,
-                startTime: timer.startTime,
-                stopTime: timer.stopTime,
-                maxSteps,
-            }),
-        );
-    }
-
     async leaveIfDone() {
         if ((await this.getQuestions()).length === 0) {
             await this.submitPromise;
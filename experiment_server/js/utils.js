@@ -23,17 +23,27 @@ export function zip(a, b) {
     return a.map((k, i) => [k, b[i]]);
 }
 
-export function post(url, body) {
+export function post(url, body, headers = {}) {
     return fetch(url, {
         method: 'POST',
         cache: 'no-store',
         headers: {
             'Content-Type': 'application/json',
+            ...headers,
         },
         body,
     });
 }
 
+// Revalidates with the server every time, so a response the browser has cached comes back as a 304.
+export function get(url, headers = {}) {
+    return fetch(url, {
+        method: 'GET',
+        cache: 'no-cache',
+        headers,
+    });
+}
+
 export const combos = [
     ['ArrowLeft', 'ArrowDown'],
     ['ArrowLeft'],
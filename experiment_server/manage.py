@@ -0,0 +1,180 @@
+"""Admin commands for maintaining the experiment database.
+
+Run with `python -m experiment_server.manage <command> --help`.
+"""
+
+import argparse
+import logging
+import re
+import sqlite3
+import time
+
+import fs
+
+from experiment_server.export import export_answers
+from experiment_server.journal import JournalCompactor, WriteJournal
+from experiment_server.query import backfill_flags, migrate_blobs
+from experiment_server.remote_sqlite import RemoteSqlite
+from experiment_server.user_db import connect_user_db, import_user_files
+from experiment_server.user_file import compact_user
+
+
+def migrate_blobs_command(args: argparse.Namespace) -> None:
+    conn = sqlite3.connect(args.db_path)
+    start = time.perf_counter()
+    n_migrated = migrate_blobs(conn, batch_size=args.batch_size)
+    logging.info(
+        f"Rewrote {n_migrated} trajectories in {time.perf_counter() - start:.2f}s"
+    )
+    if args.vacuum:
+        # Old pickles leave free pages behind, vacuum so the file (and the s3 download) shrinks.
+        conn.execute("VACUUM")
+    conn.close()
+
+
+def backfill_flags_command(args: argparse.Namespace) -> None:
+    conn = sqlite3.connect(args.db_path)
+    start = time.perf_counter()
+    n_updated = backfill_flags(conn, batch_size=args.batch_size)
+    logging.info(
+        f"Computed flags for {n_updated} trajectories in {time.perf_counter() - start:.2f}s"
+    )
+    conn.close()
+
+
+def compact_journal_command(args: argparse.Namespace) -> None:
+    remote_fs = fs.open_fs(args.fs_url)
+    db = RemoteSqlite(remote_fs, args.filename)
+    journal = WriteJournal(remote_fs)
+    if args.every is not None:
+        JournalCompactor(
+            journal, db, interval=args.every, batch_size=args.batch_size
+        ).run_forever()
+    while (n_compacted := journal.compact(db, batch_size=args.batch_size)) > 0:
+        logging.info(f"Merged {n_compacted} journal entries")
+        if not args.all:
+            break
+
+
+def import_users_command(args: argparse.Namespace) -> None:
+    conn = connect_user_db(args.db_path, create=True)
+    n_imported = import_user_files(fs.open_fs(args.users_fs_url), conn)
+    logging.info(f"Imported {n_imported} users into {args.db_path}")
+    conn.close()
+
+
+def compact_users_command(args: argparse.Namespace) -> None:
+    users_fs = fs.open_fs(args.users_fs_url)
+    n_segments = 0
+    for name in users_fs.listdir("/"):
+        if (match := re.fullmatch(r"user_([0-9]+)\.json", name)) is not None:
+            n_segments += compact_user(users_fs, int(match.group(1)))
+    logging.info(f"Folded {n_segments} answer segments into user files")
+
+
+def export_answers_command(args: argparse.Namespace) -> None:
+    export_answers(
+        fs.open_fs(args.users_fs_url),
+        args.out_dir,
+        workers=args.workers,
+        incremental=not args.full,
+    )
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(required=True)
+
+    migrate = subparsers.add_parser(
+        "migrate-blobs",
+        help="Rewrite pickled trajectory blobs in the binary codec format, in place.",
+    )
+    migrate.add_argument("db_path")
+    migrate.add_argument("--batch-size", type=int, default=1000)
+    migrate.add_argument("--no-vacuum", dest="vacuum", action="store_false")
+    migrate.set_defaults(func=migrate_blobs_command)
+
+    backfill = subparsers.add_parser(
+        "backfill-flags",
+        help="Add the content flag columns if missing, then compute flags (fire, tile counts) for trajectories that don't have them.",
+    )
+    backfill.add_argument("db_path")
+    backfill.add_argument("--batch-size", type=int, default=1000)
+    backfill.set_defaults(func=backfill_flags_command)
+
+    compact = subparsers.add_parser(
+        "compact-journal",
+        help="Merge journaled trajectory and question submissions into the database.",
+    )
+    compact.add_argument(
+        "fs_url",
+        nargs="?",
+        default="s3://multimodal-reward-learning/",
+        help="Filesystem holding the database and its journal.",
+    )
+    compact.add_argument("--filename", default="experiments.db")
+    compact.add_argument("--batch-size", type=int, default=1000)
+    compact.add_argument(
+        "--all",
+        action="store_true",
+        help="Keep merging batches until the journal is empty.",
+    )
+    compact.add_argument(
+        "--every",
+        type=float,
+        metavar="SECONDS",
+        help="Keep running, emptying the journal every SECONDS. Run only one of these.",
+    )
+    compact.set_defaults(func=compact_journal_command)
+
+    import_users = subparsers.add_parser(
+        "import-users",
+        help="Copy participants' user_<id>.json files into the users and answers tables.",
+    )
+    import_users.add_argument(
+        "users_fs_url",
+        nargs="?",
+        default="s3://multimodal-reward-learning/users/",
+        help="Filesystem holding the user files.",
+    )
+    import_users.add_argument("db_path")
+    import_users.set_defaults(func=import_users_command)
+
+    compact_users = subparsers.add_parser(
+        "compact-users",
+        help="Fold appended answer segments into each participant's user_<id>.json. Run between studies.",
+    )
+    compact_users.add_argument(
+        "users_fs_url",
+        nargs="?",
+        default="s3://multimodal-reward-learning/users/",
+        help="Filesystem holding the user files.",
+    )
+    compact_users.set_defaults(func=compact_users_command)
+
+    export = subparsers.add_parser(
+        "export-answers",
+        help="Write every participant's answers to columnar .npz files, re-reading only changed users.",
+    )
+    export.add_argument(
+        "users_fs_url",
+        nargs="?",
+        default="s3://multimodal-reward-learning/users/",
+        help="Filesystem holding the user files.",
+    )
+    export.add_argument("out_dir")
+    export.add_argument("--workers", type=int, default=16)
+    export.add_argument(
+        "--full",
+        action="store_true",
+        help="Re-read every user instead of reusing the previous export.",
+    )
+    export.set_defaults(func=export_answers_command)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Request and storage metrics, exported at /metrics in the Prometheus text format.
+
+/metrics answers requests from the same machine, and others carrying a token (see profiling.py).
+
+Each request's route is kept in a context variable for as long as it runs, so storage calls can be
+attributed to the route that made them (see Boto3Counter). The app's background work, like uploading
+spooled writes or computing stats, runs under a label of its own (see `labeled`). boto3 makes some
+calls, like the parts of an upload or download, on its own transfer threads, which don't see the
+variable. Those are attributed to the only request or labeled task in progress when there is one,
+which under gunicorn's sync workers is usually the one that made them. Otherwise they are counted as
+"background".
+"""
+
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+Labels = Tuple[Tuple[str, str], ...]
+
+LATENCY_BUCKETS: Sequence[float] = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+SIZE_BUCKETS: Sequence[float] = tuple(float(4**i * 256) for i in range(9))
+
+current_route: ContextVar[Optional[str]] = ContextVar("current_route", default=None)
+
+_active_routes: Dict[str, int] = defaultdict(int)
+_active_lock = threading.Lock()
+
+
+def _enter(route: str) -> None:
+    current_route.set(route)
+    with _active_lock:
+        _active_routes[route] += 1
+
+
+def _leave(route: str) -> None:
+    with _active_lock:
+        _active_routes[route] -= 1
+        if _active_routes[route] == 0:
+            del _active_routes[route]
+    current_route.set(None)
+
+
+@contextmanager
+def labeled(label: str) -> Iterator[None]:
+    """Attributes the storage calls made by a piece of background work to label, like a route."""
+    _enter(label)
+    try:
+        yield
+    finally:
+        _leave(label)
+
+
+def route_label() -> str:
+    """The route of the request making the current call, see the module docstring."""
+    if (route := current_route.get()) is not None:
+        return route
+    with _active_lock:
+        if len(_active_routes) == 1:
+            ((route, count),) = _active_routes.items()
+            if count == 1:
+                return route
+    return "background"
+
+
+class Histogram:
+    """A Prometheus histogram: counts of observations at or below each bucket's upper bound."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _format_labels(labels: Labels) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_counter(
+    name: str, help: str, values: Dict[Labels, float], type: str = "counter"
+) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {type}"]
+    for labels, value in sorted(values.items()):
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    return lines
+
+
+def format_histogram(
+    name: str, help: str, histograms: Dict[Labels, Histogram]
+) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} histogram"]
+    for labels, histogram in sorted(histograms.items(), key=lambda item: item[0]):
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            bucket_labels = labels + (("le", repr(float(bound))),)
+            lines.append(f"{name}_bucket{_format_labels(bucket_labels)} {count}")
+        inf_labels = labels + (("le", "+Inf"),)
+        lines.append(f"{name}_bucket{_format_labels(inf_labels)} {histogram.count}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+        lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+    return lines
+
+
+class RequestMetrics:
+    """Counts and latencies of the app's own requests, by route."""
+
+    def __init__(self):
+        self.requests: Dict[Labels, int] = defaultdict(int)
+        self.latency: Dict[Labels, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def begin(self, route: str) -> Tuple[str, float]:
+        """Marks the start of a request to route, returning a token to pass to end."""
+        _enter(route)
+        return route, time.perf_counter()
+
+    def end(self, token: Tuple[str, float], method: str, status: int) -> None:
+        route, start = token
+        elapsed = time.perf_counter() - start
+        _leave(route)
+        with self._lock:
+            self.requests[
+                (("route", route), ("method", method), ("status", str(status)))
+            ] += 1
+            if (histogram := self.latency.get((("route", route),))) is None:
+                histogram = self.latency[(("route", route),)] = Histogram(
+                    LATENCY_BUCKETS
+                )
+            histogram.observe(elapsed)
+
+    def prometheus(self) -> List[str]:
+        with self._lock:
+            return format_counter(
+                "http_requests_total",
+                "Requests handled, by route, method and status.",
+                dict(self.requests),
+            ) + format_histogram(
+                "http_request_seconds",
+                "Time to handle a request, by route.",
+                self.latency,
+            )
+
+
+def render(sections: Iterable[List[str]]) -> str:
+    return "\n".join(line for section in sections for line in section) + "\n"
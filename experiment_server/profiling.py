@@ -0,0 +1,220 @@
+"""Profiling of single live requests, opted into with a signed token.
+
+A request carrying a valid token, in the X-Profile header or the _profile query parameter, runs under
+cProfile. The profile is kept in a bounded in-memory buffer, listed at /admin/profiles, and the
+response gets a Server-Timing header with the request's wall time split into storage I/O, sqlite,
+blob decoding (unpickling or the binary codec) and JSON encoding.
+
+The same tokens open /stats and /metrics. Profiling is off unless PROFILE_SECRET is set. Tokens
+expire, and are made with
+
+    PROFILE_SECRET=... python -m experiment_server.profiling --ttl 600
+"""
+
+import argparse
+import cProfile
+import hashlib
+import hmac
+import io
+import itertools
+import os
+import pstats
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+import arrow
+from attrs import define
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_PARAM = "_profile"
+
+# (category, substrings of a function's file, substrings of a builtin's name). A function's own time
+# goes to the first category it matches.
+CATEGORIES: List[Tuple[str, Tuple[str, ...], Tuple[str, ...]]] = [
+    ("sqlite", ("/sqlite3/",), ("sqlite3.",)),
+    (
+        "decode",
+        ("/experiment_server/codec.py", "/pickle.py"),
+        ("_pickle.load",),
+    ),
+    (
+        "json",
+        ("/json/", "/experiment_server/encoder.py"),
+        ("_json.", "json."),
+    ),
+    (
+        "storage",
+        (
+            "/fs/",
+            "/fs_s3fs/",
+            "/boto3/",
+            "/botocore/",
+            "/s3transfer/",
+            "/urllib3/",
+            "/http/client.py",
+            "/ssl.py",
+            "/socket.py",
+        ),
+        ("_socket.", "_ssl."),
+    ),
+]
+
+FuncKey = Tuple[str, int, str]
+
+
+def sign(secret: str, expires: int) -> str:
+    digest = hmac.new(secret.encode(), str(expires).encode(), hashlib.sha256)
+    return f"{expires}.{digest.hexdigest()}"
+
+
+def verify(secret: str, token: str, now: Optional[float] = None) -> bool:
+    """Checks token was made by sign with the same secret and hasn't expired."""
+    expires, _, _ = token.partition(".")
+    if not expires.isdigit():
+        return False
+    if int(expires) < (now if now is not None else time.time()):
+        return False
+    return hmac.compare_digest(sign(secret, int(expires)), token)
+
+
+def _match(func: FuncKey) -> Optional[str]:
+    filename, _, name = func
+    for category, files, builtins in CATEGORIES:
+        if filename == "~":
+            if any(builtin in name for builtin in builtins):
+                return category
+        elif any(file in filename.replace(os.sep, "/") for file in files):
+            return category
+    return None
+
+
+def categorize(func: FuncKey, callers: Dict[FuncKey, tuple]) -> Optional[str]:
+    """The category of func's own time. Other builtins, like waiting on a lock or reading a socket,
+    take the category of the code that called them."""
+    if (category := _match(func)) is not None:
+        return category
+    if func[0] == "~":
+        for caller in callers:
+            if (category := _match(caller)) is not None:
+                return category
+    return None
+
+
+def breakdown(stats: pstats.Stats, wall_seconds: float) -> Dict[str, float]:
+    """Seconds of wall time spent in each category, from each function's own time."""
+    seconds = {category: 0.0 for category, _, _ in CATEGORIES}
+    for func, (_, _, own_time, _, callers) in stats.stats.items():  # type: ignore
+        if (category := categorize(func, callers)) is not None:
+            seconds[category] += own_time
+    seconds["other"] = max(0.0, wall_seconds - sum(seconds.values()))
+    seconds["total"] = wall_seconds
+    return seconds
+
+
+def server_timing(seconds: Dict[str, float]) -> str:
+    return ", ".join(
+        f"{category};dur={1000 * value:.1f}" for category, value in seconds.items()
+    )
+
+
+@define
+class RequestProfile:
+    id: int
+    method: str
+    path: str
+    route: str
+    started_at: str
+    status: int
+    seconds: Dict[str, float]
+    # The slowest functions by cumulative time, as printed by pstats.
+    report: str
+
+    def summary(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "route": self.route,
+            "started_at": self.started_at,
+            "status": self.status,
+            "seconds": self.seconds,
+        }
+
+
+class ProfileBuffer:
+    """The most recent request profiles, up to maxlen of them."""
+
+    def __init__(self, maxlen: int = 32):
+        self._profiles: Deque[RequestProfile] = deque(maxlen=maxlen)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def next_id(self) -> int:
+        with self._lock:
+            return next(self._ids)
+
+    def add(self, profile: RequestProfile) -> None:
+        with self._lock:
+            self._profiles.append(profile)
+
+    def recent(self) -> List[RequestProfile]:
+        with self._lock:
+            return list(reversed(self._profiles))
+
+    def get(self, id: int) -> Optional[RequestProfile]:
+        with self._lock:
+            return next((p for p in self._profiles if p.id == id), None)
+
+
+class ActiveProfile:
+    """A request being profiled. Profiles the thread that starts it until finish is called."""
+
+    def __init__(self, buffer: ProfileBuffer, method: str, path: str, route: str):
+        self.buffer = buffer
+        self.id = buffer.next_id()
+        self.method = method
+        self.path = path
+        self.route = route
+        self.started_at = arrow.utcnow().isoformat()
+        self.profiler = cProfile.Profile()
+        self.start = time.perf_counter()
+        self.profiler.enable()
+
+    def finish(self, status: int, n_functions: int = 40) -> RequestProfile:
+        self.profiler.disable()
+        wall_seconds = time.perf_counter() - self.start
+        report = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=report)
+        stats.sort_stats("cumulative").print_stats(n_functions)
+        profile = RequestProfile(
+            id=self.id,
+            method=self.method,
+            path=self.path,
+            route=self.route,
+            started_at=self.started_at,
+            status=status,
+            seconds=breakdown(stats, wall_seconds),
+            report=report.getvalue(),
+        )
+        self.buffer.add(profile)
+        return profile
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Print a token for profiling requests."
+    )
+    parser.add_argument(
+        "--ttl", type=int, default=600, help="Seconds until it expires."
+    )
+    args = parser.parse_args()
+    print(sign(os.environ["PROFILE_SECRET"], int(time.time()) + args.ttl))
+
+
+if __name__ == "__main__":
+    main()
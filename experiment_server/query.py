@@ -1,25 +1,244 @@
 import logging
-import pickle
+import random
 import sqlite3
-from typing import List, Optional, Sequence, Tuple
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import islice
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Final,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
 
 import numpy as np
 
-from experiment_server.type import DataModality, Question, QuestionAlgorithm, Trajectory
+from experiment_server.codec import (
+    decode_actions,
+    decode_state,
+    encode_actions,
+    encode_array,
+    encode_cstates,
+    encode_state,
+    is_encoded,
+    reencode,
+)
+from experiment_server.question_cache import QuestionCache
+from experiment_server.type import (
+    DataModality,
+    Question,
+    QuestionAlgorithm,
+    State,
+    Trajectory,
+)
+
+T = TypeVar("T")
+U = TypeVar("U")
+
+FIRE_TILE: Final[int] = 12
+
+# Content flags computed once per trajectory when it is inserted, so serving never scans grids.
+FLAG_COLUMNS: Final[Dict[str, str]] = {"has_fire": "INT", "tile_counts": "BLOB"}
+
+
+def trajectory_flags(start_state: State) -> Dict[str, Any]:
+    grid = np.asarray(start_state.grid).ravel()
+    return {
+        "has_fire": int(np.any(grid == FIRE_TILE)),
+        "tile_counts": encode_array(
+            np.bincount(grid.astype(np.int64)).astype(np.int32)
+        ),
+    }
+
+
+def add_missing_columns(
+    conn: sqlite3.Connection, table: str, columns: Dict[str, str]
+) -> bool:
+    """Adds any of the given columns that table doesn't have yet. Returns True if any were added."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    missing = [name for name in columns.keys() if name not in existing]
+    for name in missing:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {columns[name]}")
+    return len(missing) > 0
+
+
+def ensure_flag_columns(conn: sqlite3.Connection) -> None:
+    """Adds the content flag columns, and their index, to trajectory tables created before they existed.
+
+    This is a migration: call it once per connection on the write paths (compaction, bulk loads and
+    `manage.py backfill-flags`), never while serving.
+    """
+    add_missing_columns(conn, "trajectories", FLAG_COLUMNS)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS trajectories_has_fire ON trajectories(has_fire)"
+    )
+    conn.commit()
+
+
+def has_flag_columns(conn: sqlite3.Connection) -> bool:
+    existing = {row[1] for row in conn.execute("PRAGMA table_info(trajectories)")}
+    return all(name in existing for name in FLAG_COLUMNS)
+
+
+PoolKey = Tuple[str, Optional[DataModality], Optional[int]]
+
+
+class QuestionPool:
+    """Ids of the questions that can be served for each (env, modality, length) request.
+
+    Built with a single pass over the question bank when the database is loaded, so that sampling
+    questions doesn't need to join and sort every question on every request. A modality or length of
+    None matches questions of any modality or length, like in get_random_questions.
+
+    Questions where both trajectories contain fire are kept in a separate set of pools, so they can
+    be left out without any per-request filtering. The pool only reads conn. Questions whose
+    trajectories have no flags yet, because the database wasn't migrated or backfilled, can't be
+    shown to be safe, so they are left out of those pools and counted in `unflagged`, with a warning.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        pools: Dict[PoolKey, List[int]] = defaultdict(list)
+        safe_pools: Dict[PoolKey, List[int]] = defaultdict(list)
+        self.double_fire: Set[int] = set()
+        self.unflagged = 0
+        double_fire_column = (
+            "left.has_fire AND right.has_fire" if has_flag_columns(conn) else "NULL"
+        )
+        cursor = conn.execute(f"""
+SELECT
+    q.id,
+    q.env,
+    left.modality,
+    left.length,
+    right.modality,
+    right.length,
+    {double_fire_column} AS double_fire
+FROM
+    questions AS q
+    JOIN trajectories AS left ON
+        q.first_id=left.id
+    JOIN trajectories AS right ON
+        q.second_id=right.id
+    WHERE
+        left.env=q.env
+        AND right.env=q.env;""")
+        for (
+            id,
+            env,
+            left_modality,
+            left_length,
+            right_modality,
+            right_length,
+            double_fire,
+        ) in cursor:
+            modalities = (
+                (None, left_modality) if left_modality == right_modality else (None,)
+            )
+            lengths = (None, left_length) if left_length == right_length else (None,)
+            if double_fire is None:
+                self.unflagged += 1
+            elif double_fire:
+                self.double_fire.add(id)
+            for modality in modalities:
+                for length in lengths:
+                    pools[(env, modality, length)].append(id)
+                    if double_fire == 0:
+                        safe_pools[(env, modality, length)].append(id)
+        self.pools = {key: np.array(ids, dtype=np.int64) for key, ids in pools.items()}
+        self.safe_pools = {
+            key: np.array(ids, dtype=np.int64) for key, ids in safe_pools.items()
+        }
+        if self.unflagged > 0:
+            logging.warning(
+                f"{self.unflagged} questions have trajectories without content flags and are never "
+                "served when excluding double fire, run `manage.py backfill-flags`"
+            )
+
+    def sample(
+        self,
+        n_questions: int,
+        question_type: Optional[DataModality],
+        env: str,
+        length: Optional[int] = None,
+        exclude_ids: Optional[Sequence[int]] = None,
+        exclude_double_fire: bool = False,
+    ) -> List[int]:
+        pools = self.safe_pools if exclude_double_fire else self.pools
+        ids = pools.get((env, question_type, length))
+        if ids is None:
+            return []
+        exclude = set(exclude_ids) if exclude_ids is not None else set()
+        # random.sample only touches the indices it picks, so this is O(n) in the number of
+        # questions requested rather than in the size of the pool. Excluded ids are rejected after
+        # sampling, so draw enough extras to replace all of them.
+        n_draws = min(len(ids), n_questions + len(exclude))
+        sampled = (int(ids[i]) for i in random.sample(range(len(ids)), n_draws))
+        return [id for id in sampled if id not in exclude][:n_questions]
 
 
 def get_random_questions(
     conn: sqlite3.Connection,
     n_questions: int,
-    question_type: DataModality,
+    question_type: Optional[DataModality],
     env: str,
     length: Optional[int] = None,
     exclude_ids: Optional[Sequence[int]] = None,
+    pool: Optional[QuestionPool] = None,
+    cache: Optional[QuestionCache] = None,
+    exclude_double_fire: bool = False,
+    snapshot: Optional[int] = None,
 ) -> List[Question]:
-    if exclude_ids is None:
-        exclude_ids = []
-    excl_list = ", ".join(f":excl_{i}" for i in range(len(exclude_ids)))
-    excl_values = {f"excl_{i}": id for i, id in enumerate(exclude_ids)}
+    """Samples up to n_questions questions matching the request.
+
+    pool, conn and snapshot (the cache key) should all come from the same database snapshot. Fewer
+    questions are returned if there aren't enough to sample from, or if a sampled question is
+    missing from conn, rather than failing the request.
+    """
+    if pool is None:
+        pool = QuestionPool(conn)
+    ids = pool.sample(
+        n_questions=n_questions,
+        question_type=question_type,
+        env=env,
+        length=length,
+        exclude_ids=exclude_ids,
+        exclude_double_fire=exclude_double_fire,
+    )
+    if len(double_fire := pool.double_fire.intersection(ids)) > 0:
+        logging.warning(
+            f"Both trajectories have a fire in them in questions {double_fire}"
+        )
+    questions = (
+        cache.get_many(ids, lambda missing: get_questions(conn, missing), snapshot)
+        if cache is not None
+        else get_questions(conn, ids)
+    )
+    if len(questions) < n_questions:
+        missing_ids = set(ids) - {question.id for question in questions}
+        logging.warning(
+            f"Returning {len(questions)} of {n_questions} questions requested for "
+            f"{(env, question_type, length)}, sampled ids missing from the database: {missing_ids}"
+        )
+    return questions
+
+
+def get_questions(conn: sqlite3.Connection, ids: Sequence[int]) -> List[Question]:
+    """Returns the questions with the given ids, in the same order."""
+    if len(ids) == 0:
+        return []
+    id_list = ", ".join(f":id_{i}" for i in range(len(ids)))
+    values = {f"id_{i}": id for i, id in enumerate(ids)}
     query_s = f"""
 SELECT
     q.*,
@@ -27,36 +246,22 @@ SELECT
     left.actions AS left_actions,
     left.length AS left_length,
     left.modality AS left_modality,
-    left.reason as left_reason,
     right.start_state AS right_start,
     right.actions AS right_actions,
     right.length AS right_length,
-    right.modality AS right_modality,
-    right.reason as right_reason
+    right.modality AS right_modality
 FROM 
-    (SELECT * FROM questions {f"WHERE questions.id NOT IN ({excl_list})" if len(excl_list) > 0 else ""}) AS q
+    questions AS q
     LEFT JOIN trajectories AS left ON
         q.first_id=left.id
     LEFT JOIN trajectories AS right ON
         q.second_id=right.id
     WHERE
-        {"left.length=:length AND right.length=:length AND" if length is not None else ""}
-        {"left.modality=:question_type AND right.modality=:question_type AND" if question_type is not None else ""}
-        q.env=:env
-        AND left.env=:env
-        AND right.env=:env 
-    ORDER BY RANDOM() LIMIT :n_questions;"""
-    values = {
-        "question_type": question_type,
-        "length": length,
-        "env": env,
-        "n_questions": n_questions,
-        **excl_values,
-    }
+        q.id IN ({id_list});"""
     logging.debug(f"Querying:\n{query_s}\nwith values:\n{values}")
 
     cursor = conn.execute(query_s, values)
-    questions = []
+    questions: Dict[int, Question] = {}
     for (
         id,
         first_id,
@@ -68,119 +273,77 @@ FROM
         left_actions,
         left_length,
         left_modality,
-        left_reason,
         right_start,
         right_actions,
         right_length,
         right_modality,
-        right_reason,
     ) in cursor:
-        questions.append(
-            Question(
-                id=id,
-                trajs=(
-                    Trajectory(
-                        start_state=pickle.loads(left_start),
-                        actions=pickle.loads(left_actions),
-                        env_name=env,
-                        modality=left_modality,
-                    ),
-                    Trajectory(
-                        start_state=pickle.loads(right_start),
-                        actions=pickle.loads(right_actions),
-                        env_name=env,
-                        modality=right_modality,
-                    ),
+        questions[id] = Question(
+            id=id,
+            trajs=(
+                Trajectory(
+                    start_state=decode_state(left_start),
+                    actions=decode_actions(left_actions),
+                    env_name=env,
+                    modality=left_modality,
                 ),
-            )
+                Trajectory(
+                    start_state=decode_state(right_start),
+                    actions=decode_actions(right_actions),
+                    env_name=env,
+                    modality=right_modality,
+                ),
+            ),
         )
-        if np.any(questions[-1].trajs[0].start_state.grid == 12) and np.any(
-            questions[-1].trajs[1].start_state.grid == 12
-        ):
-            logging.warning(
-                f"Both questions have a fire in them. Reasons: {left_reason}, {right_reason}"
-            )
-    assert len(questions) == n_questions
-    return questions
+    return [questions[id] for id in ids if id in questions]
 
 
-def get_named_question(conn: sqlite3.Connection, name: str) -> Question:
-    query_s = """
-SELECT
-    q.*,
-    left.start_state AS left_start,
-    left.actions AS left_actions,
-    left.length AS left_length,
-    left.modality AS left_modality,
-    right.start_state AS right_start,
-    right.actions AS right_actions,
-    right.length AS right_length,
-    right.modality AS right_modality
-FROM 
-    questions AS q
-    LEFT JOIN trajectories AS left ON
-        q.first_id=left.id
-    LEFT JOIN trajectories AS right ON
-        q.second_id=right.id
-    WHERE
-        q.label=:name
-    ORDER BY RANDOM() LIMIT 1;"""
+def get_named_question(
+    conn: sqlite3.Connection,
+    name: str,
+    cache: Optional[QuestionCache] = None,
+    snapshot: Optional[int] = None,
+) -> Question:
+    query_s = "SELECT id FROM questions WHERE label=:name ORDER BY RANDOM() LIMIT 1;"
     values = {"name": name}
     logging.debug(f"Querying:\n{query_s}\nwith values:\n{values}")
 
-    cursor = conn.execute(query_s, values)
-    (
-        id,
-        first_id,
-        second_id,
-        algorithm,
-        env,
-        question_name,
-        left_start,
-        left_actions,
-        left_length,
-        left_modality,
-        right_start,
-        right_actions,
-        right_length,
-        right_modality,
-    ) = next(cursor)
-    return Question(
-        id=id,
-        trajs=(
-            Trajectory(
-                start_state=pickle.loads(left_start),
-                actions=pickle.loads(left_actions),
-                env_name=env,
-                modality=left_modality,
-            ),
-            Trajectory(
-                start_state=pickle.loads(right_start),
-                actions=pickle.loads(right_actions),
-                env_name=env,
-                modality=right_modality,
-            ),
-        ),
-    )
+    (id,) = next(conn.execute(query_s, values))
+    if cache is not None:
+        (question,) = cache.get_many(
+            [id], lambda missing: get_questions(conn, missing), snapshot
+        )
+    else:
+        (question,) = get_questions(conn, [id])
+    return question
 
 
-def insert_traj(conn: sqlite3.Connection, traj: Trajectory) -> int:
-    # TODO: Swap pickle for dill
-    cursor = conn.execute(
-        "INSERT INTO trajectories (start_state, actions, length, env, modality, reason, cstates) VALUES (:start_state, :actions, :length, :env, :modality, :reason, :cstates)",
-        {
-            "start_state": pickle.dumps(traj.start_state),
-            "actions": pickle.dumps(traj.actions),
-            "length": len(traj.actions) if traj.actions is not None else 0,
-            "env": traj.env_name,
-            "modality": traj.modality,
-            "reason": traj.reason,
-            "cstates": pickle.dumps(traj.cstates),
-        },
-    )
+def traj_row(traj: Trajectory) -> Dict[str, Any]:
+    """Encodes traj as a row of the trajectories table."""
+    return {
+        "start_state": encode_state(traj.start_state),
+        "actions": encode_actions(traj.actions),
+        "length": len(traj.actions) if traj.actions is not None else 0,
+        "env": traj.env_name,
+        "modality": traj.modality,
+        "reason": traj.reason,
+        "cstates": encode_cstates(traj.cstates),
+        **trajectory_flags(traj.start_state),
+    }
+
+
+INSERT_TRAJ: Final[str] = (
+    "INSERT INTO trajectories (id, start_state, actions, length, env, modality, reason, cstates, has_fire, tile_counts) VALUES (:id, :start_state, :actions, :length, :env, :modality, :reason, :cstates, :has_fire, :tile_counts)"
+)
+
+
+def insert_traj(conn: sqlite3.Connection, traj: Trajectory, commit: bool = True) -> int:
+    """Inserts traj, returning its id. The table needs the flag columns, see ensure_flag_columns."""
+    cursor = conn.execute(INSERT_TRAJ, {"id": None, **traj_row(traj)})
     assert cursor.lastrowid is not None
     out = int(cursor.lastrowid)
-    conn.commit()
+    if commit:
+        conn.commit()
     return out
 
 
@@ -190,6 +353,7 @@ def insert_question(
     algo: QuestionAlgorithm,
     env_name: str,
     label: Optional[str] = None,
+    commit: bool = True,
 ) -> int:
     label_schema = ", label" if label is not None else ""
     label_value = ", :label" if label is not None else ""
@@ -206,18 +370,163 @@ def insert_question(
     cursor = conn.execute(query, values)
     assert cursor.lastrowid is not None
     out = int(cursor.lastrowid)
-    conn.commit()
+    if commit:
+        conn.commit()
     return out
 
 
 def save_questions(
     conn: sqlite3.Connection,
-    questions: Sequence[Tuple[Trajectory, Trajectory]],
+    questions: Iterable[Tuple[Trajectory, Trajectory]],
     algo: QuestionAlgorithm,
     env_name: str,
 ) -> None:
-    for traj_1, traj_2 in questions:
-        traj_1_id = insert_traj(conn, traj_1)
-        traj_2_id = insert_traj(conn, traj_2)
-        insert_question(conn, (traj_1_id, traj_2_id), algo, env_name)
+    bulk_save_questions(conn, questions, algo, env_name)
+
+
+def encode_question_chunk(
+    chunk: List[Tuple[Trajectory, Trajectory]],
+) -> List[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    return [(traj_row(traj_1), traj_row(traj_2)) for traj_1, traj_2 in chunk]
+
+
+def bounded_map(
+    pool: Executor, func: Callable[[T], U], items: Iterable[T], prefetch: int
+) -> Iterator[U]:
+    """Like pool.map, but only reads up to prefetch items ahead of the results consumed so far."""
+    futures: Deque[Future] = deque()
+    for item in items:
+        futures.append(pool.submit(func, item))
+        if len(futures) >= prefetch:
+            yield futures.popleft().result()
+    while len(futures) > 0:
+        yield futures.popleft().result()
+
+
+def insert_question_chunk(
+    conn: sqlite3.Connection,
+    rows: List[Tuple[Dict[str, Any], Dict[str, Any]]],
+    algo: QuestionAlgorithm,
+    env_name: str,
+) -> None:
+    """Inserts encoded pairs of trajectories and a question for each pair, in one transaction."""
+    with conn:
+        # Take the write lock before choosing ids, so nobody else can insert trajectories in between.
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        (last_id,) = conn.execute(
+            "SELECT COALESCE(MAX(id), 0) FROM trajectories"
+        ).fetchone()
+        conn.executemany(
+            INSERT_TRAJ,
+            (
+                {"id": last_id + 1 + i, **row}
+                for i, row in enumerate(row for pair in rows for row in pair)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO questions (first_id, second_id, algorithm, env) VALUES (?, ?, ?, ?)",
+            (
+                (last_id + 1 + 2 * i, last_id + 2 + 2 * i, algo, env_name)
+                for i in range(len(rows))
+            ),
+        )
+
+
+def bulk_save_questions(
+    conn: sqlite3.Connection,
+    questions: Iterable[Tuple[Trajectory, Trajectory]],
+    algo: QuestionAlgorithm,
+    env_name: str,
+    chunk_size: int = 1000,
+    workers: int = 1,
+) -> int:
+    """Saves a stream of trajectory pairs as questions.
+
+    Pairs are read from questions chunk_size at a time. Each chunk is encoded and inserted with
+    executemany in a single transaction. By default chunks are encoded in this process; with more
+    than one worker, a pool of that many processes encodes the chunks after the one being
+    inserted (see benchmarks/bench_save_questions.py for when that pays off). Progress and
+    throughput are logged after every chunk. Returns the number of questions saved.
+    """
+    ensure_flag_columns(conn)
     conn.commit()
+
+    pairs = iter(questions)
+    chunks = iter(lambda: list(islice(pairs, chunk_size)), [])
+
+    start = time.perf_counter()
+    n_saved = 0
+    with ProcessPoolExecutor(workers) if workers > 1 else nullcontext() as pool:
+        encoded = (
+            bounded_map(pool, encode_question_chunk, chunks, prefetch=2 * workers)
+            if pool is not None
+            else map(encode_question_chunk, chunks)
+        )
+        for rows in encoded:
+            insert_question_chunk(conn, rows, algo, env_name)
+            n_saved += len(rows)
+            elapsed = time.perf_counter() - start
+            logging.info(
+                f"Saved {n_saved} questions in {elapsed:.1f}s ({n_saved / elapsed:.0f} questions/s)"
+            )
+    return n_saved
+
+
+def migrate_blobs(conn: sqlite3.Connection, batch_size: int = 1000) -> int:
+    """Rewrites every pickled trajectory blob in the codec format, in one transaction.
+
+    Returns the number of rows rewritten.
+    """
+    n_migrated = 0
+    last_id = -1
+    with conn:
+        while True:
+            rows = conn.execute(
+                "SELECT id, start_state, actions, cstates FROM trajectories WHERE id > :last_id ORDER BY id LIMIT :batch_size",
+                {"last_id": last_id, "batch_size": batch_size},
+            ).fetchall()
+            if len(rows) == 0:
+                break
+            updates = []
+            for id, start_state, actions, cstates in rows:
+                last_id = id
+                if (
+                    is_encoded(start_state)
+                    and is_encoded(actions)
+                    and (cstates is None or is_encoded(cstates))
+                ):
+                    continue
+                updates.append((*reencode(start_state, actions, cstates), id))
+            conn.executemany(
+                "UPDATE trajectories SET start_state=?, actions=?, cstates=? WHERE id=?",
+                updates,
+            )
+            n_migrated += len(updates)
+    return n_migrated
+
+
+def backfill_flags(conn: sqlite3.Connection, batch_size: int = 1000) -> int:
+    """Computes the content flags of trajectories inserted before flags existed.
+
+    Returns the number of rows updated.
+    """
+    ensure_flag_columns(conn)
+    n_updated = 0
+    with conn:
+        while True:
+            rows = conn.execute(
+                "SELECT id, start_state FROM trajectories WHERE has_fire IS NULL LIMIT :batch_size",
+                {"batch_size": batch_size},
+            ).fetchall()
+            if len(rows) == 0:
+                break
+            conn.executemany(
+                "UPDATE trajectories SET has_fire=:has_fire, tile_counts=:tile_counts WHERE id=:id",
+                [
+                    {"id": id, **trajectory_flags(decode_state(start_state))}
+                    for id, start_state in rows
+                ],
+            )
+            n_updated += len(rows)
+    return n_updated
@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence
+
+from experiment_server.type import Question
+
+
+class QuestionCache:
+    """Bounded LRU cache of fully decoded questions, keyed by question id.
+
+    Questions don't change between writes to the question database, so the cache is only cleared
+    when `sync` sees a newer database snapshot. Lookups from a request still reading an older
+    snapshot pass that snapshot and bypass the cache. Alongside each question the cache keeps its
+    serialized response fragments, so a question is only encoded once per format.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.snapshot = -1
+        self.hits = 0
+        self.misses = 0
+        self._questions: OrderedDict[int, Question] = OrderedDict()
+        self._payloads: Dict[int, Dict[str, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._questions)
+
+    def sync(self, snapshot: int) -> bool:
+        """Clears the cache if it was filled from an older database snapshot. Returns True if cleared."""
+        with self._lock:
+            if snapshot <= self.snapshot:
+                return False
+            self._questions.clear()
+            self._payloads.clear()
+            self.snapshot = snapshot
+            return True
+
+    def get_many(
+        self,
+        ids: Sequence[int],
+        load: Callable[[Sequence[int]], List[Question]],
+        snapshot: Optional[int] = None,
+    ) -> List[Question]:
+        """Returns the questions with the given ids in order, calling load once for any not in the cache.
+
+        If snapshot is given and isn't the one the cache holds, everything is loaded and nothing kept.
+        """
+        if snapshot is not None and snapshot != self.snapshot:
+            return load(ids)
+        found: Dict[int, Question] = {}
+        missing: List[int] = []
+        with self._lock:
+            for id in ids:
+                if (question := self._questions.get(id)) is not None:
+                    self._questions.move_to_end(id)
+                    found[id] = question
+                    self.hits += 1
+                else:
+                    missing.append(id)
+                    self.misses += 1
+
+        if len(missing) > 0:
+            loaded = load(missing)
+            with self._lock:
+                for question in loaded:
+                    found[question.id] = question
+                    if snapshot is not None and snapshot != self.snapshot:
+                        continue
+                    self._questions[question.id] = question
+                    self._questions.move_to_end(question.id)
+                while len(self._questions) > self.maxsize:
+                    evicted, _ = self._questions.popitem(last=False)
+                    self._payloads.pop(evicted, None)
+
+        return [found[id] for id in ids if id in found]
+
+    def payloads(
+        self,
+        questions: Sequence[Question],
+        encode: Callable[[Question], bytes],
+        format: str = "json",
+    ) -> List[bytes]:
+        """Returns each question serialized with encode, reusing earlier serializations of cached questions."""
+        out = []
+        for question in questions:
+            payload = self._payloads.get(question.id, {}).get(format)
+            if payload is None:
+                payload = encode(question)
+                with self._lock:
+                    # Only keep payloads for questions that are still cached, so eviction frees both.
+                    if question.id in self._questions:
+                        self._payloads.setdefault(question.id, {})[format] = payload
+            out.append(payload)
+        return out
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._questions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
@@ -1,72 +1,378 @@
 # Mostly copied from https://pypi.org/project/remote-sqlite/ but accepts a filesystem, to make tracking s3 queries easier.
 
+import hashlib
+import logging
+import os
+import random
 import sqlite3
+import threading
+import time
+import uuid
+from itertools import groupby
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    BinaryIO,
+    Hashable,
+    Iterable,
+    Iterator,
+    Mapping,
+    Optional,
+    Tuple,
+    TypeVar,
+)
 
+import botocore.exceptions
 import fs
 import fs.base
 import fs.copy
+import fs.path
+from fs_s3fs import S3FS
+
+T = TypeVar("T")
+
+
+class PushConflict(Exception):
+    """The remote database changed since it was pulled, so pushing would overwrite someone else's changes."""
+
+
+class Snapshot:
+    """One version of the local copy of a RemoteSqlite: a connection to it and values derived from it.
+
+    Everything read through a snapshot comes from the same version, even if the copy is replaced
+    while it is in use, so a request that takes one snapshot never mixes ids from two versions.
+    """
+
+    def __init__(
+        self,
+        id: int,
+        con: sqlite3.Connection,
+        derived: Dict[str, Any],
+        lock: threading.RLock,
+    ):
+        self.id = id
+        self.con = con
+        self._derived = derived
+        self._lock = lock
+
+    def derived(self, name: str, factory: Callable[[sqlite3.Connection], T]) -> T:
+        """Returns a value computed from this snapshot by factory, computing it the first time."""
+        with self._lock:
+            if name not in self._derived:
+                self._derived[name] = factory(self.con)
+            return self._derived[name]
 
 
 class RemoteSqlite:
-    def __init__(self, remote_fs: fs.base.FS, filename: str, always_download=False):
+    """A local copy of a sqlite database stored on a (possibly remote) filesystem.
+
+    The local copy and its connection are kept open across calls. `refresh` only re-downloads the
+    database when the remote object has changed (by ETag, or modification time and size for
+    filesystems without ETags), and checks the remote at most once every `max_age` seconds.
+
+    Pushes are optimistic: `push` refuses to upload if the remote changed since the last pull, and
+    `transaction` retries a write against a fresh copy until it can be pushed without conflict. On
+    s3 the upload itself is conditional on the pulled ETag, so a push can't overwrite one that
+    landed after the check.
+
+    Every instance keeps its own local copy, so workers sharing local_dir never upload each other's
+    changes. Replacing the copy doesn't close the connection to the old one: callers holding `con`
+    keep reading the old snapshot until they drop it, and the old connection is closed then.
+
+    Readers should take a `view`, which pairs a connection with the snapshot it reads and the values
+    derived from that snapshot, rather than reading `snapshot`, `reader()` and `derived()` separately.
+    """
+
+    def __init__(
+        self,
+        remote_fs: fs.base.FS,
+        filename: str,
+        always_download=False,
+        max_age: float = 0.0,
+        local_dir: str = "osfs:///tmp",
+    ):
         self.fsfilename = filename
         self.remote_fs = remote_fs
-        self.temp_fs = fs.open_fs("osfs:///tmp")
-        self.localpath = self.pull(always_download)
-        self.con = sqlite3.connect(self.localpath, detect_types=sqlite3.PARSE_DECLTYPES)
-        self.con.row_factory = sqlite3.Row
+        self.temp_fs = fs.open_fs(local_dir)
+        self.max_age = max_age
+
+        # Remote version the local copy was downloaded from, and a counter that changes every time
+        # the local copy is replaced, so callers can invalidate anything derived from the old copy.
+        self.version: Optional[Hashable] = None
+        self.snapshot = 0
+        self.checked_at = float("-inf")
+        self._derived: Dict[str, Any] = {}
+
+        self.pushes = 0
+        self.conflicts = 0
+        self.retries = 0
+
+        self._lock = threading.RLock()
+        self._readers = threading.local()
+        self._connected = False
+        self.localname = (
+            f"{os.getpid()}.{uuid.uuid4().hex}.{fs.path.basename(self.fsfilename)}"
+        )
+        self.localpath = self.temp_fs.getsyspath(self.localname)
+        self.pull(always_download)
 
     def __del__(self):
-        self.con.close()
+        self.close()
+
+    def close(self) -> None:
+        """Closes the connection and deletes the local copy. The next pull downloads it again."""
+        if getattr(self, "_connected", False):
+            self.con.close()
+            self._connected = False
+        if hasattr(self, "localpath") and os.path.exists(self.localpath):
+            os.remove(self.localpath)
+
+    def _open(self) -> sqlite3.Connection:
+        con = sqlite3.connect(
+            self.localpath,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+        )
+        con.row_factory = sqlite3.Row
+        return con
+
+    def connect(self) -> None:
+        # The previous connection is left to be closed when its last user drops it, see the class
+        # docstring. It still reads the file it opened, which os.replace unlinked rather than changed.
+        self._connected = True
+        self.con = self._open()
+
+    def reader(self) -> sqlite3.Connection:
+        """A read-only connection to the current snapshot for the calling thread alone.
+
+        Threads sharing `con` serialize on it and see each other's transactions, so code reading
+        from several threads at once, like the ASGI app's storage pool, should use this instead.
+        """
+        readers = self._readers
+        with self._lock:
+            if getattr(readers, "snapshot", None) != self.snapshot:
+                readers.con = self._open()
+                readers.con.execute("PRAGMA query_only = ON")
+                readers.snapshot = self.snapshot
+            return readers.con
+
+    def view(self) -> Snapshot:
+        """The current snapshot, read through the calling thread's connection (see `reader`)."""
+        with self._lock:
+            return Snapshot(self.snapshot, self.reader(), self._derived, self._lock)
+
+    def derived(self, name: str, factory: Callable[[sqlite3.Connection], T]) -> T:
+        """Returns a value computed from the current snapshot, computing it if the snapshot changed."""
+        return self.view().derived(name, factory)
+
+    def invalidate(self) -> None:
+        """Marks the local copy as changed, dropping everything derived from the old contents."""
+        with self._lock:
+            self.snapshot += 1
+            # A new dict rather than clearing the old one, which snapshots still in use refer to.
+            self._derived = {}
+
+    def remote_version(self) -> Hashable:
+        info = self.remote_fs.getinfo(self.fsfilename, namespaces=["details", "s3"])
+        if (etag := info.get("s3", "e_tag")) is not None:
+            return etag
+        return (info.modified, info.size)
+
+    def refresh(self) -> bool:
+        """Re-download the database if the remote copy changed and the local copy is older than max_age.
+
+        Returns True if the local copy was replaced.
+        """
+        with self._lock:
+            if time.monotonic() - self.checked_at < self.max_age:
+                return False
+            snapshot = self.snapshot
+            self.pull()
+            return self.snapshot != snapshot
 
     def pull(self, always_download=False):
-        if always_download:
-            fs.copy.copy_file(
-                self.remote_fs, self.fsfilename, self.temp_fs, self.fsfilename
-            )
-        else:
-            fs.copy.copy_file_if_newer(
-                self.remote_fs, self.fsfilename, self.temp_fs, self.fsfilename
-            )
-        return self.temp_fs.getsyspath(self.fsfilename)
+        with self._lock:
+            remote_version = self.remote_version()
+            if (
+                always_download
+                or remote_version != self.version
+                or not os.path.exists(self.localpath)
+            ):
+                # Download next to the live copy and swap it in, so connections to the old copy
+                # never see a partially written database.
+                tmp_name = f"{self.localname}.download"
+                fs.copy.copy_file(
+                    self.remote_fs, self.fsfilename, self.temp_fs, tmp_name
+                )
+                os.replace(self.temp_fs.getsyspath(tmp_name), self.localpath)
+                self.version = remote_version
+                self.invalidate()
+                self.connect()
+            elif not self._connected:
+                self.connect()
+            self.checked_at = time.monotonic()
+        return self.localpath
 
     def push(self, always_upload=False):
-        if always_upload:
-            fs.copy.copy_file(
-                self.temp_fs, self.fsfilename, self.remote_fs, self.fsfilename
-            )
-        else:
-            fs.copy.copy_file_if_newer(
-                self.temp_fs, self.fsfilename, self.remote_fs, self.fsfilename
-            )
+        """Uploads the local copy, raising PushConflict if the remote changed since it was pulled.
+
+        On s3 the upload is a PUT with If-Match set to the pulled ETag, so checking and uploading
+        are one atomic request, and the new version is the ETag that PUT returns. Other filesystems
+        check and upload separately, and only keep the new version if the remote still holds our
+        contents afterwards: a push landing in between is downloaded by the next pull, and makes
+        the next push conflict, rather than being mistaken for ours.
+        """
+        with self._lock:
+            if not always_upload and self.remote_version() != self.version:
+                self.conflicts += 1
+                raise PushConflict(
+                    f"{self.fsfilename} changed on the remote since it was pulled"
+                )
+            if isinstance(self.remote_fs, S3FS):
+                version = self._put_s3(None if always_upload else self.version)
+            else:
+                fs.copy.copy_file(
+                    self.temp_fs, self.localname, self.remote_fs, self.fsfilename
+                )
+                version = self._uploaded_version()
+            self.pushes += 1
+            # If the remote matches our local copy, don't download it again on the next refresh.
+            self.version = version
+            self.invalidate()
+
+    def _put_s3(self, if_match: Optional[Hashable]) -> str:
+        s3 = self.remote_fs
+        assert isinstance(s3, S3FS)
+        args = {"Bucket": s3._bucket_name, "Key": s3._path_to_key(self.fsfilename)}
+        if if_match is not None:
+            args["IfMatch"] = if_match
+        try:
+            with open(self.localpath, "rb") as f:
+                response = s3.client.put_object(Body=f, **args)
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] in (
+                "PreconditionFailed",
+                "ConditionalRequestConflict",
+            ):
+                self.conflicts += 1
+                raise PushConflict(
+                    f"{self.fsfilename} changed on the remote while it was pushed"
+                ) from e
+            raise
+        return response["ETag"]
+
+    def _uploaded_version(self) -> Optional[Hashable]:
+        """The remote's version if it has the contents of the local copy, otherwise None."""
+        # Read the version first: if another push lands after it, the contents won't match.
+        version = self.remote_version()
+        with self.remote_fs.openbin(self.fsfilename) as remote, open(
+            self.localpath, "rb"
+        ) as local:
+            if digest(remote) != digest(local):
+                logging.warning(
+                    f"{self.fsfilename} changed on the remote right after it was pushed"
+                )
+                return None
+        return version
+
+    def transaction(
+        self,
+        apply: Callable[[sqlite3.Connection], T],
+        max_attempts: int = 5,
+        backoff: float = 0.1,
+    ) -> T:
+        """Applies a write to the latest remote copy and pushes it, retrying on conflicts.
+
+        apply may be called several times, each time against a freshly pulled copy, so it should do
+        all of its writes through the connection it is given.
+        """
+        with self._lock:
+            for attempt in range(max_attempts):
+                # Throw away local changes from a failed attempt along with the stale copy.
+                self.pull(always_download=attempt > 0)
+                out = apply(self.con)
+                try:
+                    self.push()
+                    return out
+                except PushConflict:
+                    if attempt == max_attempts - 1:
+                        raise
+                    self.retries += 1
+                    delay = backoff * 2**attempt * (1 + random.random())
+                    logging.warning(
+                        f"Conflict pushing {self.fsfilename}, retrying in {delay:.2f}s"
+                    )
+                    time.sleep(delay)
+        raise AssertionError("unreachable")
 
     def get_count(self, tbl_name):
         return self.select(f"""SELECT COUNT(*) FROM `{tbl_name}`""")[0]["COUNT(*)"]
 
     def get_counts(self):
-        tables = self.select(
-            """SELECT tbl_name FROM sqlite_master WHERE type='table'"""
+        """Counts the rows of every table with a single query."""
+        # One connection for both queries, in case the local copy is replaced in between.
+        con = self.con
+        tables = [
+            row["tbl_name"]
+            for row in self._select(
+                con, """SELECT tbl_name FROM sqlite_master WHERE type='table'"""
+            )
+        ]
+        if len(tables) == 0:
+            return []
+        counts = dict(
+            con.execute(
+                " UNION ALL ".join(
+                    f'SELECT ?, COUNT(*) FROM "{tbl_name}"' for tbl_name in tables
+                ),
+                tables,
+            ).fetchall()
         )
-        return [{t["tbl_name"]: self.get_count(t["tbl_name"])} for t in tables]
+        return [{tbl_name: counts[tbl_name]} for tbl_name in tables]
 
     def select(self, select_statement="SELECT * FROM sqlite_master"):
-        cur = self.con.cursor()
+        return self._select(self.con, select_statement)
+
+    @staticmethod
+    def _select(con: sqlite3.Connection, select_statement: str):
+        cur = con.cursor()
         cur.execute(select_statement)
         records = [dict(row) for row in cur.fetchall()]
         return records
 
-    def insert(self, tbl_name, records):
-        cur = self.con.cursor()
-        for record in records:
-            field_names = ",".join([f'"{k}"' for k in record.keys()])
-            placeholders = ",".join(["?" for k in record.keys()])
-            insert_statement = (
-                f'INSERT INTO "{tbl_name}" ({field_names}) VALUES ({placeholders})'
-            )
-            values = tuple(record.values())
-            cur.execute(insert_statement, values)
-        self.con.commit()
+    def insert(self, tbl_name: str, records: Iterable[Mapping[str, Any]]) -> int:
+        """Inserts records, which can be any iterable of dicts, in one transaction.
+
+        Consecutive records with the same columns are inserted with a single executemany, so records
+        are streamed rather than collected first. Returns the number of records inserted.
+        """
+        statements: Dict[Tuple[str, ...], str] = {}
+        n_inserted = 0
+
+        def values(run: Iterable[Mapping[str, Any]]) -> Iterator[Tuple[Any, ...]]:
+            nonlocal n_inserted
+            for record in run:
+                n_inserted += 1
+                yield tuple(record.values())
+
+        with self._lock, self.con:
+            for columns, run in groupby(records, key=lambda r: tuple(r.keys())):
+                if (statement := statements.get(columns)) is None:
+                    field_names = ",".join([f'"{k}"' for k in columns])
+                    placeholders = ",".join(["?" for _ in columns])
+                    statement = f'INSERT INTO "{tbl_name}" ({field_names}) VALUES ({placeholders})'
+                    statements[columns] = statement
+                self.con.executemany(statement, values(run))
+        return n_inserted
 
     def generate_create_table(self, tbl_name, records):
         columns = ", ".join([f'"{k}" TEXT' for k in records[0].keys()])
         return f'CREATE TABLE "{tbl_name}" ({columns})'
+
+
+def digest(f: BinaryIO) -> bytes:
+    h = hashlib.blake2b()
+    while chunk := f.read(1 << 20):
+        h.update(chunk)
+    return h.digest()
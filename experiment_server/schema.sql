@@ -6,7 +6,9 @@ CREATE TABLE IF NOT EXISTS trajectories(
   env TEXT NOT NULL,
   modality TEXT NOT NULL,
   reason TEXT,
-  cstates BLOB
+  cstates BLOB,
+  has_fire INT,
+  tile_counts BLOB
 );
 CREATE TABLE IF NOT EXISTS questions(
   id INTEGER PRIMARY KEY,
@@ -18,9 +20,15 @@ CREATE TABLE IF NOT EXISTS questions(
 );
 CREATE TABLE IF NOT EXISTS users(
   id INTEGER PRIMARY KEY,
-  site_sequence INT NOT NULL,
-  demographics BLOB NOT NULL,
-  payment_code TEXT NOT NULL UNIQUE
+  site_sequence INT NOT NULL DEFAULT 0,
+  demographics BLOB NOT NULL DEFAULT '{}',
+  payment_code TEXT NOT NULL UNIQUE,
+  interact_start TEXT,
+  interact_end TEXT
+);
+CREATE TABLE IF NOT EXISTS user_ids(
+  id INTEGER PRIMARY KEY,
+  allocated_at TEXT NOT NULL
 );
 CREATE TABLE IF NOT EXISTS answers(
   id INTEGER PRIMARY KEY,
@@ -28,5 +36,13 @@ CREATE TABLE IF NOT EXISTS answers(
   question_id INT NOT NULL,
   answer INT NOT NULL,
   start_time TEXT NOT NULL,
-  end_time TEXT NOT NULL
+  end_time TEXT NOT NULL,
+  max_steps_left INT,
+  max_steps_right INT
+);
+CREATE INDEX IF NOT EXISTS answers_user_id ON answers(user_id);
+CREATE TABLE IF NOT EXISTS answer_batches(
+  user_id INT NOT NULL,
+  key TEXT NOT NULL,
+  PRIMARY KEY (user_id, key)
 );
\ No newline at end of file
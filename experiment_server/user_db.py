@@ -0,0 +1,175 @@
+import logging
+import re
+import sqlite3
+from pathlib import Path
+from typing import Optional, Sequence
+
+import fs.base
+
+from experiment_server.query import add_missing_columns
+from experiment_server.type import Answer, User
+from experiment_server.user_file import read_user
+
+SCHEMA_PATH = Path(__file__).parent / "schema.sql"
+
+USER_COLUMNS = {"interact_start": "TEXT", "interact_end": "TEXT"}
+ANSWER_COLUMNS = {"max_steps_left": "INT", "max_steps_right": "INT"}
+
+
+def connect_user_db(
+    path: str, create: bool = False, check_same_thread: bool = True
+) -> sqlite3.Connection:
+    """Opens the participant database, creating or upgrading the users and answers tables if create is set."""
+    conn = sqlite3.connect(path, timeout=30.0, check_same_thread=check_same_thread)
+    if create:
+        # WAL lets every gunicorn worker read while one of them writes.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA_PATH.read_text())
+        add_missing_columns(conn, "users", USER_COLUMNS)
+        add_missing_columns(conn, "answers", ANSWER_COLUMNS)
+        conn.commit()
+    return conn
+
+
+def find_user_by_payment_code(
+    conn: sqlite3.Connection, payment_code: str
+) -> Optional[int]:
+    row = conn.execute(
+        "SELECT id FROM users WHERE payment_code=:payment_code",
+        {"payment_code": payment_code},
+    ).fetchone()
+    return int(row[0]) if row is not None else None
+
+
+class UserDatabase:
+    """Participant storage in the users and answers tables, with the same interface as UserFile."""
+
+    def __init__(self, conn: sqlite3.Connection, user_id: int, payment_code: str):
+        self.conn = conn
+        self.user_id = user_id
+
+        self.create_user(payment_code)
+        self.check_user(payment_code)
+
+    def create(self) -> None:
+        """The user row is already inserted when this is constructed."""
+
+    def create_user(self, payment_code: str) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO users (id, site_sequence, demographics, payment_code) VALUES (:id, 0, '{}', :payment_code)",
+                {"id": self.user_id, "payment_code": payment_code},
+            )
+
+    def check_user(self, payment_code: str) -> None:
+        row = self.conn.execute(
+            "SELECT payment_code FROM users WHERE id=:id", {"id": self.user_id}
+        ).fetchone()
+        if row is None:
+            raise ValueError("User ID mismatch")
+        if row[0] != payment_code:
+            raise ValueError("Payment code mismatch")
+
+    def get(self) -> User:
+        payment_code, interact_start, interact_end = self.conn.execute(
+            "SELECT payment_code, interact_start, interact_end FROM users WHERE id=:id",
+            {"id": self.user_id},
+        ).fetchone()
+        responses = [
+            Answer(
+                question_id=question_id,
+                answer=bool(answer),
+                start_time=start_time,
+                end_time=end_time,
+                max_steps=(max_steps_left, max_steps_right),
+            )
+            for question_id, answer, start_time, end_time, max_steps_left, max_steps_right in self.conn.execute(
+                "SELECT question_id, answer, start_time, end_time, max_steps_left, max_steps_right FROM answers WHERE user_id=:id ORDER BY id",
+                {"id": self.user_id},
+            )
+        ]
+        return User(
+            user_id=self.user_id,
+            payment_code=payment_code,
+            responses=responses,
+            interact_times=(
+                (interact_start, interact_end) if interact_start is not None else None
+            ),
+        )
+
+    def write(self, user: User) -> None:
+        """Updates the user's own columns. Answers are only ever added, with add_answers, so answers
+        added since user was read aren't lost."""
+        with self.conn:
+            self.conn.execute(
+                "UPDATE users SET interact_start=:start, interact_end=:end WHERE id=:id",
+                {
+                    "id": self.user_id,
+                    "start": user.interact_times[0] if user.interact_times else None,
+                    "end": user.interact_times[1] if user.interact_times else None,
+                },
+            )
+
+    def add_answers(self, answers: Sequence[Answer], key: Optional[str] = None) -> None:
+        """Inserts answers. If key is given and a batch with the same key was already added, does nothing."""
+        with self.conn:
+            if key is not None:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO answer_batches (user_id, key) VALUES (:id, :key)",
+                    {"id": self.user_id, "key": key},
+                )
+                if cursor.rowcount == 0:
+                    return
+            insert_answers(self.conn, self.user_id, answers)
+
+    def flush(self) -> None:
+        """Every change is committed as it is made, so there is nothing left to write."""
+
+
+def insert_answers(
+    conn: sqlite3.Connection, user_id: int, answers: Sequence[Answer]
+) -> None:
+    conn.executemany(
+        "INSERT INTO answers (user_id, question_id, answer, start_time, end_time, max_steps_left, max_steps_right) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                user_id,
+                answer.question_id,
+                int(answer.answer),
+                answer.start_time,
+                answer.end_time,
+                *answer.max_steps,
+            )
+            for answer in answers
+        ],
+    )
+
+
+def import_user_files(filesystem: fs.base.FS, conn: sqlite3.Connection) -> int:
+    """Copies every user_<id>.json file and its answer segments into the users and answers tables,
+    skipping users already there.
+
+    Returns the number of users imported.
+    """
+    n_imported = 0
+    for name in filesystem.listdir("/"):
+        if (match := re.fullmatch(r"user_([0-9]+)\.json", name)) is None:
+            continue
+        user = read_user(filesystem, int(match.group(1)))
+        assert user is not None
+        with conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (id, site_sequence, demographics, payment_code, interact_start, interact_end) VALUES (:id, 0, '{}', :payment_code, :start, :end)",
+                {
+                    "id": user.user_id,
+                    "payment_code": user.payment_code,
+                    "start": user.interact_times[0] if user.interact_times else None,
+                    "end": user.interact_times[1] if user.interact_times else None,
+                },
+            )
+            if cursor.rowcount == 0:
+                logging.info(f"Skipping user {user.user_id}, already imported")
+                continue
+            insert_answers(conn, user.user_id, user.responses)
+        n_imported += 1
+    return n_imported
@@ -1,39 +1,186 @@
 import json
+import time
+from secrets import token_hex
+from typing import List, Optional, Sequence
 
 import fs
 import fs.base
+import fs.errors
 from attrs import asdict
 
-from experiment_server.type import User
+from experiment_server.type import Answer, User
+
+
+def snapshot_filename(user_id: int) -> str:
+    return f"user_{user_id}.json"
+
+
+def answers_dirname(user_id: int) -> str:
+    return f"user_{user_id}_answers"
+
+
+def list_answer_segments(filesystem: fs.base.FS, user_id: int) -> List[str]:
+    try:
+        names = filesystem.listdir(answers_dirname(user_id))
+    except fs.errors.ResourceNotFound:
+        return []
+    return sorted(
+        f"{answers_dirname(user_id)}/{name}"
+        for name in names
+        if name.endswith(".jsonl")
+    )
+
+
+def read_answer_segment(filesystem: fs.base.FS, path: str) -> List[Answer]:
+    return [
+        Answer(**json.loads(line))
+        for line in filesystem.readtext(path).splitlines()
+        if line.strip() != ""
+    ]
+
+
+def merge_answers(user: User, segments: Sequence[Sequence[Answer]]) -> User:
+    """Adds the answers from each segment to user's responses, in order.
+
+    An answer can be in both the snapshot and a segment if compaction was interrupted, so answers
+    identical to one already seen are dropped.
+    """
+    seen = set((a.question_id, a.start_time, a.end_time) for a in user.responses)
+    for segment in segments:
+        for answer in segment:
+            key = (answer.question_id, answer.start_time, answer.end_time)
+            if key not in seen:
+                seen.add(key)
+                user.responses.append(answer)
+    return user
+
+
+def read_snapshot(filesystem: fs.base.FS, user_id: int) -> Optional[User]:
+    try:
+        return User.from_dict(
+            json.loads(filesystem.readtext(snapshot_filename(user_id)))
+        )
+    except fs.errors.ResourceNotFound:
+        return None
+
+
+def read_user(filesystem: fs.base.FS, user_id: int) -> Optional[User]:
+    """Reads a user's snapshot file together with any answers appended since it was last compacted."""
+    if (user := read_snapshot(filesystem, user_id)) is None:
+        return None
+    segments = [
+        read_answer_segment(filesystem, path)
+        for path in list_answer_segments(filesystem, user_id)
+    ]
+    return merge_answers(user, segments)
+
+
+def compact_user(filesystem: fs.base.FS, user_id: int) -> int:
+    """Folds a user's answer segments into their snapshot file and deletes the segments.
+
+    Only run this when the participant isn't active: a snapshot written by a request that read the
+    user before compaction would drop the compacted answers. Returns the number of segments folded.
+    """
+    paths = list_answer_segments(filesystem, user_id)
+    if len(paths) == 0:
+        return 0
+    user = User.from_dict(json.loads(filesystem.readtext(snapshot_filename(user_id))))
+    user = merge_answers(user, [read_answer_segment(filesystem, p) for p in paths])
+    filesystem.writetext(snapshot_filename(user_id), json.dumps(asdict(user)))
+    for path in paths:
+        filesystem.remove(path)
+    return len(paths)
 
 
 class UserFile:
+    """A participant's user_<id>.json, read at most once and written at most once per request.
+
+    Nothing is read until `get` is first called, and a missing file is created in memory rather than
+    written straight away. `write` only changes the in-memory copy and marks it dirty; `flush` writes
+    it back, and the app calls it once at the end of every request.
+
+    Answers are never written into user_<id>.json directly. `add_answers` appends them to a new
+    JSON Lines segment in user_<id>_answers/ on flush, without reading anything, so an answer costs
+    one small write no matter how many came before it, and concurrent tabs can't overwrite each
+    other's answers. `compact_user` folds the segments back into the snapshot.
+    """
+
     def __init__(self, filesystem: fs.base.FS, user_id: int, payment_code: str):
         self.fs = filesystem
         self.user_id = user_id
-        self.filename = f"user_{user_id}.json"
-
-        self.create_file(payment_code)
-        self.check_file(payment_code)
+        self.payment_code = payment_code
+        self.filename = snapshot_filename(user_id)
 
-    def create_file(self, payment_code: str) -> None:
-        if not self.fs.exists(self.filename):
-            user = User(user_id=self.user_id, payment_code=payment_code, responses=[])
-            with self.fs.open(self.filename, "w") as f:
-                f.write(json.dumps(asdict(user)))
+        self.user: Optional[User] = None
+        self.dirty = False
+        self.pending_answers: List[Answer] = []
+        self.segment_key: Optional[str] = None
 
-    def check_file(self, payment_code: str) -> None:
-        user = self.get()
-        if user.payment_code != payment_code:
+    def check_user(self, user: User) -> None:
+        if user.payment_code != self.payment_code:
             raise ValueError("Payment code mismatch")
         if user.user_id != self.user_id:
             raise ValueError("User ID mismatch")
 
+    def create(self) -> None:
+        """Starts a new user without reading anything. The file is written on flush."""
+        self.user = User(
+            user_id=self.user_id, payment_code=self.payment_code, responses=[]
+        )
+        self.dirty = True
+
     def get(self) -> User:
-        with self.fs.open(self.filename, "r") as f:
-            user = User.from_dict(json.loads(f.read()))
-        return user
+        if self.user is None:
+            self.load(read_user(self.fs, self.user_id))
+        assert self.user is not None
+        return self.user
+
+    def load(self, user: Optional[User]) -> None:
+        """Adopts user as read from storage, or creates it if there was no file."""
+        if user is None:
+            user = User(
+                user_id=self.user_id, payment_code=self.payment_code, responses=[]
+            )
+            self.dirty = True
+        self.check_user(user)
+        user.responses.extend(self.pending_answers)
+        self.user = user
 
     def write(self, user: User) -> None:
-        with self.fs.open(self.filename, "w") as f:
-            f.write(json.dumps(asdict(user)))
+        self.check_user(user)
+        self.user = user
+        self.dirty = True
+
+    def add_answers(self, answers: Sequence[Answer], key: Optional[str] = None) -> None:
+        """Queues answers for the next flush, in a segment named after key if one is given.
+
+        A retried batch writes a second segment, but its answers are dropped as duplicates on read.
+        """
+        self.pending_answers.extend(answers)
+        if key is not None:
+            self.segment_key = key
+        if self.user is not None:
+            self.user.responses.extend(answers)
+
+    def flush(self) -> None:
+        if len(self.pending_answers) > 0:
+            self.write_segment(self.pending_answers)
+            self.pending_answers = []
+            self.segment_key = None
+        if self.dirty and self.user is not None:
+            self.write_snapshot(self.user)
+            self.dirty = False
+
+    def write_snapshot(self, user: User) -> None:
+        self.fs.writetext(self.filename, json.dumps(asdict(user)))
+
+    def write_segment(self, answers: Sequence[Answer]) -> None:
+        suffix = self.segment_key if self.segment_key is not None else token_hex(4)
+        path = f"{answers_dirname(self.user_id)}/{time.time_ns():020d}-{suffix}.jsonl"
+        text = "".join(json.dumps(asdict(answer)) + "\n" for answer in answers)
+        try:
+            self.fs.writetext(path, text)
+        except fs.errors.ResourceNotFound:
+            # s3 needs a directory marker before anything can be written under it.
+            self.fs.makedir(answers_dirname(self.user_id), recreate=True)
+            self.fs.writetext(path, text)
@@ -0,0 +1,124 @@
+"""Allocating participant ids without looking at how many participants there already are."""
+
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import List
+
+import fs.base
+
+from experiment_server.metrics import LATENCY_BUCKETS, Histogram, format_histogram
+from experiment_server.user_file import snapshot_filename
+
+
+class IdAllocator(ABC):
+    """Base class for participant id allocators, recording how long each allocation takes."""
+
+    def __init__(self) -> None:
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.max_latency = 0.0
+        self._stats_lock = threading.Lock()
+
+    def allocate(self) -> int:
+        start = time.perf_counter()
+        user_id = self._allocate()
+        latency = time.perf_counter() - start
+        with self._stats_lock:
+            self.latency.observe(latency)
+            self.max_latency = max(self.max_latency, latency)
+        logging.info(
+            f"Allocated user id {user_id} with {type(self).__name__} in {latency * 1000:.1f}ms"
+        )
+        return user_id
+
+    @abstractmethod
+    def _allocate(self) -> int:
+        """Returns an id no other participant has."""
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "allocated": self.latency.count,
+                "mean_latency": self.latency.sum / max(self.latency.count, 1),
+                "max_latency": self.max_latency,
+            }
+
+    def prometheus(self) -> List[str]:
+        with self._stats_lock:
+            return format_histogram(
+                "user_id_allocation_seconds",
+                "Time to allocate a participant id, by allocator.",
+                {(("allocator", type(self).__name__),): self.latency},
+            )
+
+
+class RandomIdAllocator(IdAllocator):
+    """Draws random ids, checking that no user file exists for the id drawn.
+
+    With 48 bit ids, two participants drawing the same id is vanishingly unlikely even if they
+    arrive at once, and the existence check is a single request however many users there are.
+    48 bits also keeps ids exactly representable as javascript numbers.
+    """
+
+    def __init__(
+        self, filesystem: fs.base.FS, bits: int = 48, max_attempts: int = 10
+    ) -> None:
+        super().__init__()
+        self.fs = filesystem
+        self.bits = bits
+        self.max_attempts = max_attempts
+
+    def _allocate(self) -> int:
+        for _ in range(self.max_attempts):
+            user_id = secrets.randbits(self.bits)
+            if not self.fs.exists(snapshot_filename(user_id)):
+                return user_id
+        raise RuntimeError(
+            f"No free user id found in {self.max_attempts} attempts with {self.bits} bits"
+        )
+
+
+class SqliteIdAllocator(IdAllocator):
+    """Hands out sequential ids from the user_ids table of the participant database.
+
+    The next id is one past the largest id in either user_ids or users, so users imported from
+    user files are never handed out again. Both maxima are primary key lookups, and the insert is a
+    single statement, so concurrent workers can't allocate the same id.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__()
+        self.path = path
+
+    def _allocate(self) -> int:
+        conn = sqlite3.connect(self.path, timeout=30.0)
+        try:
+            with conn:
+                cursor = conn.execute(
+                    "INSERT INTO user_ids (id, allocated_at) VALUES ("
+                    "MAX(COALESCE((SELECT MAX(id) FROM user_ids), -1), COALESCE((SELECT MAX(id) FROM users), -1)) + 1, "
+                    "datetime('now'))"
+                )
+            user_id = cursor.lastrowid
+            assert user_id is not None
+            return user_id
+        finally:
+            conn.close()
+
+
+class MemoryIdAllocator(IdAllocator):
+    """Sequential ids kept in memory, for tests and local development."""
+
+    def __init__(self, start: int = 0) -> None:
+        super().__init__()
+        self.next_id = start
+        self._lock = threading.Lock()
+
+    def _allocate(self) -> int:
+        with self._lock:
+            user_id = self.next_id
+            self.next_id += 1
+            return user_id
@@ -0,0 +1,242 @@
+"""Write-behind buffering for participant files.
+
+A `WriteBehindFS` wraps the participant filesystem. Writes are stored in a local SQLite spool and
+return as soon as they are committed there, and a background thread uploads them in batches. Reads
+look in the spool before going to the wrapped filesystem, so a request always sees the writes made
+by earlier requests, even ones that haven't been uploaded yet.
+
+The spool survives crashes: whatever is in it when a worker starts is uploaded by that worker's
+flusher. It doesn't survive losing the disk, which on Heroku happens whenever a dyno restarts, so
+workers also flush it as they exit (see gunicorn.conf.py).
+
+Every gunicorn worker can share one spool file. A flusher leases the rows it is uploading, and never
+leases a path another flusher is still uploading, so an older version of a file can't be uploaded
+over a newer one.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import fs.base
+import fs.errors
+import fs.path
+from fs.wrapfs import WrapFS
+
+from experiment_server.metrics import labeled
+
+
+class WriteSpool:
+    def __init__(self, path: str, lease_time: float = 60.0):
+        self.path = path
+        self.lease_time = lease_time
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # A write is acknowledged to the participant once it's here, so it must reach the disk.
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS spool(id INTEGER PRIMARY KEY AUTOINCREMENT, path TEXT NOT NULL, data BLOB NOT NULL, queued_at REAL NOT NULL, lease_until REAL NOT NULL DEFAULT 0)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS spool_path ON spool(path)")
+        self.conn.commit()
+        self._lock = threading.Lock()
+
+    def put(self, path: str, data: bytes) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO spool (path, data, queued_at) VALUES (:path, :data, :now)",
+                {"path": path, "data": data, "now": time.time()},
+            )
+
+    def latest(self, path: str) -> Optional[bytes]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT data FROM spool WHERE path=:path ORDER BY id DESC LIMIT 1",
+                {"path": path},
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def paths_in(self, dirname: str) -> List[str]:
+        prefix = fs.path.forcedir(dirname)
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT DISTINCT path FROM spool WHERE substr(path, 1, :n)=:prefix",
+                {"n": len(prefix), "prefix": prefix},
+            ).fetchall()
+        return [path for (path,) in rows if fs.path.dirname(path) == dirname]
+
+    def lease(self, batch_size: int) -> Dict[str, Tuple[int, bytes]]:
+        """Leases up to batch_size paths nobody else is uploading.
+
+        Returns the id and data of the latest write to each path. Every write to a leased path up to
+        that id is superseded by it.
+        """
+        now = time.time()
+        with self._lock, self.conn:
+            rows = self.conn.execute(
+                "SELECT path, MAX(id) FROM spool WHERE path NOT IN (SELECT path FROM spool WHERE lease_until > :now) GROUP BY path ORDER BY MIN(id) LIMIT :limit",
+                {"now": now, "limit": batch_size},
+            ).fetchall()
+            leased = {}
+            for path, max_id in rows:
+                self.conn.execute(
+                    "UPDATE spool SET lease_until=:until WHERE path=:path AND id<=:max_id",
+                    {"until": now + self.lease_time, "path": path, "max_id": max_id},
+                )
+                (data,) = self.conn.execute(
+                    "SELECT data FROM spool WHERE id=:id", {"id": max_id}
+                ).fetchone()
+                leased[path] = (max_id, data)
+        return leased
+
+    def release(self, path: str, max_id: int, uploaded: bool) -> None:
+        with self._lock, self.conn:
+            if uploaded:
+                self.conn.execute(
+                    "DELETE FROM spool WHERE path=:path AND id<=:max_id",
+                    {"path": path, "max_id": max_id},
+                )
+            else:
+                self.conn.execute(
+                    "UPDATE spool SET lease_until=0 WHERE path=:path AND id<=:max_id",
+                    {"path": path, "max_id": max_id},
+                )
+
+    def discard(self, path: str) -> bool:
+        with self._lock, self.conn:
+            cursor = self.conn.execute(
+                "DELETE FROM spool WHERE path=:path", {"path": path}
+            )
+        return cursor.rowcount > 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+class WriteBehindFS(WrapFS):
+    def __init__(
+        self,
+        wrap_fs: fs.base.FS,
+        spool_path: str,
+        interval: float = 1.0,
+        batch_size: int = 100,
+    ):
+        super().__init__(wrap_fs)
+        self.spool = WriteSpool(spool_path)
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.uploaded = 0
+        self.failed = 0
+        self._stop = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._flusher is None:
+            self._flusher = threading.Thread(
+                target=self._run, name="write-behind-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                with labeled("write_behind"):
+                    self.flush()
+            except Exception:
+                logging.exception("Failed to flush write-behind spool")
+
+    def flush(self) -> int:
+        """Uploads everything in the spool that isn't leased by another flusher.
+
+        Returns the number of files uploaded.
+        """
+        n_uploaded = 0
+        while len(leased := self.spool.lease(self.batch_size)) > 0:
+            error: Optional[Exception] = None
+            for path, (max_id, data) in leased.items():
+                if error is None:
+                    try:
+                        self._upload(path, data)
+                        self.spool.release(path, max_id, uploaded=True)
+                        n_uploaded += 1
+                        continue
+                    except Exception as e:
+                        error = e
+                        self.failed += 1
+                self.spool.release(path, max_id, uploaded=False)
+            if error is not None:
+                raise error
+        self.uploaded += n_uploaded
+        return n_uploaded
+
+    def _upload(self, path: str, data: bytes) -> None:
+        delegate_fs, delegate_path = self.delegate_path(path)
+        try:
+            delegate_fs.writebytes(delegate_path, data)
+        except fs.errors.ResourceNotFound:
+            delegate_fs.makedirs(fs.path.dirname(delegate_path), recreate=True)
+            delegate_fs.writebytes(delegate_path, data)
+
+    def close(self) -> None:
+        if not self.isclosed():
+            self._stop.set()
+            if self._flusher is not None:
+                self._flusher.join()
+            try:
+                self.flush()
+            finally:
+                if len(self.spool) > 0:
+                    logging.warning(
+                        f"{len(self.spool)} writes left in {self.spool.path}, they will be uploaded on restart"
+                    )
+                self.spool.close()
+                super().close()
+
+    def writebytes(self, path, contents) -> None:
+        self.spool.put(fs.path.abspath(path), bytes(contents))
+
+    def writetext(self, path, contents, encoding="utf-8", errors=None, newline=""):
+        self.writebytes(path, contents.encode(encoding, errors or "strict"))
+
+    def readbytes(self, path) -> bytes:
+        if (data := self.spool.latest(fs.path.abspath(path))) is not None:
+            return data
+        return super().readbytes(path)
+
+    def readtext(self, path, encoding=None, errors=None, newline=""):
+        if (data := self.spool.latest(fs.path.abspath(path))) is not None:
+            return data.decode(encoding or "utf-8", errors or "strict")
+        return super().readtext(path, encoding, errors, newline)
+
+    def exists(self, path) -> bool:
+        return self.spool.latest(fs.path.abspath(path)) is not None or super().exists(
+            path
+        )
+
+    def listdir(self, path) -> List[str]:
+        spooled = [
+            fs.path.basename(p) for p in self.spool.paths_in(fs.path.abspath(path))
+        ]
+        try:
+            names = super().listdir(path)
+        except fs.errors.ResourceNotFound:
+            if len(spooled) == 0:
+                raise
+            names = []
+        return names + [name for name in spooled if name not in names]
+
+    def remove(self, path) -> None:
+        spooled = self.spool.discard(fs.path.abspath(path))
+        try:
+            super().remove(path)
+        except fs.errors.ResourceNotFound:
+            if not spooled:
+                raise
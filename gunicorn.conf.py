@@ -0,0 +1,5 @@
+def worker_exit(server, worker):
+    # Runs in the worker before the interpreter starts shutting down, while boto3 can still upload.
+    from experiment_server.common import close_user_fs
+
+    close_user_fs()
@@ -1,10 +1,12 @@
+import arrow
 import numpy as np
-from experiment_server.type import FeatureTrajectory, State, Trajectory
+from experiment_server.type import Answer, FeatureTrajectory, State, Trajectory
 from hypothesis.extra.numpy import array_shapes, arrays
 from hypothesis.strategies import characters, composite, floats, integers, tuples
 
 seeds = integers(0, 2**32 - 1)
 
+
 small_int_strategy = integers(1, 5)
 
 finite_floats = floats(allow_infinity=False, allow_nan=False, width=32)
@@ -75,3 +77,16 @@ def feature_trajs(draw, states, action_strategy):
         arrays(dtype=np.float32, shape=(actions.shape[0], 4), elements=floats_1000)
     )
     return FeatureTrajectory(start_state, actions, env_name, modality, features)
+
+
+def make_answer(question_id: int) -> Answer:
+    """An answer to question_id that takes question_id seconds, preferring the right trajectory for
+    even ids."""
+    start = arrow.get("2022-01-01T00:00:00+00:00")
+    return Answer(
+        question_id=question_id,
+        answer=question_id % 2 == 0,
+        start_time=start.isoformat(),
+        end_time=start.shift(seconds=question_id).isoformat(),
+        max_steps=(10, 12),
+    )
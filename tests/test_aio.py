@@ -0,0 +1,83 @@
+import asyncio
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import fs
+from experiment_server.aio import AsyncRemoteSqlite, AsyncUserFile
+from experiment_server.remote_sqlite import RemoteSqlite, Snapshot
+from experiment_server.type import User
+from experiment_server.user_db import UserDatabase, connect_user_db
+from experiment_server.user_file import UserFile
+
+from .strategies import make_answer
+
+
+def test_user_file_roundtrip():
+    async def run(user_fs: fs.base.FS) -> User:
+        user_file = AsyncUserFile(UserFile(user_fs, 3, "code"))
+        user_file.create()
+        await user_file.flush()
+        for question_id in (1, 2, 3):
+            user_file = AsyncUserFile(UserFile(user_fs, 3, "code"))
+            await user_file.add_answers([make_answer(question_id)])
+            await user_file.flush()
+        user_file = AsyncUserFile(UserFile(user_fs, 3, "code"))
+        user = await user_file.get()
+        user.interact_times = ("a", "b")
+        await user_file.write(user)
+        await user_file.flush()
+        return await AsyncUserFile(UserFile(user_fs, 3, "code")).get()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        user_fs = fs.open_fs(f"osfs://{tmpdir}")
+        user = asyncio.run(run(user_fs))
+        assert user.get_used_questions() == [1, 2, 3]
+        assert user.interact_times == ["a", "b"]
+        assert UserFile(user_fs, 3, "code").get() == user
+
+
+def test_user_database():
+    async def run(conn: sqlite3.Connection) -> User:
+        user_file = AsyncUserFile(UserDatabase(conn, 3, "code"))
+        await user_file.add_answers([make_answer(1)])
+        return await user_file.get()
+
+    conn = connect_user_db(":memory:", create=True, check_same_thread=False)
+    assert asyncio.run(run(conn)).get_used_questions() == [1]
+
+
+def test_remote_sqlite_transaction():
+    def insert(conn: sqlite3.Connection) -> None:
+        conn.execute("INSERT INTO items (name) VALUES ('a')")
+        conn.commit()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        (root / "remote").mkdir()
+        (root / "local").mkdir()
+        conn = sqlite3.connect(root / "remote" / "test.db")
+        conn.execute("CREATE TABLE items(id INTEGER PRIMARY KEY, name TEXT)")
+        conn.commit()
+        conn.close()
+
+        db = RemoteSqlite(
+            fs.open_fs(f"osfs://{root / 'remote'}"),
+            "test.db",
+            local_dir=f"osfs://{root / 'local'}",
+        )
+        async_db = AsyncRemoteSqlite(db)
+        asyncio.run(async_db.transaction(insert))
+        assert sqlite3.connect(root / "remote" / "test.db").execute(
+            "SELECT name FROM items"
+        ).fetchall() == [("a",)]
+
+        def names(snapshot: Snapshot) -> list:
+            return [
+                row["name"] for row in snapshot.con.execute("SELECT name FROM items")
+            ]
+
+        async def read_concurrently() -> list:
+            return await asyncio.gather(*(async_db.read(names) for _ in range(8)))
+
+        assert asyncio.run(read_concurrently()) == [["a"]] * 8
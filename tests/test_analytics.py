@@ -0,0 +1,107 @@
+import threading
+import time
+
+import numpy as np
+from experiment_server.analytics import (
+    StatsCache,
+    answers_from_user_db,
+    grouped_medians,
+    question_stats,
+    summarize,
+    timing_outliers,
+)
+from experiment_server.type import Answer
+from experiment_server.user_db import UserDatabase, connect_user_db
+
+
+def make_answers(rows) -> dict:
+    """rows of (user_id, question_id, prefer_right, response_time)."""
+    user_id, question_id, prefer_right, time = zip(*rows)
+    return {
+        "user_id": np.array(user_id, dtype=np.int64),
+        "question_id": np.array(question_id, dtype=np.int64),
+        "prefer_right": np.array(prefer_right, dtype=bool),
+        "start_time": np.zeros(len(rows)),
+        "end_time": np.array(time, dtype=np.float64),
+        "max_steps": np.full((len(rows), 2), 10, dtype=np.int32),
+    }
+
+
+def test_question_stats():
+    answers = make_answers(
+        [(1, 5, True, 1), (2, 5, True, 1), (3, 5, False, 1), (1, 6, False, 1)]
+    )
+    stats = question_stats(answers)
+    assert stats["question_id"].tolist() == [5, 6]
+    assert stats["n_answers"].tolist() == [3, 1]
+    assert np.allclose(stats["prefer_right"], [2 / 3, 0])
+    assert np.isclose(stats["agreement"][0], 1 / 3)
+    assert np.isnan(stats["agreement"][1])
+
+
+def test_grouped_medians():
+    keys, medians = grouped_medians(
+        np.array([2, 1, 2, 1, 1]), np.array([4, 3, 2, 1, 2])
+    )
+    assert keys.tolist() == [1, 2]
+    assert medians.tolist() == [2, 3]
+
+
+def test_timing_outliers():
+    rows = [(user_id, 1, True, 5 + user_id % 3) for user_id in range(20)]
+    answers = make_answers(rows + [(99, 1, True, 200)])
+    assert timing_outliers(answers)["user_id"].tolist() == [99]
+
+
+def test_summarize_breakdowns():
+    answers = make_answers([(1, 5, True, 1), (2, 5, False, 3), (1, 6, True, 2)])
+    questions = {
+        "question_id": np.array([5, 6]),
+        "modality": np.array(["state", "traj"]),
+        "length": np.array([3, 3]),
+    }
+    summary = summarize(answers, questions)
+    assert summary["n_users"] == 2
+    assert summary["questions"]["agreement"] == [0.0, None]
+    assert [group["group"] for group in summary["by_modality"]] == ["state", "traj"]
+    assert summary["by_length"][0]["n_answers"] == 3
+    assert summary["by_modality"][0]["median_response_time"] == 2.0
+
+
+def test_answers_from_user_db():
+    conn = connect_user_db(":memory:", create=True)
+    UserDatabase(conn, 3, "code").add_answers(
+        [
+            Answer(
+                question_id=1,
+                answer=True,
+                start_time="2022-01-01T00:00:00.250000+00:00",
+                end_time="2022-01-01T01:00:05+01:00",
+                max_steps=(10, 12),
+            )
+        ]
+    )
+    answers = answers_from_user_db(conn)
+    assert answers["user_id"].tolist() == [3]
+    assert answers["max_steps"].tolist() == [[10, 12]]
+    assert np.allclose(answers["end_time"] - answers["start_time"], 4.75, atol=1e-3)
+
+
+def test_stats_cache_computes_in_the_background():
+    cache = StatsCache(max_age=3600.0)
+    release = threading.Event()
+    done = threading.Event()
+
+    def compute():
+        release.wait(5)
+        done.set()
+        return {"n_answers": 1}
+
+    assert cache.get(compute) is None
+    # The first computation is still running, so this doesn't start another.
+    assert cache.get(lambda: {"n_answers": 2}) is None
+    release.set()
+    assert done.wait(5)
+    while cache._refreshing:
+        time.sleep(0.01)
+    assert cache.get(compute) == {"n_answers": 1}
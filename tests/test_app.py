@@ -0,0 +1,409 @@
+import asyncio
+import importlib
+import os
+import sqlite3
+from contextlib import contextmanager
+
+import fs
+import pytest
+
+os.environ.setdefault("SECRET_KEY", "test")
+
+from experiment_server.common import (  # noqa: E402
+    get_db_fs,
+    get_id_allocator,
+    get_journal,
+    get_user_fs,
+)
+from experiment_server.journal import WriteJournal  # noqa: E402
+from experiment_server.query import insert_question, insert_traj  # noqa: E402
+from experiment_server.remote_sqlite import RemoteSqlite  # noqa: E402
+from experiment_server.user_file import read_user  # noqa: E402
+
+from .test_query import SCHEMA, make_traj  # noqa: E402
+
+
+class SyncResponse:
+    """A quart test response with the blocking accessors of a flask one."""
+
+    def __init__(self, response, loop: asyncio.AbstractEventLoop):
+        self._response = response
+        self._loop = loop
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.location = response.location
+
+    def get_json(self):
+        return self._loop.run_until_complete(self._response.get_json())
+
+    def get_data(self, as_text: bool = False):
+        return self._loop.run_until_complete(self._response.get_data(as_text=as_text))
+
+
+class SyncClient:
+    """Drives the quart app's test client with the same blocking calls as flask's, so each route
+    test runs against both apps."""
+
+    def __init__(self, client, loop: asyncio.AbstractEventLoop):
+        self._client = client
+        self._loop = loop
+
+    def get(self, path: str, **kwargs) -> SyncResponse:
+        return self.open(path, method="GET", **kwargs)
+
+    def post(self, path: str, **kwargs) -> SyncResponse:
+        return self.open(path, method="POST", **kwargs)
+
+    def open(self, path: str, **kwargs) -> SyncResponse:
+        response = self._loop.run_until_complete(self._client.open(path, **kwargs))
+        return SyncResponse(response, self._loop)
+
+    @contextmanager
+    def session_transaction(self):
+        # Quart's transaction has to be entered and exited in one task, so the session is read in
+        # one and written back in another.
+        async def read() -> dict:
+            async with self._client.session_transaction() as session:
+                return dict(session)
+
+        async def write(changed: dict) -> None:
+            async with self._client.session_transaction() as session:
+                session.clear()
+                session.update(changed)
+
+        session = self._loop.run_until_complete(read())
+        yield session
+        self._loop.run_until_complete(write(session))
+
+
+@pytest.fixture(params=["app", "asgi_app"])
+def app_module(request, monkeypatch):
+    """The flask app, or the quart app if quart is installed."""
+    if request.param == "asgi_app":
+        pytest.importorskip("quart")
+    module = importlib.import_module(f"experiment_server.{request.param}")
+    monkeypatch.setattr(module, "_database", None)
+    if request.param == "asgi_app":
+        # The lock belongs to the event loop it was first used on, and each test has its own.
+        monkeypatch.setattr(module, "_database_lock", None)
+    return module
+
+
+@pytest.fixture
+def client(app_module, tmp_path, monkeypatch):
+    monkeypatch.setenv("EXPERIMENT_DIR", str(tmp_path))
+    monkeypatch.delenv("USER_DATABASE_PATH", raising=False)
+    monkeypatch.delenv("WRITE_BEHIND_SPOOL", raising=False)
+    get_user_fs.cache_clear()
+    get_id_allocator.cache_clear()
+    if app_module.__name__.endswith("asgi_app"):
+        loop = asyncio.new_event_loop()
+        yield SyncClient(app_module.app.test_client(), loop)
+        loop.close()
+    else:
+        yield app_module.app.test_client()
+    get_user_fs.cache_clear()
+    get_id_allocator.cache_clear()
+
+
+@pytest.fixture
+def db_path(client, tmp_path, monkeypatch):
+    """An empty question database for the app, with the journal next to it."""
+    path = tmp_path / "db" / "experiments.db"
+    path.parent.mkdir()
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA.read_text())
+    conn.close()
+    monkeypatch.setenv("DATABASE_PATH", str(path))
+    caches = [get_db_fs, get_journal]
+    for cache in caches:
+        cache.cache_clear()
+    yield path
+    for cache in caches:
+        cache.cache_clear()
+
+
+def start_session(client) -> int:
+    """Visits the welcome and instructions pages, like a new participant, returning their id."""
+    assert client.get("/").status_code == 200
+    assert client.get("/instructions").status_code == 200
+    with client.session_transaction() as session:
+        return session["user_id"]
+
+
+def answer_json(question_id: int) -> dict:
+    return {
+        "id": question_id,
+        "answer": "right",
+        "startTime": "2022-01-01T00:00:00+00:00",
+        "stopTime": "2022-01-01T00:00:05+00:00",
+        "maxSteps": [10, 12],
+    }
+
+
+def stored_answers(tmp_path, user_id: int) -> list:
+    user = read_user(fs.open_fs(f"osfs://{tmp_path}"), user_id)
+    assert user is not None
+    return [answer.question_id for answer in user.responses]
+
+
+def test_submit_answers(client, tmp_path):
+    user_id = start_session(client)
+    response = client.post(
+        "/submit_answers",
+        json={"idempotencyKey": "batch-1", "answers": [answer_json(1), answer_json(2)]},
+    )
+    assert response.status_code == 200
+    assert response.get_json() == {"success": True, "accepted": 2, "duplicate": False}
+    assert stored_answers(tmp_path, user_id) == [1, 2]
+    with client.session_transaction() as session:
+        assert session["answered_questions"] == [1, 2]
+
+
+def test_submit_answers_ignores_duplicate_batches(client, tmp_path):
+    user_id = start_session(client)
+    batch = {"idempotencyKey": "batch-1", "answers": [answer_json(1)]}
+    assert client.post("/submit_answers", json=batch).get_json()["accepted"] == 1
+
+    # A retry of a batch that was already stored, e.g. after a lost response.
+    response = client.post("/submit_answers", json=batch)
+    assert response.status_code == 200
+    assert response.get_json() == {"success": True, "accepted": 0, "duplicate": True}
+    assert stored_answers(tmp_path, user_id) == [1]
+
+
+def test_submit_answers_skips_answered_questions(client, tmp_path):
+    user_id = start_session(client)
+    client.post(
+        "/submit_answers", json={"idempotencyKey": "a", "answers": [answer_json(1)]}
+    )
+    response = client.post(
+        "/submit_answers",
+        json={
+            "idempotencyKey": "b",
+            "answers": [answer_json(1), answer_json(3), answer_json(3)],
+        },
+    )
+    assert response.get_json() == {"success": True, "accepted": 1, "duplicate": False}
+    assert stored_answers(tmp_path, user_id) == [1, 3]
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"answers": [answer_json(1)]},
+        {"idempotencyKey": "not a key!", "answers": [answer_json(1)]},
+        {"idempotencyKey": "k" * 65, "answers": [answer_json(1)]},
+        {"idempotencyKey": "a", "answers": answer_json(1)},
+        {"idempotencyKey": "a", "answers": [answer_json(i) for i in range(21)]},
+        {"idempotencyKey": "a", "answers": [{"id": 1}]},
+        {"idempotencyKey": "a", "answers": [{**answer_json(1), "startTime": "?"}]},
+    ],
+)
+def test_submit_answers_rejects_bad_payloads(client, tmp_path, payload):
+    user_id = start_session(client)
+    assert client.post("/submit_answers", json=payload).status_code == 400
+    assert stored_answers(tmp_path, user_id) == []
+
+
+def test_submit_answers_needs_a_session(client):
+    response = client.post(
+        "/submit_answers", json={"idempotencyKey": "a", "answers": [answer_json(1)]}
+    )
+    assert response.status_code == 404
+
+
+def submit(client, question_ids) -> None:
+    response = client.post(
+        "/submit_answers",
+        json={
+            "idempotencyKey": f"q{question_ids[0]}",
+            "answers": [answer_json(id) for id in question_ids],
+        },
+    )
+    assert response.status_code == 200
+
+
+def test_new_participant_gets_a_session(client, tmp_path):
+    assert client.get("/").status_code == 200
+    with client.session_transaction() as session:
+        user_id = session["user_id"]
+        assert session["answered_questions"] == []
+        assert not session["consent"]
+    # The user file is written on the first visit, not on a later page load.
+    assert stored_answers(tmp_path, user_id) == []
+
+
+def test_pages_need_consent(client):
+    client.get("/")
+    for page in ("/replay", "/interact", "/goodbye"):
+        response = client.get(page)
+        assert response.status_code == 302
+        assert response.location.endswith("/")
+
+
+def test_redirects_follow_progress(client):
+    start_session(client)
+    assert client.get("/interact").status_code == 200
+    assert client.get("/replay").status_code == 200
+
+    submit(client, [1, 2])
+    for page in ("/", "/instructions", "/interact", "/goodbye"):
+        assert client.get(page).location.endswith("/replay")
+    assert client.get("/replay").status_code == 200
+
+    submit(client, list(range(3, 21)))
+    for page in ("/", "/instructions", "/interact", "/replay"):
+        assert client.get(page).location.endswith("/goodbye")
+    with client.session_transaction() as session:
+        payment_code = session["payment_code"]
+    response = client.get("/goodbye")
+    assert response.status_code == 200
+    assert payment_code in response.get_data(as_text=True)
+
+
+def test_progress_comes_from_the_session(client):
+    start_session(client)
+    # Nothing is stored, so only the session's progress can send the participant to goodbye.
+    with client.session_transaction() as session:
+        session["answered_questions"] = list(range(1, 21))
+    assert client.get("/replay").location.endswith("/goodbye")
+
+
+@pytest.mark.parametrize("progress", [None, "1,2", [1, 1], [1, "2"], list(range(21))])
+def test_invalid_session_progress_is_read_from_storage(client, progress):
+    start_session(client)
+    submit(client, [1, 2])
+    with client.session_transaction() as session:
+        if progress is None:
+            del session["answered_questions"]
+        else:
+            session["answered_questions"] = progress
+    assert client.get("/interact").location.endswith("/replay")
+    with client.session_transaction() as session:
+        assert session["answered_questions"] == [1, 2]
+
+
+TRAJECTORY = {
+    "start_state": {
+        "grid": {str(i): 1 for i in range(16)},
+        "grid_shape": [4, 4],
+        "agent_pos": [0, 0],
+        "exit_pos": [3, 3],
+    },
+    "actions": [1, 2],
+}
+
+
+def test_submit_question_accepts_ids_and_journaled_trajectories(client, db_path):
+    response = client.post("/submit_trajectory", json=TRAJECTORY)
+    traj_ref = response.get_json()["trajectory_id"]
+    response = client.post(
+        "/submit_question", json={"traj_ids": [traj_ref, 1], "name": "test"}
+    )
+    assert response.status_code == 200
+    assert len(WriteJournal(fs.open_fs(str(db_path.parent))).keys()) == 2
+
+
+def test_submit_question_accepts_compacted_trajectories(client, db_path):
+    response = client.post("/submit_trajectory", json=TRAJECTORY)
+    traj_ref = response.get_json()["trajectory_id"]
+    # Load the app's copy of the database before the trajectory is merged into it.
+    assert (
+        client.post(
+            "/submit_question", json={"traj_ids": [1, 2], "name": "a"}
+        ).status_code
+        == 200
+    )
+    db_fs = fs.open_fs(str(db_path.parent))
+    journal = WriteJournal(db_fs)
+    journal.compact(RemoteSqlite(db_fs, "experiments.db"))
+    assert journal.keys() == []
+
+    response = client.post(
+        "/submit_question", json={"traj_ids": [traj_ref, traj_ref], "name": "b"}
+    )
+    assert response.status_code == 200
+
+
+@pytest.mark.parametrize(
+    "traj_ids",
+    [
+        ["not an id", 1],
+        ["2", 1],
+        [True, 1],
+        ["journal:missing", 1],
+        [1],
+        [1, 2, 3],
+        "1,2",
+    ],
+)
+def test_submit_question_rejects_unresolvable_ids(client, db_path, traj_ids):
+    response = client.post("/submit_question", json={"traj_ids": traj_ids, "name": "x"})
+    assert response.status_code == 400
+    assert WriteJournal(fs.open_fs(str(db_path.parent))).keys() == []
+
+
+def test_submit_question_rejects_refs_to_questions(client, db_path):
+    response = client.post("/submit_question", json={"traj_ids": [1, 2], "name": "a"})
+    question_ref = response.get_json()["question_id"]
+    response = client.post(
+        "/submit_question", json={"traj_ids": [question_ref, 1], "name": "b"}
+    )
+    assert response.status_code == 400
+
+
+def add_questions(db_path, n: int, label=None) -> None:
+    conn = sqlite3.connect(db_path)
+    for _ in range(n):
+        first = insert_traj(conn, make_traj(5))
+        second = insert_traj(conn, make_traj(5))
+        insert_question(conn, (first, second), "random", "miner", label=label)
+    conn.close()
+
+
+def test_random_questions_returns_what_it_has(client, db_path):
+    add_questions(db_path, 3)
+
+    start_session(client)
+    response = client.post(
+        "/random_questions", json={"env": "miner", "lengths": [], "type": "traj"}
+    )
+    assert response.status_code == 200
+    assert sorted(question["id"] for question in response.get_json()) == [1, 2, 3]
+
+
+def test_named_question_get_is_conditional(client, db_path):
+    add_questions(db_path, 1, label="tutorial")
+    response = client.get("/named_question?name=tutorial")
+    assert response.status_code == 200
+    assert response.get_json()["id"] == 1
+    etag = response.headers["ETag"]
+
+    response = client.get(
+        "/named_question?name=tutorial", headers={"If-None-Match": etag}
+    )
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.get_data() == b""
+
+    response = client.get(
+        "/named_question?name=tutorial", headers={"If-None-Match": '"stale"'}
+    )
+    assert response.status_code == 200
+    assert client.get("/named_question").status_code == 400
+
+
+def test_posted_questions_have_no_etag(client, db_path):
+    add_questions(db_path, 1, label="tutorial")
+    response = client.post("/named_question", json={"name": "tutorial"})
+    assert response.status_code == 200
+    assert response.get_json()["id"] == 1
+    assert "ETag" not in response.headers
+
+    start_session(client)
+    response = client.post(
+        "/random_questions", json={"env": "miner", "lengths": [], "type": "traj"}
+    )
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
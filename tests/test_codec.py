@@ -0,0 +1,98 @@
+import pickle
+
+import numpy as np
+from experiment_server.codec import (
+    decode_actions,
+    decode_array,
+    decode_cstates,
+    decode_state,
+    encode_actions,
+    encode_array,
+    encode_cstates,
+    encode_state,
+    is_encoded,
+)
+from experiment_server.query import get_questions, migrate_blobs
+from experiment_server.type import State
+from hypothesis import example, given
+from hypothesis.extra.numpy import array_shapes, arrays, scalar_dtypes
+from hypothesis.strategies import binary, lists
+
+from .strategies import actions, states
+from .test_query import make_db
+
+
+@given(state=states(max_grid_size=20))
+def test_state_roundtrip(state: State):
+    blob = encode_state(state)
+    assert is_encoded(blob)
+    decoded = decode_state(blob)
+    assert decoded == state
+    assert decoded.grid.dtype == state.grid.dtype
+
+
+@given(actions=actions)
+def test_actions_roundtrip(actions: np.ndarray):
+    decoded = decode_actions(encode_actions(actions))
+    assert decoded is not None
+    assert np.array_equal(decoded, actions)
+    assert decoded.dtype == actions.dtype
+
+
+@given(
+    arr=arrays(
+        dtype=scalar_dtypes(),
+        shape=array_shapes(min_dims=0, max_dims=3, min_side=0, max_side=4),
+    )
+)
+@example(arr=np.array(7, dtype=np.int64))
+def test_array_roundtrip(arr: np.ndarray):
+    decoded = decode_array(encode_array(arr))
+    assert decoded.shape == arr.shape
+    assert decoded.dtype == arr.dtype
+    # Compares the bytes rather than the values, so NaNs count as equal.
+    assert decoded.tobytes() == arr.tobytes()
+
+
+@given(cstates=lists(binary(), max_size=5))
+def test_cstates_roundtrip(cstates):
+    assert decode_cstates(encode_cstates(cstates)) == cstates
+
+
+def test_none_roundtrip():
+    assert decode_actions(encode_actions(None)) is None
+    assert decode_cstates(encode_cstates(None)) is None
+
+
+def test_decode_does_not_copy():
+    blob = encode_actions(np.arange(10, dtype=np.int64))
+    decoded = decode_actions(blob)
+    assert decoded is not None
+    assert not decoded.flags.owndata and not decoded.flags.writeable
+
+
+def test_migrate_pickled_rows():
+    conn = make_db()
+    expected = get_questions(conn, [1, 2, 3, 4])
+    for id, start_blob, actions_blob in conn.execute(
+        "SELECT id, start_state, actions FROM trajectories"
+    ).fetchall():
+        conn.execute(
+            "UPDATE trajectories SET start_state=?, actions=?, cstates=? WHERE id=?",
+            (
+                pickle.dumps(decode_state(start_blob)),
+                pickle.dumps(np.array(decode_actions(actions_blob))),
+                pickle.dumps(None),
+                id,
+            ),
+        )
+    conn.commit()
+    assert get_questions(conn, [1, 2, 3, 4]) == expected
+
+    assert migrate_blobs(conn, batch_size=3) == 8
+    assert migrate_blobs(conn) == 0
+    assert all(
+        is_encoded(blob)
+        for (blob,) in conn.execute("SELECT start_state FROM trajectories")
+    )
+    assert get_questions(conn, [1, 2, 3, 4]) == expected
@@ -0,0 +1,65 @@
+import base64
+import json
+
+import attrs
+import numpy as np
+from experiment_server.encoder import compact_array, encode_compact_json, encode_json
+from experiment_server.type import Question, State, Trajectory
+from hypothesis import given
+from hypothesis.extra.numpy import array_shapes, arrays, integer_dtypes
+
+from .strategies import states
+
+
+def unpack(packed: dict) -> np.ndarray:
+    return np.frombuffer(
+        base64.b64decode(packed["__ndarray__"]), dtype=np.dtype(packed["dtype"])
+    ).reshape(packed["shape"])
+
+
+@given(arrays(integer_dtypes(sizes=(8, 16, 32)), array_shapes(min_dims=0, max_dims=2)))
+def test_compact_array_roundtrip(arr: np.ndarray):
+    unpacked = unpack(compact_array(arr))
+    assert unpacked.shape == arr.shape
+    assert np.array_equal(unpacked, arr)
+
+
+def test_compact_array_narrows_small_ints():
+    assert compact_array(np.arange(13, dtype=np.int64))["dtype"] == "uint8"
+    assert compact_array(np.array([-1, 300]))["dtype"] == "int32"
+
+
+@given(states())
+def test_compact_json_matches_json(state: State):
+    traj = Trajectory(
+        start_state=state,
+        actions=np.arange(10),
+        env_name="miner",
+        modality="traj",
+    )
+    question = Question(id=1, trajs=(traj, traj))
+    plain = json.loads(encode_json(question))
+    compact = json.loads(encode_compact_json(question))
+
+    compact_state = compact["trajs"][0]["start_state"]
+    assert (
+        unpack(compact_state["grid"]).tolist()
+        == plain["trajs"][0]["start_state"]["grid"]
+    )
+    assert unpack(compact["trajs"][1]["actions"]).tolist() == list(range(10))
+    assert compact_state["agent_pos"] == plain["trajs"][0]["start_state"]["agent_pos"]
+
+
+@given(states())
+def test_serializers_match_asdict(state: State):
+    traj = Trajectory(
+        start_state=state,
+        actions=np.arange(10),
+        env_name="miner",
+        modality="traj",
+        reason="because",
+    )
+    question = Question(id=1, trajs=(traj, traj))
+    assert encode_json(question) == json.dumps(
+        attrs.asdict(question), default=lambda arr: arr.tolist()
+    ).encode("utf-8")
@@ -0,0 +1,83 @@
+import tempfile
+
+import boto3
+import fs
+import numpy as np
+import pytest
+from experiment_server.boto3_counter import Boto3Counter
+from experiment_server.export import export_answers, load_answers, scan_users
+from experiment_server.user_file import UserFile
+
+from .strategies import make_answer
+
+
+def add_user(user_fs, user_id: int, question_ids) -> None:
+    user_file = UserFile(user_fs, user_id, "code")
+    user_file.create()
+    user_file.add_answers([make_answer(q) for q in question_ids])
+    user_file.flush()
+
+
+def test_export_answers():
+    with tempfile.TemporaryDirectory() as users_dir, tempfile.TemporaryDirectory() as out_dir:
+        user_fs = fs.open_fs(f"osfs://{users_dir}")
+        add_user(user_fs, 2, [3, 4])
+        add_user(user_fs, 1, [1])
+
+        stats = export_answers(user_fs, out_dir, workers=2)
+        assert stats == {"users": 2, "answers": 3, "read": 2}
+        answers, users = load_answers(out_dir)
+        assert answers["user_id"].tolist() == [1, 2, 2]
+        assert answers["question_id"].tolist() == [1, 3, 4]
+        assert answers["prefer_right"].tolist() == [False, False, True]
+        assert answers["max_steps"].tolist() == [[10, 12]] * 3
+        assert np.allclose(answers["end_time"] - answers["start_time"], [1, 3, 4])
+        assert users["n_answers"].tolist() == [1, 2]
+        assert np.isnan(users["interact_start"]).all()
+
+
+def test_incremental_export_only_reads_changed_users():
+    with tempfile.TemporaryDirectory() as users_dir, tempfile.TemporaryDirectory() as out_dir:
+        user_fs = fs.open_fs(f"osfs://{users_dir}")
+        add_user(user_fs, 1, [1])
+        add_user(user_fs, 2, [2])
+        export_answers(user_fs, out_dir, workers=2)
+
+        user_file = UserFile(user_fs, 2, "code")
+        user_file.add_answers([make_answer(5)])
+        user_file.flush()
+        add_user(user_fs, 3, [6])
+
+        stats = export_answers(user_fs, out_dir, workers=2)
+        assert stats == {"users": 3, "answers": 4, "read": 2}
+        answers, _ = load_answers(out_dir)
+        assert answers["user_id"].tolist() == [1, 2, 2, 3]
+        assert answers["question_id"].tolist() == [1, 2, 5, 6]
+
+        assert export_answers(user_fs, out_dir, incremental=False)["read"] == 3
+
+
+def test_scan_users_lists_s3_once(monkeypatch):
+    moto = pytest.importorskip("moto")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_s3():
+        boto3.client("s3", region_name="us-east-1").create_bucket(Bucket="test")
+        user_fs = fs.open_fs("s3://test/users/")
+        add_user(user_fs, 1, [1])
+        add_user(user_fs, 2, [2, 3])
+        user_file = UserFile(user_fs, 2, "code")
+        user_file.add_answers([make_answer(4)])
+        user_file.flush()
+
+        counter = Boto3Counter(user_fs.client)
+        listing = sorted(scan_users(user_fs))
+        assert [(user_id, len(paths)) for user_id, _, paths in listing] == [
+            (1, 1),
+            (2, 2),
+        ]
+        assert all(version.startswith('"') for _, version, _ in listing)
+        assert dict(counter.requests) == {
+            (("route", ""), ("operation", "ListObjectsV2")): 1
+        }
@@ -0,0 +1,258 @@
+import json
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import fs
+from experiment_server.journal import JournalCompactor, WriteJournal, apply_entries
+from experiment_server.remote_sqlite import RemoteSqlite
+
+from .test_query import SCHEMA
+
+STATE = {
+    "grid": {str(i): 1 for i in range(16)},
+    "grid_shape": [4, 4],
+    "agent_pos": [0, 0],
+    "exit_pos": [3, 3],
+}
+
+
+def test_compact_resolves_refs_and_is_idempotent():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(f"{tmpdir}/experiments.db")
+        conn.executescript(SCHEMA.read_text())
+        conn.close()
+
+        remote_fs = fs.open_fs(f"osfs://{tmpdir}")
+        journal = WriteJournal(remote_fs)
+        traj_ids = [
+            journal.append(
+                "trajectory",
+                {
+                    "start_state": STATE,
+                    "actions": [1, 2, 3],
+                    "env_name": "miner",
+                    "modality": "traj",
+                },
+            )
+            for _ in range(2)
+        ]
+        journal.append(
+            "question",
+            {
+                "traj_ids": traj_ids,
+                "algo": "manual",
+                "env_name": "miner",
+                "label": "test",
+            },
+        )
+
+        db = RemoteSqlite(remote_fs, "experiments.db")
+        entries = [(key, *journal.read(key)) for key in journal.keys()]
+        assert journal.compact(db) == 3
+        assert journal.keys() == []
+
+        check = RemoteSqlite(remote_fs, "experiments.db")
+        assert check.get_count("trajectories") == 2
+        assert check.select("SELECT first_id, second_id, label FROM questions") == [
+            {"first_id": 1, "second_id": 2, "label": "test"}
+        ]
+
+        # Replaying entries that were already merged, e.g. if removing them failed, does nothing.
+        apply_entries(check.con, entries)
+        assert check.get_count("trajectories") == 2
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_compactor_drains_the_journal_in_batches():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(f"{tmpdir}/experiments.db")
+        conn.executescript(SCHEMA.read_text())
+        conn.close()
+
+        remote_fs = fs.open_fs(f"osfs://{tmpdir}")
+        journal = WriteJournal(remote_fs)
+        for _ in range(3):
+            journal.append(
+                "trajectory",
+                {
+                    "start_state": STATE,
+                    "actions": [1],
+                    "env_name": "miner",
+                    "modality": "traj",
+                },
+            )
+        compactor = JournalCompactor(
+            journal, RemoteSqlite(remote_fs, "experiments.db"), batch_size=2
+        )
+        reader = RemoteSqlite(remote_fs, "experiments.db")
+
+        assert compactor.run() == 3
+        assert journal.keys() == []
+        assert reader.refresh()
+        assert reader.get_count("trajectories") == 3
+        assert compactor.run() == 0
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_entries_are_kept_if_the_push_is_overwritten():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(f"{tmpdir}/experiments.db")
+        conn.executescript(SCHEMA.read_text())
+        conn.close()
+
+        remote_fs = fs.open_fs(f"osfs://{tmpdir}")
+        journal = WriteJournal(remote_fs)
+        journal.append(
+            "trajectory",
+            {
+                "start_state": STATE,
+                "actions": [1],
+                "env_name": "miner",
+                "modality": "traj",
+            },
+        )
+        stale = RemoteSqlite(remote_fs, "experiments.db")
+
+        class Overwritten(RemoteSqlite):
+            def transaction(self, apply, **kwargs):
+                out = super().transaction(apply, **kwargs)
+                # A writer that doesn't check versions uploads its old copy over ours.
+                time.sleep(0.01)
+                stale.push(always_upload=True)
+                return out
+
+        db = Overwritten(remote_fs, "experiments.db")
+        assert journal.compact(db) == 0
+        assert len(journal.keys()) == 1
+
+        assert journal.compact(RemoteSqlite(remote_fs, "experiments.db")) == 1
+        assert journal.keys() == []
+        check = RemoteSqlite(remote_fs, "experiments.db")
+        assert check.get_count("trajectories") == 1
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_bad_entries_are_dead_lettered_without_blocking_the_rest():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(f"{tmpdir}/experiments.db")
+        conn.executescript(SCHEMA.read_text())
+        conn.close()
+
+        remote_fs = fs.open_fs(f"osfs://{tmpdir}")
+        journal = WriteJournal(remote_fs)
+
+        def trajectory() -> str:
+            return journal.append(
+                "trajectory",
+                {
+                    "start_state": STATE,
+                    "actions": [1],
+                    "env_name": "miner",
+                    "modality": "traj",
+                },
+            )
+
+        def question(traj_ids, label: str) -> str:
+            return journal.append(
+                "question",
+                {
+                    "traj_ids": traj_ids,
+                    "algo": "manual",
+                    "env_name": "miner",
+                    "label": label,
+                },
+            )
+
+        first = trajectory()
+        bad_ids = [
+            question([first, "not an id"], "not a number"),
+            question([first, "journal:missing"], "missing ref"),
+        ]
+        second = trajectory()
+        question([first, second], "good")
+
+        db = RemoteSqlite(remote_fs, "experiments.db")
+        # Only the first trajectory and the bad questions fit in the first batch.
+        assert journal.compact(db, batch_size=3) == 3
+        assert journal.compact(db, batch_size=3) == 2
+        assert journal.keys() == []
+        dead = sorted(
+            name[: -len(".json")] for name in remote_fs.listdir("journal/dead")
+        )
+        assert dead == sorted(ref[len("journal:") :] for ref in bad_ids)
+
+        check = RemoteSqlite(remote_fs, "experiments.db")
+        assert check.get_count("trajectories") == 2
+        assert check.select("SELECT first_id, second_id, label FROM questions") == [
+            {"first_id": 1, "second_id": 2, "label": "good"}
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_refs_to_later_entries_are_merged_with_them():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        conn = sqlite3.connect(f"{tmpdir}/experiments.db")
+        conn.executescript(SCHEMA.read_text())
+        conn.close()
+
+        remote_fs = fs.open_fs(f"osfs://{tmpdir}")
+        journal = WriteJournal(remote_fs)
+        traj = {
+            "start_state": STATE,
+            "actions": [1],
+            "env_name": "miner",
+            "modality": "traj",
+        }
+        first = journal.append("trajectory", traj)
+        # A question submitted by a worker whose clock is behind the one that journaled its
+        # trajectory sorts first.
+        remote_fs.writetext(
+            "journal/00000000000000000000-00000000.json",
+            json.dumps(
+                {
+                    "kind": "question",
+                    "payload": {
+                        "traj_ids": [first, first],
+                        "algo": "manual",
+                        "env_name": "miner",
+                        "label": "early",
+                    },
+                }
+            ),
+        )
+
+        db = RemoteSqlite(remote_fs, "experiments.db")
+        assert journal.compact(db, batch_size=1) == 2
+        assert journal.keys() == []
+        assert not remote_fs.exists("journal/dead")
+        assert db.select("SELECT first_id, second_id FROM questions") == [
+            {"first_id": 1, "second_id": 1}
+        ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_apply_entries_defers_refs_to_pending_entries():
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(SCHEMA.read_text())
+    question = {
+        "traj_ids": ["journal:later", 1],
+        "algo": "manual",
+        "env_name": "miner",
+        "label": "waits",
+    }
+    result = apply_entries(conn, [("a", "question", question)], pending={"later"})
+    assert result.deferred == ["a"]
+    assert result.applied == [] and result.failed == {}
+    assert conn.execute("SELECT COUNT(*) FROM questions").fetchone() == (0,)
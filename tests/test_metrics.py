@@ -0,0 +1,96 @@
+import threading
+
+import boto3.session
+import pytest
+from experiment_server.boto3_counter import S3_STANDARD_PRICES, Boto3Counter
+from experiment_server.common import SessionS3FS
+from experiment_server.metrics import (
+    Histogram,
+    RequestMetrics,
+    current_route,
+    format_histogram,
+    labeled,
+    render,
+    route_label,
+)
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram([1.0, 2.0])
+    for value in (0.5, 1.5, 3.0):
+        histogram.observe(value)
+    assert histogram.counts == [1, 2]
+    lines = format_histogram("x", "help", {(("route", "/"),): histogram})
+    assert 'x_bucket{route="/",le="+Inf"} 3' in lines
+    assert 'x_sum{route="/"} 5.0' in lines
+
+
+def test_route_label():
+    metrics = RequestMetrics()
+    labels = []
+
+    def transfer_thread():
+        labels.append(route_label())
+
+    token = metrics.begin("/submit_answer")
+    assert route_label() == "/submit_answer"
+    # Threads don't inherit the route, but there's only one request to attribute their calls to.
+    thread = threading.Thread(target=transfer_thread)
+    thread.start()
+    thread.join()
+    metrics.end(token, "POST", 200)
+    assert labels == ["/submit_answer"]
+    assert current_route.get() is None
+    assert route_label() == "background"
+    assert (
+        'http_requests_total{route="/submit_answer",method="POST",status="200"} 1'
+        in (render([metrics.prometheus()]))
+    )
+
+
+def test_counter_cost_by_route():
+    counter = Boto3Counter(prices=S3_STANDARD_PRICES)
+    counter.record("/", "PutObject", 0.01, 100, 0)
+    counter.record("/", "GetObject", 0.01, 0, 100)
+    counter.record("/", "DeleteObject", 0.01, 0, 0)
+    assert counter.get_counts() == (1, 1)
+    assert counter.get_request_cost_cents() == 0.00054
+    text = render([counter.prometheus()])
+    assert 's3_requests_total{route="/",operation="DeleteObject"} 1' in text
+    assert (
+        's3_request_bytes_sum{route="/",operation="GetObject",direction="received"} 100.0'
+        in text
+    )
+
+
+def test_session_clients_are_counted_under_their_task(monkeypatch):
+    moto = pytest.importorskip("moto")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_s3():
+        session = boto3.session.Session()
+        counter = Boto3Counter(label=route_label)
+        counter.watch_session(session)
+        s3_fs = SessionS3FS("test", session=session)
+        s3_fs.client.create_bucket(Bucket="test")
+
+        def flusher():
+            # A new thread, so a new client, and the upload itself runs on boto3's transfer threads.
+            with labeled("write_behind"):
+                s3_fs.writetext("a.txt", "a")
+
+        thread = threading.Thread(target=flusher)
+        thread.start()
+        thread.join()
+
+        assert current_route.get() is None
+        assert (
+            counter.requests[(("route", "write_behind"), ("operation", "PutObject"))]
+            == 1
+        )
+        assert {
+            dict(labels)["route"]
+            for labels in counter.requests
+            if dict(labels)["operation"] != "CreateBucket"
+        } == {"write_behind"}
@@ -0,0 +1,37 @@
+import json
+import pickle
+import sqlite3
+
+from experiment_server.profiling import ActiveProfile, ProfileBuffer, sign, verify
+
+
+def test_tokens_expire_and_need_the_secret():
+    token = sign("secret", expires=1000)
+    assert verify("secret", token, now=999)
+    assert not verify("secret", token, now=1001)
+    assert not verify("other secret", token, now=999)
+    assert not verify("secret", "1000.0123", now=999)
+    assert not verify("secret", "garbage", now=999)
+
+
+def test_profile_breakdown():
+    buffer = ProfileBuffer(maxlen=2)
+    conn = sqlite3.connect(":memory:")
+    for _ in range(3):
+        active = ActiveProfile(buffer, "POST", "/random_questions", "/random_questions")
+        conn.execute(
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 100000) SELECT SUM(i) FROM n"
+        ).fetchall()
+        pickle.loads(pickle.dumps(list(range(100000))))
+        json.dumps(list(range(100000)))
+        profile = active.finish(200)
+
+    assert [p.id for p in buffer.recent()] == [3, 2]
+    assert buffer.get(1) is None
+    assert buffer.get(3) is profile
+    for category in ("sqlite", "decode", "json"):
+        assert profile.seconds[category] > 0
+    assert sum(v for k, v in profile.seconds.items() if k != "total") >= (
+        profile.seconds["total"] * 0.99
+    )
+    assert "cumulative" in profile.report
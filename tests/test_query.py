@@ -0,0 +1,183 @@
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pytest
+from experiment_server.codec import decode_array, encode_actions, encode_state
+from experiment_server.query import (
+    QuestionPool,
+    backfill_flags,
+    bulk_save_questions,
+    ensure_flag_columns,
+    get_questions,
+    get_random_questions,
+    insert_question,
+    insert_traj,
+)
+from experiment_server.question_cache import QuestionCache
+from experiment_server.type import State, Trajectory
+
+SCHEMA = Path(__file__).parent.parent / "experiment_server" / "schema.sql"
+
+
+def make_traj(length: int, modality: str = "traj", fire: bool = False) -> Trajectory:
+    grid = np.ones(16, dtype=np.int32)
+    if fire:
+        grid[3] = 12
+    return Trajectory(
+        start_state=State(grid, (4, 4), (0, 0), (3, 3)),
+        actions=np.zeros(length, dtype=np.int64),
+        env_name="miner",
+        modality=modality,  # type: ignore
+    )
+
+
+def make_db(lengths=(5, 5, 5, 10)) -> sqlite3.Connection:
+    conn = sqlite3.connect(":memory:")
+    conn.executescript(SCHEMA.read_text())
+    for length in lengths:
+        first = insert_traj(conn, make_traj(length))
+        second = insert_traj(conn, make_traj(length))
+        insert_question(conn, (first, second), "random", "miner")
+    return conn
+
+
+def test_pool_keys():
+    pool = QuestionPool(make_db())
+    assert list(pool.pools[("miner", "traj", 5)]) == [1, 2, 3]
+    assert list(pool.pools[("miner", None, None)]) == [1, 2, 3, 4]
+    assert ("miner", "state", None) not in pool.pools
+
+
+def test_sample_excludes():
+    pool = QuestionPool(make_db())
+    for _ in range(20):
+        ids = pool.sample(2, "traj", "miner", length=5, exclude_ids=[2])
+        assert sorted(ids) == [1, 3]
+
+
+def test_random_questions_match_spec():
+    conn = make_db()
+    questions = get_random_questions(conn, 3, "traj", "miner", length=5)
+    assert sorted(q.id for q in questions) == [1, 2, 3]
+    assert all(len(t.actions) == 5 for q in questions for t in q.trajs)
+
+
+def test_question_cache_hits_and_invalidates():
+    conn = make_db()
+    cache = QuestionCache(maxsize=2)
+    loads = []
+
+    def load(ids):
+        loads.append(list(ids))
+        return get_questions(conn, ids)
+
+    cache.sync(0)
+    assert [q.id for q in cache.get_many([1, 2], load)] == [1, 2]
+    assert [q.id for q in cache.get_many([2, 1], load)] == [2, 1]
+    assert loads == [[1, 2]]
+    cache.get_many([3], load)
+    assert len(cache) == 2 and loads[-1] == [3]
+    assert cache.stats()["hits"] == 2 and cache.stats()["misses"] == 3
+
+    assert cache.sync(1)
+    cache.get_many([2], load)
+    assert loads[-1] == [2]
+
+
+def test_double_fire_pool():
+    conn = make_db(lengths=(5,))
+    first = insert_traj(conn, make_traj(5, fire=True))
+    second = insert_traj(conn, make_traj(5, fire=True))
+    fire_id = insert_question(conn, (first, second), "random", "miner")
+    pool = QuestionPool(conn)
+    assert pool.double_fire == {fire_id}
+    assert pool.sample(5, "traj", "miner", exclude_double_fire=True) == [1]
+    assert sorted(pool.sample(5, "traj", "miner")) == [1, fire_id]
+
+
+def test_backfill_flags():
+    conn = make_db(lengths=(5,))
+    insert_traj(conn, make_traj(5, fire=True))
+    conn.execute("UPDATE trajectories SET has_fire=NULL, tile_counts=NULL")
+    assert backfill_flags(conn, batch_size=2) == 3
+    assert [
+        has_fire for (has_fire,) in conn.execute("SELECT has_fire FROM trajectories")
+    ] == [0, 0, 1]
+    (tile_counts,) = next(
+        conn.execute("SELECT tile_counts FROM trajectories WHERE id=3")
+    )
+    assert list(decode_array(tile_counts)) == [0, 15] + [0] * 10 + [1]
+
+
+@pytest.mark.parametrize("workers", [0, 2])
+def test_bulk_save_questions(workers: int):
+    conn = make_db(lengths=(5,))
+    pairs = ((make_traj(i % 7), make_traj(i % 7, fire=True)) for i in range(250))
+    assert (
+        bulk_save_questions(
+            conn, pairs, "random", "miner", chunk_size=64, workers=workers
+        )
+        == 250
+    )
+
+    questions = get_questions(conn, [2, 100, 251])
+    assert [len(q.trajs[0].actions) for q in questions] == [0, 98 % 7, 249 % 7]
+    assert questions[2].trajs[1] == make_traj(249 % 7, fire=True)
+    assert conn.execute(
+        "SELECT COUNT(*), SUM(has_fire) FROM trajectories"
+    ).fetchone() == (502, 250)
+
+
+def test_pool_reads_unmigrated_databases_without_writing():
+    conn = sqlite3.connect(":memory:")
+    conn.execute(
+        "CREATE TABLE trajectories(id INTEGER PRIMARY KEY, start_state BLOB NOT NULL, actions BLOB NOT NULL, length INT NOT NULL, env TEXT NOT NULL, modality TEXT NOT NULL, reason TEXT, cstates BLOB)"
+    )
+    # The schema can be re-run on a database from before the flag columns.
+    conn.executescript(SCHEMA.read_text())
+    for _ in range(2):
+        conn.execute(
+            "INSERT INTO trajectories (start_state, actions, length, env, modality) VALUES (?, ?, 5, 'miner', 'traj')",
+            (
+                encode_state(make_traj(5, fire=True).start_state),
+                encode_actions(np.zeros(5)),
+            ),
+        )
+    insert_question(conn, (1, 2), "random", "miner")
+
+    conn.execute("PRAGMA query_only = ON")
+    pool = QuestionPool(conn)
+    assert pool.unflagged == 1
+    assert pool.sample(5, "traj", "miner") == [1]
+    # Unflagged questions might have fire in both trajectories, so they aren't served as safe.
+    assert pool.sample(5, "traj", "miner", exclude_double_fire=True) == []
+
+    conn.execute("PRAGMA query_only = OFF")
+    ensure_flag_columns(conn)
+    backfill_flags(conn)
+    pool = QuestionPool(conn)
+    assert pool.unflagged == 0 and pool.double_fire == {1}
+
+
+def test_random_questions_are_short_rather_than_failing():
+    conn = make_db(lengths=(5, 5, 5))
+    # A pool from a newer snapshot than conn has ids conn doesn't know about.
+    newer = make_db(lengths=(5, 5, 5, 5, 5))
+    questions = get_random_questions(
+        conn, 5, "traj", "miner", length=5, pool=QuestionPool(newer)
+    )
+    assert sorted(q.id for q in questions) == [1, 2, 3]
+    # There are only three questions of length 5 to sample from.
+    assert len(get_random_questions(conn, 5, "traj", "miner", length=5)) == 3
+
+
+def test_question_cache_bypasses_older_snapshots():
+    conn = make_db()
+    cache = QuestionCache()
+    cache.sync(2)
+    assert not cache.sync(1)
+    get_random_questions(conn, 2, "traj", "miner", length=5, cache=cache, snapshot=1)
+    assert len(cache) == 0
+    get_random_questions(conn, 2, "traj", "miner", length=5, cache=cache, snapshot=2)
+    assert len(cache) == 2
@@ -0,0 +1,242 @@
+import sqlite3
+import tempfile
+from pathlib import Path
+
+import boto3
+import fs
+import pytest
+from experiment_server.remote_sqlite import PushConflict, RemoteSqlite
+
+
+def make_remote(root: Path) -> fs.base.FS:
+    for name in ("remote", "worker_1", "worker_2"):
+        (root / name).mkdir()
+    conn = sqlite3.connect(root / "remote" / "test.db")
+    conn.execute("CREATE TABLE items(id INTEGER PRIMARY KEY, name TEXT)")
+    conn.commit()
+    conn.close()
+    return fs.open_fs(f"osfs://{root / 'remote'}")
+
+
+def insert(name: str):
+    def apply(conn: sqlite3.Connection) -> None:
+        conn.execute("INSERT INTO items (name) VALUES (?)", (name,))
+        conn.commit()
+
+    return apply
+
+
+def test_refresh_only_downloads_changes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote = make_remote(root)
+        reader = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}"
+        )
+        writer = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_2'}"
+        )
+
+        snapshot = reader.snapshot
+        assert not reader.refresh()
+        writer.transaction(insert("a"))
+        assert reader.refresh()
+        assert reader.snapshot > snapshot
+        assert reader.select("SELECT name FROM items") == [{"name": "a"}]
+
+
+def test_conflicting_push_is_retried():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote = make_remote(root)
+        first = RemoteSqlite(remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}")
+        second = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_2'}"
+        )
+
+        first.transaction(insert("a"))
+
+        # second pulled before first pushed, so a blind push would drop "a".
+        insert("b")(second.con)
+        with pytest.raises(PushConflict):
+            second.push()
+
+        # Another worker pushes between second's pull and push, so second has to replay "b".
+        calls = []
+
+        def racing_insert(conn: sqlite3.Connection) -> None:
+            if len(calls) == 0:
+                first.transaction(insert("c"))
+            calls.append(conn)
+            insert("b")(conn)
+
+        second.transaction(racing_insert, backoff=0.0)
+        assert len(calls) == 2
+        assert second.retries == 1
+        assert second.conflicts == 2
+
+        check = RemoteSqlite(remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}")
+        names = sorted(row["name"] for row in check.select("SELECT name FROM items"))
+        assert names == ["a", "b", "c"]
+
+
+def test_insert_and_get_counts():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote_fs = make_remote(root)
+        db = RemoteSqlite(remote_fs, "test.db", local_dir=f"osfs://{root / 'worker_1'}")
+        db.con.execute("CREATE TABLE empty(id INTEGER PRIMARY KEY)")
+
+        records = (
+            {"name": str(i)} if i % 3 else {"id": 100 + i, "name": str(i)}
+            for i in range(10)
+        )
+        assert db.insert("items", records) == 10
+        assert db.get_counts() == [{"items": 10}, {"empty": 0}]
+        assert db.select("SELECT name FROM items WHERE id=103") == [{"name": "3"}]
+
+
+def test_workers_sharing_a_directory_keep_separate_copies():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote = make_remote(root)
+        local_dir = f"osfs://{root / 'worker_1'}"
+        first = RemoteSqlite(remote, "test.db", local_dir=local_dir)
+        second = RemoteSqlite(remote, "test.db", local_dir=local_dir)
+        assert first.localpath != second.localpath
+
+        # An uncommitted write in one worker's copy must not be uploaded by the other.
+        first.con.execute("INSERT INTO items (name) VALUES ('uncommitted')")
+        first.con.commit()
+        second.transaction(insert("a"))
+        assert second.select("SELECT name FROM items") == [{"name": "a"}]
+
+        first.close()
+        assert not Path(first.localpath).exists()
+
+
+def test_refresh_keeps_old_connection_readable():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote = make_remote(root)
+        reader = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}"
+        )
+        writer = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_2'}"
+        )
+
+        old = reader.con
+        writer.transaction(insert("a"))
+        assert reader.refresh()
+        assert old.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 0
+        assert reader.select("SELECT name FROM items") == [{"name": "a"}]
+
+
+def test_reader_follows_refreshes():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote = make_remote(root)
+        reader = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}"
+        )
+        writer = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_2'}"
+        )
+
+        con = reader.reader()
+        assert reader.reader() is con
+        with pytest.raises(sqlite3.OperationalError):
+            con.execute("INSERT INTO items (name) VALUES ('x')")
+
+        writer.transaction(insert("a"))
+        assert reader.refresh()
+        assert reader.reader() is not con
+        assert reader.reader().execute("SELECT name FROM items").fetchall()[0][0] == "a"
+
+
+def test_push_racing_the_upload_is_not_taken_for_ours():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote = make_remote(root)
+        other = RemoteSqlite(remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}")
+
+        class Raced(RemoteSqlite):
+            def _uploaded_version(self):
+                # Another worker's push lands right after ours.
+                other.transaction(insert("theirs"))
+                return super()._uploaded_version()
+
+        db = Raced(remote, "test.db", local_dir=f"osfs://{root / 'worker_2'}")
+        insert("ours")(db.con)
+        db.push()
+        assert db.version is None
+
+        # Taking their version would let this push silently overwrite "theirs".
+        insert("again")(db.con)
+        with pytest.raises(PushConflict):
+            db.push()
+        assert db.refresh()
+        names = [row["name"] for row in db.select("SELECT name FROM items")]
+        assert names == ["ours", "theirs"]
+
+
+def test_s3_push_is_conditional_and_keeps_its_own_etag(monkeypatch):
+    moto = pytest.importorskip("moto")
+    for name in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        monkeypatch.setenv(name, "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_s3(), tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        make_remote(root)
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="test")
+        client.upload_file(str(root / "remote" / "test.db"), "test", "test.db")
+        remote = fs.open_fs("s3://test/")
+
+        db = RemoteSqlite(remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}")
+        pulled = db.version
+        puts = []
+        remote.client.meta.events.register(
+            "provide-client-params.s3.PutObject",
+            lambda params, **kwargs: puts.append(dict(params)),
+        )
+        insert("a")(db.con)
+        db.push()
+        assert puts[0]["IfMatch"] == pulled
+        assert db.version == remote.getinfo("test.db", ["s3"]).get("s3", "e_tag")
+
+        # Someone else's upload after ours must not become our version.
+        client.put_object(Bucket="test", Key="test.db", Body=b"not ours")
+        assert db.version != db.remote_version()
+        insert("b")(db.con)
+        with pytest.raises(PushConflict):
+            db.push()
+
+
+def test_view_reads_one_snapshot_across_a_refresh():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        remote = make_remote(root)
+        reader = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_1'}"
+        )
+        writer = RemoteSqlite(
+            remote, "test.db", local_dir=f"osfs://{root / 'worker_2'}"
+        )
+
+        def count(con: sqlite3.Connection) -> int:
+            return con.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+        view = reader.view()
+        writer.transaction(insert("a"))
+        assert reader.refresh()
+
+        # Derived values and reads through the old view still come from the old snapshot.
+        assert view.derived("count", count) == 0
+        assert count(view.con) == 0
+        new_view = reader.view()
+        assert new_view.id > view.id
+        assert new_view.derived("count", count) == 1
+        assert reader.derived("count", count) == 1
+        assert view.derived("count", count) == 0
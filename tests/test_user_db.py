@@ -0,0 +1,74 @@
+import json
+import sqlite3
+import tempfile
+
+import fs
+import pytest
+from attrs import asdict
+from experiment_server.type import User
+from experiment_server.user_db import (
+    UserDatabase,
+    connect_user_db,
+    find_user_by_payment_code,
+    import_user_files,
+)
+
+from .strategies import make_answer
+
+
+def make_conn() -> sqlite3.Connection:
+    return connect_user_db(":memory:", create=True)
+
+
+def test_answers_roundtrip():
+    conn = make_conn()
+    user_db = UserDatabase(conn, 3, "code")
+    user_db.add_answers([make_answer(1), make_answer(2)])
+    user = user_db.get()
+    assert user.get_used_questions() == [1, 2]
+    assert user.responses[0] == make_answer(1)
+
+    user.interact_times = ("a", "b")
+    user_db.write(user)
+    assert UserDatabase(conn, 3, "code").get() == user
+    assert find_user_by_payment_code(conn, "code") == 3
+
+
+def test_payment_code_mismatch():
+    conn = make_conn()
+    UserDatabase(conn, 3, "code")
+    with pytest.raises(ValueError):
+        UserDatabase(conn, 3, "other code")
+
+
+def test_import_user_files():
+    user = User(user_id=7, payment_code="code", responses=[make_answer(4)])
+    with tempfile.TemporaryDirectory() as tmpdir:
+        user_fs = fs.open_fs(f"osfs://{tmpdir}")
+        user_fs.writetext("user_7.json", json.dumps(asdict(user)))
+        conn = make_conn()
+        assert import_user_files(user_fs, conn) == 1
+        assert import_user_files(user_fs, conn) == 0
+    assert UserDatabase(conn, 7, "code").get() == user
+
+
+def test_answer_batches_are_idempotent():
+    conn = make_conn()
+    user_db = UserDatabase(conn, 3, "code")
+    user_db.add_answers([make_answer(1), make_answer(2)], key="batch-1")
+    user_db.add_answers([make_answer(1), make_answer(2)], key="batch-1")
+    user_db.add_answers([make_answer(3)], key="batch-2")
+    assert user_db.get().get_used_questions() == [1, 2, 3]
+
+
+def test_write_keeps_answers_added_since_get():
+    conn = make_conn()
+    user_db = UserDatabase(conn, 3, "code")
+    user = user_db.get()
+    UserDatabase(conn, 3, "code").add_answers([make_answer(1)])
+
+    user.interact_times = ("a", "b")
+    user_db.write(user)
+    user = UserDatabase(conn, 3, "code").get()
+    assert user.get_used_questions() == [1]
+    assert user.interact_times == ("a", "b")
@@ -0,0 +1,59 @@
+import json
+import tempfile
+
+import fs
+from attrs import asdict
+from experiment_server.type import User
+from experiment_server.user_file import UserFile, compact_user, read_user
+
+from .strategies import make_answer
+
+
+def test_answers_are_appended_without_rewriting_user():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        user_fs = fs.open_fs(f"osfs://{tmpdir}")
+        user_file = UserFile(user_fs, 3, "code")
+        user_file.get()
+        user_file.flush()
+        snapshot = user_fs.readtext("user_3.json")
+
+        for question_id in (1, 2):
+            user_file = UserFile(user_fs, 3, "code")
+            user_file.add_answers([make_answer(question_id)])
+            user_file.flush()
+            assert user_file.user is None
+
+        assert user_fs.readtext("user_3.json") == snapshot
+        assert len(user_fs.listdir("user_3_answers")) == 2
+        assert UserFile(user_fs, 3, "code").get().get_used_questions() == [1, 2]
+
+
+def test_compact_user():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        user_fs = fs.open_fs(f"osfs://{tmpdir}")
+        user = User(user_id=3, payment_code="code", responses=[make_answer(1)])
+        user_fs.writetext("user_3.json", json.dumps(asdict(user)))
+        user_file = UserFile(user_fs, 3, "code")
+        user_file.add_answers([make_answer(2), make_answer(3)])
+        user_file.flush()
+
+        assert compact_user(user_fs, 3) == 1
+        assert user_fs.listdir("user_3_answers") == []
+        assert compact_user(user_fs, 3) == 0
+        user = read_user(user_fs, 3)
+        assert user is not None
+        assert user.get_used_questions() == [1, 2, 3]
+
+
+def test_interrupted_compaction_does_not_duplicate_answers():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        user_fs = fs.open_fs(f"osfs://{tmpdir}")
+        user = User(user_id=3, payment_code="code", responses=[make_answer(1)])
+        user_fs.writetext("user_3.json", json.dumps(asdict(user)))
+        user_file = UserFile(user_fs, 3, "code")
+        user_file.add_answers([make_answer(1), make_answer(2)])
+        user_file.flush()
+
+        user = read_user(user_fs, 3)
+        assert user is not None
+        assert user.get_used_questions() == [1, 2]
@@ -0,0 +1,50 @@
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import fs
+import pytest
+from experiment_server.user_db import connect_user_db
+from experiment_server.user_ids import (
+    MemoryIdAllocator,
+    RandomIdAllocator,
+    SqliteIdAllocator,
+)
+
+
+def test_memory_allocator():
+    allocator = MemoryIdAllocator()
+    with ThreadPoolExecutor(4) as pool:
+        ids = list(pool.map(lambda _: allocator.allocate(), range(100)))
+    assert sorted(ids) == list(range(100))
+    assert allocator.stats()["allocated"] == 100
+    assert (
+        'user_id_allocation_seconds_count{allocator="MemoryIdAllocator"} 100'
+        in allocator.prometheus()
+    )
+
+
+def test_random_allocator_skips_existing_users():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        user_fs = fs.open_fs(f"osfs://{tmpdir}")
+        user_fs.writetext("user_0.json", "{}")
+        allocator = RandomIdAllocator(user_fs, bits=1, max_attempts=100)
+        assert all(allocator.allocate() == 1 for _ in range(10))
+
+        user_fs.writetext("user_1.json", "{}")
+        with pytest.raises(RuntimeError):
+            allocator.allocate()
+
+
+def test_sqlite_allocator_continues_after_imported_users():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = str(Path(tmpdir) / "users.db")
+        conn = connect_user_db(path, create=True)
+        with conn:
+            conn.execute("INSERT INTO users (id, payment_code) VALUES (4, 'code')")
+        conn.close()
+
+        allocator = SqliteIdAllocator(path)
+        with ThreadPoolExecutor(4) as pool:
+            ids = list(pool.map(lambda _: allocator.allocate(), range(20)))
+        assert sorted(ids) == list(range(5, 25))
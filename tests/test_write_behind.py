@@ -0,0 +1,78 @@
+import tempfile
+from pathlib import Path
+
+import fs
+import pytest
+from experiment_server.user_file import UserFile
+from experiment_server.write_behind import WriteBehindFS
+
+from .strategies import make_answer
+
+
+def test_writes_are_readable_before_upload():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        (root / "users").mkdir()
+        users_fs = fs.open_fs(f"osfs://{root / 'users'}")
+        write_behind = WriteBehindFS(users_fs, str(root / "spool.db"))
+
+        user_file = UserFile(write_behind, 3, "code")
+        user_file.create()
+        user_file.flush()
+        user_file = UserFile(write_behind, 3, "code")
+        user_file.add_answers([make_answer(1), make_answer(2)])
+        user_file.flush()
+
+        assert users_fs.listdir("/") == []
+        assert write_behind.exists("user_3.json")
+        assert UserFile(write_behind, 3, "code").get().get_used_questions() == [1, 2]
+
+        assert write_behind.flush() == 2
+        assert len(write_behind.spool) == 0
+        assert UserFile(users_fs, 3, "code").get().get_used_questions() == [1, 2]
+
+
+def test_spool_is_replayed_after_restart():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        (root / "users").mkdir()
+        users_fs = fs.open_fs(f"osfs://{root / 'users'}")
+
+        crashed = WriteBehindFS(users_fs, str(root / "spool.db"))
+        crashed.writetext("a.json", "old")
+        crashed.writetext("a.json", "new")
+        crashed.writetext("b.json", "b")
+
+        restarted = WriteBehindFS(users_fs, str(root / "spool.db"))
+        restarted.close()
+        assert users_fs.readtext("a.json") == "new"
+        assert users_fs.readtext("b.json") == "b"
+
+
+def test_leased_paths_are_not_uploaded_twice():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        (root / "users").mkdir()
+        users_fs = fs.open_fs(f"osfs://{root / 'users'}")
+        first = WriteBehindFS(users_fs, str(root / "spool.db"))
+        second = WriteBehindFS(users_fs, str(root / "spool.db"))
+
+        first.writetext("a.json", "old")
+        assert list(first.spool.lease(10)) == ["/a.json"]
+        second.writetext("a.json", "new")
+        assert second.flush() == 0
+
+
+def test_failed_uploads_stay_in_spool():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root = Path(tmpdir)
+        (root / "users").mkdir()
+        users_fs = fs.open_fs(f"osfs://{root / 'users'}")
+        write_behind = WriteBehindFS(users_fs, str(root / "spool.db"))
+        write_behind.writetext("a.json", "a")
+        users_fs.close()
+
+        with pytest.raises(Exception):
+            write_behind.flush()
+        assert write_behind.readtext("a.json") == "a"
+        assert write_behind.spool.lease(10) != {}